@@ -0,0 +1,86 @@
+"""
+Lookup benchmark on a simulated network
+
+Bootstraps a simulated network (@see dhtbot.simulator), then runs
+lookups towards random targets from random nodes, one after the other,
+and reports the (simulated) lookup latency, the number of queries and
+rounds per lookup, how well the routing tables have converged, and the
+number of messages that crossed the network. Runs are deterministic:
+the same arguments always give the same report
+
+Run with:
+    python -m dhtbot.benchmarks.lookup_simulation [nodes] [lookups]
+        [loss] [churn] [seed]
+
+where nodes is the size of the network (default 2000), lookups the
+number of lookups to time (default 200), loss the probability that a
+packet is lost (default 0), churn the fraction of nodes replaced per
+second (default 0), and seed the random seed (default 0)
+
+"""
+import sys
+
+from dhtbot.protocols.krpc_iterator import IterationError
+from dhtbot.simulator import Simulator, ChurnModel, uniform_latency
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def run(num_nodes, num_lookups, loss=0.0, churn_rate=0.0, seed=0):
+    churn = ChurnModel(churn_rate) if churn_rate > 0 else None
+    simulator = Simulator(num_nodes=num_nodes, seed=seed, loss=loss,
+                          churn=churn, latency=uniform_latency(0.02, 0.15))
+    simulator.start()
+    try:
+        simulator.bootstrap()
+        print ("bootstrap nodes=%d simulated_seconds=%.1f messages=%d "
+               "convergence=%.3f" % (num_nodes, simulator.clock.seconds(),
+               simulator.network.sent, simulator.convergence()))
+        sys.stdout.flush()
+        messages_before = simulator.network.sent
+        latencies = []
+        queries = []
+        rounds = []
+        failures = 0
+        for i in xrange(num_lookups):
+            start = simulator.clock.seconds()
+            d = simulator.lookup(simulator.random_node(),
+                                 simulator.random_id())
+            try:
+                lookup = simulator.run_until(d)
+            except IterationError:
+                failures += 1
+                continue
+            latencies.append(simulator.clock.seconds() - start)
+            queries.append(lookup.stats.queries)
+            rounds.append(lookup.stats.rounds)
+        if len(latencies) == 0:
+            print "lookups=%d failures=%d" % (num_lookups, failures)
+            return simulator
+        print ("lookups=%d failures=%d latency_p50=%.3f latency_p90=%.3f "
+               "latency_max=%.3f queries_avg=%.1f rounds_avg=%.1f "
+               "messages=%d" % (num_lookups, failures,
+               percentile(latencies, 0.5), percentile(latencies, 0.9),
+               max(latencies), float(sum(queries)) / len(queries),
+               float(sum(rounds)) / len(rounds),
+               simulator.network.sent - messages_before))
+        network = simulator.network
+        print ("network sent=%d delivered=%d lost=%d unreachable=%d "
+               "queries=%d responses=%d errors=%d departed=%d "
+               "convergence=%.3f" % (network.sent, network.delivered,
+               network.lost, network.unreachable,
+               network.msgtype_counts['q'], network.msgtype_counts['r'],
+               network.msgtype_counts['e'], simulator.departed,
+               simulator.convergence()))
+    finally:
+        simulator.stop()
+    return simulator
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    loss = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    churn_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+    run(num_nodes, num_lookups, loss, churn_rate, seed)
@@ -0,0 +1,415 @@
+"""
+Microbenchmarks of the hot paths, with JSON output and regression checks
+
+Covers the bencode and krpc_coder encoding/decoding of every message
+type, the basic_coder conversions, TreeRoutingTable.offer_node and
+get_closest_nodes (on tables offered 1K to 1M nodes), MemoryDataStore
+put/get/expiry, _TokenGenerator generate/verify, and TokenBucket and
+HostBuckets consume. Every benchmark runs offline and is timed as the
+best of a few repetitions, reported in seconds per operation
+
+Run with:
+    python -m dhtbot.benchmarks.micro list
+    python -m dhtbot.benchmarks.micro run [output.json] [pattern]
+    python -m dhtbot.benchmarks.micro compare baseline.json current.json
+        [tolerance]
+
+`run` times every benchmark whose name contains pattern (default: all
+of them) and writes the results to output.json if given. `compare`
+reports the change of every benchmark between two such files and
+exits with a non zero status if any benchmark got slower by more than
+tolerance (a fraction, default 0.1)
+
+"""
+import sys
+import json
+import time
+import random
+
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot import constants, contact
+from dhtbot.coding import basic_coder, krpc_coder
+from dhtbot.coding.bencode import bencode, bdecode
+from dhtbot.datastore import MemoryDataStore
+from dhtbot.simulator import VirtualClock
+from dhtbot.krpc_types import Query, Response
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.protocols.krpc_responder import _TokenGenerator
+from dhtbot.extensions.rate_limiter import TokenBucket, HostBuckets
+
+timer = time.time
+
+# Version of the JSON output format
+_FORMAT_VERSION = 1
+
+# The number of nodes offered to the routing tables that are benchmarked
+routing_table_sizes = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+# name -> function that prepares a benchmark, returning
+# a function to time and the number of operations it performs
+benchmarks = []
+
+def benchmark(name, repeat=5):
+    """Register the decorated function as the benchmark called name"""
+    def register(prepare):
+        benchmarks.append((name, prepare, repeat))
+        return prepare
+    return register
+
+def measure(func, operations, repeat):
+    """
+    @returns the best time (seconds) per operation of `repeat` calls
+        to func, which performs `operations` operations per call
+    """
+    best = None
+    for i in xrange(repeat):
+        start = timer()
+        func()
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / operations
+
+def _loop(func, args_list):
+    """@returns a function calling func once with each args in args_list"""
+    def run():
+        for args in args_list:
+            func(*args)
+    return run
+
+def _random_ids(rng, count):
+    return [rng.getrandbits(constants.id_size) for i in xrange(count)]
+
+def _random_addresses(rng, count):
+    return [("%d.%d.%d.%d" % (rng.randint(1, 254), rng.randint(0, 255),
+                              rng.randint(0, 255), rng.randint(1, 254)),
+             rng.randint(1, 65535)) for i in xrange(count)]
+
+##
+## bencode / krpc_coder
+##
+
+def _messages():
+    """@returns message type -> a KRPC of that type"""
+    rng = random.Random(0)
+    nodes = [contact.Node(node_id, address) for (node_id, address) in
+             zip(_random_ids(rng, constants.k),
+                 _random_addresses(rng, constants.k))]
+    query = Query()
+    query._transaction_id = 2 ** 15
+    query._from = rng.getrandbits(constants.id_size)
+    query.target_id = rng.getrandbits(constants.id_size)
+    messages = {}
+    for rpctype in ["ping", "find_node", "get_peers", "announce_peer",
+                    "sample_infohashes"]:
+        q = Query()
+        q._transaction_id = query._transaction_id
+        q._from = query._from
+        q.rpctype = rpctype
+        if rpctype != "ping":
+            q.target_id = query.target_id
+        if rpctype == "announce_peer":
+            q.token = "\x01\x02\x03\x04"
+            q.port = 6881
+        messages["query.%s" % rpctype] = q
+    query.rpctype = "ping"
+    messages["response.ping"] = query.build_response()
+    query.rpctype = "find_node"
+    messages["response.find_node"] = query.build_response(nodes=nodes)
+    query.rpctype = "get_peers"
+    messages["response.get_peers"] = query.build_response(
+            token="\x01\x02\x03\x04",
+            peers=_random_addresses(rng, 50))
+    query.rpctype = "sample_infohashes"
+    messages["response.sample_infohashes"] = query.build_response(
+            nodes=nodes, samples=_random_ids(rng, 20), num=1000,
+            interval=constants.sample_infohashes_interval)
+    for (name, message) in messages.items():
+        if name.startswith("response."):
+            message._from = rng.getrandbits(constants.id_size)
+    messages["error"] = query.build_error()
+    return messages
+
+def _decode_fully(packet):
+    krpc = krpc_coder.decode(packet)
+    # Nodes and peers are decoded lazily, on first access
+    if isinstance(krpc, Response):
+        krpc.nodes
+        krpc.peers
+    return krpc
+
+def _register_coder_benchmarks():
+    for (name, message) in sorted(_messages().items()):
+        packet = krpc_coder.encode(message)
+        raw = bdecode(packet)
+        args = [(message,)] * 1000
+        benchmark("krpc_coder.encode.%s" % name)(
+                lambda args=args: (_loop(krpc_coder.encode, args),
+                                   len(args)))
+        benchmark("krpc_coder.decode.%s" % name)(
+                lambda packet=packet: (_loop(_decode_fully,
+                                             [(packet,)] * 1000), 1000))
+        benchmark("bencode.encode.%s" % name)(
+                lambda raw=raw: (_loop(bencode, [(raw,)] * 1000), 1000))
+        benchmark("bencode.decode.%s" % name)(
+                lambda packet=packet: (_loop(bdecode, [(packet,)] * 1000),
+                                       1000))
+
+_register_coder_benchmarks()
+
+##
+## basic_coder
+##
+
+def _basic_coder_inputs():
+    rng = random.Random(0)
+    network_ids = _random_ids(rng, 1000)
+    addresses = _random_addresses(rng, 1000)
+    return {
+        "encode_network_id": network_ids,
+        "decode_network_id": [basic_coder.encode_network_id(network_id)
+                              for network_id in network_ids],
+        "ltob": network_ids,
+        "btol": [basic_coder.ltob(network_id)
+                 for network_id in network_ids],
+        "encode_address": addresses,
+        "decode_address": [basic_coder.encode_address(address)
+                           for address in addresses],
+        "encode_port": [port for (ip, port) in addresses],
+        "decode_port": [basic_coder.encode_port(port)
+                        for (ip, port) in addresses],
+    }
+
+def _register_basic_coder_benchmarks():
+    for (name, inputs) in sorted(_basic_coder_inputs().items()):
+        args = [(value,) for value in inputs]
+        benchmark("basic_coder.%s" % name)(
+                lambda name=name, args=args:
+                    (_loop(getattr(basic_coder, name), args), len(args)))
+
+_register_basic_coder_benchmarks()
+
+##
+## TreeRoutingTable
+##
+
+def _candidate_nodes(size):
+    rng = random.Random(size)
+    return [contact.Node(node_id, address) for (node_id, address) in
+            zip(_random_ids(rng, size), _random_addresses(rng, size))]
+
+def _filled_table(nodes):
+    table = TreeRoutingTable(node_id=2 ** 159 + 1)
+    for node in nodes:
+        table.offer_node(node)
+    return table
+
+def _register_routing_table_benchmarks():
+    for size in routing_table_sizes:
+        # Large tables take long enough to fill that a single
+        # repetition is precise enough
+        repeat = max(1, min(5, 10 ** 5 / size))
+
+        def offer_node(size=size):
+            nodes = _candidate_nodes(size)
+            return (lambda: _filled_table(nodes), size)
+        benchmark("routing_table.offer_node.%d" % size, repeat)(offer_node)
+
+        def get_closest_nodes(size=size):
+            table = _filled_table(_candidate_nodes(size))
+            targets = [(target,) for target in
+                       _random_ids(random.Random(0), 1000)]
+            return (_loop(table.get_closest_nodes, targets), len(targets))
+        benchmark("routing_table.get_closest_nodes.%d" % size)(
+                get_closest_nodes)
+
+_register_routing_table_benchmarks()
+
+##
+## MemoryDataStore
+##
+
+# Peer timeouts are scheduled on a VirtualClock, which keeps its calls
+# on a heap (task.Clock sorts them on every callLater, which would
+# dominate the time measured)
+
+def _peers(count):
+    rng = random.Random(0)
+    # A few popular torrents announced by many peers
+    # and many torrents announced by a single peer
+    infohashes = (_random_ids(rng, 10) * (count / 20) +
+                  _random_ids(rng, count - 10 * (count / 20)))
+    return zip(infohashes, _random_addresses(rng, count))
+
+@benchmark("datastore.put")
+def datastore_put():
+    peers = _peers(10000)
+    def put():
+        _loop(MemoryDataStore(VirtualClock()).put, peers)()
+    return (put, len(peers))
+
+@benchmark("datastore.get")
+def datastore_get():
+    peers = _peers(10000)
+    datastore = MemoryDataStore(VirtualClock())
+    _loop(datastore.put, peers)()
+    return (_loop(datastore.get, [(infohash,) for (infohash, address)
+                                  in peers]), len(peers))
+
+@benchmark("datastore.expiry")
+def datastore_expiry():
+    peers = _peers(10000)
+    def expire():
+        # The datastore reads the time through time.time,
+        # while timeouts are scheduled on its reactor
+        clock = VirtualClock()
+        patcher = MonkeyPatcher((time, "time", clock.seconds))
+        datastore = MemoryDataStore(clock)
+        patcher.runWithPatches(_loop(datastore.put, peers))
+        # Only the expiry of every peer is timed
+        start = timer()
+        patcher.runWithPatches(clock.advance, constants.peer_timeout)
+        expire.elapsed = timer() - start
+    return (expire, len(peers))
+
+##
+## _TokenGenerator
+##
+
+def _token_traffic(count):
+    rng = random.Random(0)
+    traffic = []
+    for (node_id, address) in zip(_random_ids(rng, count),
+                                  _random_addresses(rng, count)):
+        query = Query()
+        query._from = node_id
+        query.target_id = rng.getrandbits(constants.id_size)
+        traffic.append((query, address))
+    return traffic
+
+@benchmark("token_generator.generate")
+def token_generator_generate():
+    traffic = _token_traffic(10000)
+    return (_loop(_TokenGenerator().generate, traffic), len(traffic))
+
+@benchmark("token_generator.verify")
+def token_generator_verify():
+    generator = _TokenGenerator()
+    traffic = [(query, address, generator.generate(query, address))
+               for (query, address) in _token_traffic(10000)]
+    return (_loop(generator.verify, traffic), len(traffic))
+
+##
+## Rate limiting
+##
+
+@benchmark("token_bucket.consume")
+def token_bucket_consume():
+    bucket = TokenBucket(10 ** 9, 10 ** 9)
+    return (_loop(bucket.consume, [(1,)] * 10000), 10000)
+
+@benchmark("host_buckets.consume")
+def host_buckets_consume():
+    addresses = _random_addresses(random.Random(0), 1000)
+    buckets = HostBuckets(10 ** 9, 10 ** 9)
+    return (_loop(buckets.consume, [(address, 1) for address
+                                    in addresses] * 10), 10000)
+
+##
+## Running and comparing
+##
+
+def run(pattern=""):
+    """
+    Time every benchmark whose name contains pattern
+
+    @returns benchmark name -> seconds per operation
+
+    """
+    results = {}
+    for (name, prepare, repeat) in benchmarks:
+        if pattern not in name:
+            continue
+        (func, operations) = prepare()
+        if hasattr(func, "elapsed"):
+            # The function times (part of) itself
+            best = None
+            for i in xrange(repeat):
+                func()
+                if best is None or func.elapsed < best:
+                    best = func.elapsed
+            results[name] = best / operations
+        else:
+            results[name] = measure(func, operations, repeat)
+        print "%-50s %12.3f us/op %12d ops/s" % (name,
+                1e6 * results[name], 1.0 / max(results[name], 1e-12))
+        sys.stdout.flush()
+    return results
+
+def save_results(results, path):
+    output = {"version": _FORMAT_VERSION,
+              "python": sys.version.split()[0],
+              "time": time.time(),
+              "results": results}
+    output_file = open(path, "w")
+    try:
+        json.dump(output, output_file, indent=1, sort_keys=True)
+    finally:
+        output_file.close()
+
+def load_results(path):
+    """@returns benchmark name -> seconds per operation"""
+    input_file = open(path, "r")
+    try:
+        contents = json.load(input_file)
+    finally:
+        input_file.close()
+    if contents.get("version") != _FORMAT_VERSION:
+        raise ValueError("%s is not a benchmark results file" % path)
+    return contents["results"]
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Print the change of every benchmark between two sets of results
+
+    @returns the names of the benchmarks that got slower by more
+        than tolerance (a fraction of the baseline time)
+
+    """
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        if name not in current:
+            print "%-50s missing" % name
+            continue
+        if name not in baseline:
+            print "%-50s new %12.3f us/op" % (name, 1e6 * current[name])
+            continue
+        change = current[name] / max(baseline[name], 1e-12) - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print "%-50s %12.3f -> %12.3f us/op %+7.1f%%%s" % (name,
+                1e6 * baseline[name], 1e6 * current[name], 100 * change,
+                " REGRESSION" if regressed else "")
+    return regressions
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "list":
+        for (name, prepare, repeat) in benchmarks:
+            print name
+    elif command == "run":
+        results = run(sys.argv[3] if len(sys.argv) > 3 else "")
+        if len(sys.argv) > 2:
+            save_results(results, sys.argv[2])
+    elif command == "compare" and len(sys.argv) > 3:
+        tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+        regressions = compare(load_results(sys.argv[2]),
+                              load_results(sys.argv[3]), tolerance)
+        if len(regressions) > 0:
+            print "%d regression(s)" % len(regressions)
+            sys.exit(1)
+    else:
+        print __doc__
+        sys.exit(2)
@@ -0,0 +1,65 @@
+"""
+Long running memory benchmark for the RateLimiter
+
+Floods a RateLimiter with packets from random (spoofed) source
+addresses, and periodically reports the number of tracked hosts and
+the peak memory use of the process. With a memory bounded rate
+limiter, both level off instead of growing with the number of
+distinct addresses seen
+
+Run with:
+    python -m dhtbot.benchmarks.rate_limiter_memory [packets] [rate]
+
+where packets is the total number of packets to simulate (default
+10 million) and rate the number of packets per simulated second
+(default 100000)
+
+"""
+import sys
+import random
+import resource
+
+from dhtbot import constants
+from dhtbot.extensions import rate_limiter
+from dhtbot.extensions.rate_limiter import RateLimiter
+from dhtbot.test.utils import Clock
+
+packet = "x" * 100
+
+def random_address():
+    ip = ".".join(str(random.randint(1, 254)) for i in xrange(4))
+    return (ip, random.randint(1, 65535))
+
+def peak_memory():
+    """Returns the peak resident set size of this process (kilobytes)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run(num_packets, rate, report_every=10 ** 6):
+    clock = Clock()
+    # Drive the rate limiter with a simulated clock so that hours
+    # of traffic can be simulated in minutes, and lift the global
+    # limit so that every packet reaches the per host buckets
+    original_time = rate_limiter.time.time
+    original_rate = constants.global_bandwidth_rate
+    rate_limiter.time.time = clock
+    constants.global_bandwidth_rate = 2 * rate * len(packet)
+    try:
+        limiter = RateLimiter()
+        hosts = limiter.host_buckets
+        for i in xrange(1, num_packets + 1):
+            clock.set(float(i) / rate)
+            limiter.consume(packet, random_address())
+            if i % report_every == 0:
+                print ("packets=%d hosts=%d expirations=%d evictions=%d "
+                       "peak_rss_kb=%d" % (i, len(hosts), hosts.expirations,
+                       hosts.evictions, peak_memory()))
+                sys.stdout.flush()
+    finally:
+        rate_limiter.time.time = original_time
+        constants.global_bandwidth_rate = original_rate
+    return limiter
+
+if __name__ == "__main__":
+    num_packets = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 7
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 10 ** 5
+    run(num_packets, rate)
@@ -0,0 +1,279 @@
+"""
+Receive path throughput benchmark, replaying captured datagrams
+
+Feeds the datagrams of a capture file (@see dhtbot.extensions.capture)
+through a KRPC_Responder, either as fast as possible or at the pace at
+which they were captured, and reports the number of packets processed
+per second along with the time spent in each stage of the receive path:
+
+    parse: bdecoding the datagram, which tells queries apart
+           from (unmatched) replies
+    decode: decoding the bdecoded datagram into a KRPC
+    dispatch: handling the KRPC (routing table, datastore, tokens)
+    encode: encoding the response
+    send: handing the response to the transport
+
+Stages are timed by wrapping the functions that implement them, so the
+timing overhead is included in every stage (and in the total); compare
+runs of the same build rather than absolute numbers.
+
+Python 2 has no tracemalloc, so allocations are reported as the net
+number of garbage collected objects (lists, dicts, class instances, ...)
+created while replaying, as counted by the gc module with collection
+disabled. Objects that are freed as soon as the packet is processed do
+not show up, while objects that are retained (such as routing table
+nodes and stored peers) do.
+
+Run with:
+    python -m dhtbot.benchmarks.replay synthesize path [packets] [seed]
+    python -m dhtbot.benchmarks.replay replay path [paced]
+    python -m dhtbot.benchmarks.replay [packets] [seed]
+
+The first form writes a synthetic capture (@see synthesize) of the given
+number of packets (default 100000) to path, the second replays a
+capture (as fast as possible, unless paced is given), and the third
+replays a synthetic capture without writing it to disk
+
+"""
+import gc
+import sys
+import time
+import random
+from collections import defaultdict
+
+from twisted.python import log
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot import contact
+from dhtbot.coding import krpc_coder
+from dhtbot.krpc_types import Query, Response
+from dhtbot.protocols.krpc_responder import KRPC_Responder
+from dhtbot.extensions.capture import read_capture, write_capture
+from dhtbot.test.testing_data import random_one_hundred_IDs
+
+timer = time.time
+
+# The traffic mix of a synthetic capture (fractions of all packets)
+traffic_mix = [
+    ("ping", 0.15),
+    ("find_node", 0.3),
+    ("get_peers", 0.3),
+    ("announce_peer", 0.1),
+    ("sample_infohashes", 0.05),
+    # Replies to queries that have already timed out
+    ("reply", 0.08),
+    ("malformed", 0.02),
+]
+
+class CountingTransport(object):
+    """A transport that only counts what is written to it"""
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+
+    def write(self, packet, address):
+        self.packets += 1
+        self.bytes += len(packet)
+
+class StageTimer(object):
+    """
+    Accumulate the time spent in (and the calls made to) each stage
+
+    seconds: stage name -> seconds spent in that stage
+    calls: stage name -> the number of calls made to that stage
+
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def wrap(self, stage, func):
+        """
+        @returns a function that calls func, timing it as the given stage
+        """
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[stage] += timer() - start
+                self.calls[stage] += 1
+        return timed
+
+class ReplayResult(object):
+    """
+    The outcome of replaying a capture
+
+    packets: the number of datagrams replayed
+    seconds: the time spent processing them (excluding any pacing)
+    stage_seconds: stage name -> seconds (@see StageTimer)
+    responses: the number of packets the protocol sent back
+    allocations: the net number of gc tracked objects created
+
+    """
+    def __init__(self, packets, seconds, stage_seconds, responses,
+                 allocations):
+        self.packets = packets
+        self.seconds = seconds
+        self.stage_seconds = stage_seconds
+        self.responses = responses
+        self.allocations = allocations
+
+    def packets_per_second(self):
+        return self.packets / max(self.seconds, 1e-9)
+
+def _address(rng):
+    return ("10.%d.%d.%d" % (rng.randint(0, 255), rng.randint(0, 255),
+                             rng.randint(1, 254)),
+            rng.randint(1024, 65535))
+
+def _synthesize_packet(kind, rng):
+    node_id = rng.choice(random_one_hundred_IDs)
+    # Targets cluster around known IDs, the way lookups converge
+    target_id = rng.choice(random_one_hundred_IDs) ^ rng.getrandbits(64)
+    transaction_id = rng.getrandbits(16)
+    if kind == "malformed":
+        return "d1:ad2:id20:%s" % ("x" * rng.randint(0, 19))
+    if kind == "reply":
+        krpc = Response()
+        krpc.rpctype = "find_node"
+    else:
+        krpc = Query()
+        krpc.rpctype = kind
+        if kind != "ping":
+            krpc.target_id = target_id
+        if kind == "announce_peer":
+            # Tokens are not known in advance, so announces are rejected
+            krpc.token = "%c%c%c%c" % tuple(rng.randint(0, 255)
+                                            for i in xrange(4))
+            krpc.port = rng.randint(1024, 65535)
+    krpc._from = node_id
+    krpc._transaction_id = transaction_id
+    return krpc_coder.encode(krpc)
+
+def synthesize(num_packets, seed=0, rate=1000.0):
+    """
+    Create a synthetic capture
+
+    Packets follow the traffic_mix, are sent by the nodes of
+    dhtbot.test.testing_data (from random addresses) and arrive
+    at `rate` packets per second on average
+
+    @returns a list of (timestamp, data, address) records
+    @see dhtbot.extensions.capture.read_capture
+
+    """
+    rng = random.Random(seed)
+    kinds = []
+    thresholds = []
+    total = 0.0
+    for (kind, fraction) in traffic_mix:
+        total += fraction
+        kinds.append(kind)
+        thresholds.append(total)
+    records = []
+    timestamp = 0.0
+    for i in xrange(num_packets):
+        draw = rng.random() * total
+        kind = kinds[-1]
+        for (candidate, threshold) in zip(kinds, thresholds):
+            if draw < threshold:
+                kind = candidate
+                break
+        timestamp += rng.expovariate(rate)
+        records.append((timestamp, _synthesize_packet(kind, rng),
+                        _address(rng)))
+    return records
+
+def make_protocol():
+    """
+    @returns a KRPC_Responder (with a CountingTransport) whose routing
+        table holds the nodes of dhtbot.test.testing_data
+    """
+    rng = random.Random(0)
+    protocol = KRPC_Responder(node_id=2**159 + 1)
+    protocol.transport = CountingTransport()
+    for node_id in random_one_hundred_IDs:
+        protocol.routing_table.offer_node(
+                contact.Node(node_id, _address(rng)))
+    return protocol
+
+def replay(records, protocol, paced=False):
+    """
+    Feed the records of a capture through protocol.datagramReceived
+
+    @param paced: if True, datagrams are fed at the pace at which they
+        were captured, otherwise as fast as possible
+    @returns a ReplayResult
+
+    """
+    stages = StageTimer()
+    transport = protocol.transport
+    patcher = MonkeyPatcher(
+            (krpc_coder, "parse", stages.wrap("parse", krpc_coder.parse)),
+            (krpc_coder, "decode_parsed",
+             stages.wrap("decode", krpc_coder.decode_parsed)),
+            (krpc_coder, "encode", stages.wrap("encode", krpc_coder.encode)),
+            (transport, "write", stages.wrap("send", transport.write)))
+    responses_before = transport.packets
+    # Malformed packets and rejected announces are logged,
+    # which is not what is being measured
+    observers = log.theLogPublisher.observers[:]
+    for observer in observers:
+        log.removeObserver(observer)
+    gc_was_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    patcher.patch()
+    try:
+        objects_before = gc.get_count()[0]
+        elapsed = 0.0
+        if len(records) > 0:
+            first_timestamp = records[0][0]
+        replay_start = timer()
+        for (timestamp, data, address) in records:
+            if paced:
+                delay = ((timestamp - first_timestamp) -
+                         (timer() - replay_start))
+                if delay > 0:
+                    time.sleep(delay)
+            start = timer()
+            protocol.datagramReceived(data, address)
+            elapsed += timer() - start
+        allocations = gc.get_count()[0] - objects_before
+    finally:
+        patcher.restore()
+        if gc_was_enabled:
+            gc.enable()
+        for observer in observers:
+            log.addObserver(observer)
+    stage_seconds = dict(stages.seconds)
+    stage_seconds["dispatch"] = max(0.0,
+            elapsed - sum(stages.seconds.values()))
+    return ReplayResult(len(records), elapsed, stage_seconds,
+                        transport.packets - responses_before, allocations)
+
+def report(result):
+    print ("packets=%d seconds=%.3f packets_per_second=%d responses=%d "
+           "allocations=%d" % (result.packets, result.seconds,
+           result.packets_per_second(), result.responses,
+           result.allocations))
+    for stage in ["parse", "decode", "dispatch", "encode", "send"]:
+        seconds = result.stage_seconds.get(stage, 0.0)
+        print ("stage=%s seconds=%.3f share=%.3f us_per_packet=%.2f" %
+               (stage, seconds, seconds / max(result.seconds, 1e-9),
+                1e6 * seconds / max(result.packets, 1)))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "synthesize":
+        num_packets = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+        seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+        count = write_capture(sys.argv[2], synthesize(num_packets, seed))
+        print "wrote %d packets to %s" % (count, sys.argv[2])
+    elif len(sys.argv) > 2 and sys.argv[1] == "replay":
+        paced = len(sys.argv) > 3 and sys.argv[3] == "paced"
+        report(replay(read_capture(sys.argv[2]), make_protocol(), paced))
+    else:
+        num_packets = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+        seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+        report(replay(synthesize(num_packets, seed), make_protocol()))
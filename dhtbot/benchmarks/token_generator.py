@@ -0,0 +1,123 @@
+"""
+Throughput benchmark for the get_peers/announce_peer token generator
+
+Simulates announce heavy traffic: every querier first receives a token
+(get_peers) and then announces with it (announce_peer) a few times,
+half of the announces arriving after the secret has been rotated (so
+that verification has to try an older secret as well). The current
+_TokenGenerator is compared against the previous implementation
+(SHA-1 over node ID, infohash, address and secret, with numeric tokens)
+
+Run with:
+    python -m dhtbot.benchmarks.token_generator [queriers] [announces]
+
+where queriers is the number of distinct querying addresses (default
+10000) and announces the number of announces per querier (default 10)
+
+"""
+import sys
+import time
+import random
+import hashlib
+from collections import deque
+
+from dhtbot import constants
+from dhtbot.coding import basic_coder
+from dhtbot.krpc_types import Query
+from dhtbot.protocols import krpc_responder
+from dhtbot.protocols.krpc_responder import _TokenGenerator
+from dhtbot.test.utils import Clock
+
+class _SHA1TokenGenerator(object):
+    """The token generator as it was before the HMAC based one"""
+    def __init__(self):
+        num_secrets = constants.token_timeout / constants._secret_timeout
+        self.secrets = deque(maxlen=num_secrets)
+        self.last_secret_time = 0
+
+    def generate(self, query, address):
+        self._prune_secrets()
+        time_since_last_secret = time.time() - self.last_secret_time
+        if (time_since_last_secret >= constants._secret_timeout or
+                len(self.secrets) == 0):
+            self.secrets.appendleft(str(random.getrandbits(160)))
+        self.last_secret_time = time.time()
+        return self._get_hash(query, address, self.secrets[0])
+
+    def verify(self, query, address, token):
+        self._prune_secrets()
+        for secret in self.secrets:
+            if self._get_hash(query, address, secret) == token:
+                return True
+        return False
+
+    def _get_hash(self, query, address, secret):
+        hash = hashlib.sha1()
+        hash.update(basic_coder.encode_network_id(query._from))
+        hash.update(basic_coder.encode_network_id(query.target_id))
+        hash.update(basic_coder.encode_address(address))
+        hash.update(secret)
+        return basic_coder.btol(hash.digest())
+
+    def _prune_secrets(self):
+        time_since_last_secret = time.time() - self.last_secret_time
+        num_stale_secrets = long(round(time_since_last_secret /
+                                       constants.token_timeout))
+        while (num_stale_secrets > 0) and (len(self.secrets) > 0):
+            num_stale_secrets -= 1
+            self.secrets.pop()
+
+def make_traffic(num_queriers):
+    traffic = []
+    for i in xrange(num_queriers):
+        query = Query()
+        query._from = random.getrandbits(160)
+        query.target_id = random.getrandbits(160)
+        ip = ".".join(str(random.randint(1, 254)) for j in xrange(4))
+        traffic.append((query, (ip, random.randint(1, 65535))))
+    return traffic
+
+def run_generator(generator, traffic, num_announces, clock):
+    """
+    Returns the number of seconds spent generating and verifying tokens
+    (and the number of tokens that verified, as a sanity check)
+
+    """
+    clock.set(0)
+    valid = 0
+    start = time.clock()
+    tokens = [generator.generate(query, address)
+              for (query, address) in traffic]
+    for i in xrange(num_announces):
+        # Rotate the secret half way through the announces
+        if i == num_announces / 2:
+            clock.set(constants._secret_timeout)
+        for ((query, address), token) in zip(traffic, tokens):
+            valid += generator.verify(query, address, token)
+    return (time.clock() - start, valid)
+
+def run(num_queriers, num_announces):
+    clock = Clock()
+    traffic = make_traffic(num_queriers)
+    original_time = krpc_responder.time.time
+    # Both generators read the time through the (shared) time module
+    krpc_responder.time.time = clock
+    try:
+        results = {}
+        for (name, generator) in [("sha1", _SHA1TokenGenerator()),
+                                  ("hmac", _TokenGenerator())]:
+            (seconds, valid) = run_generator(generator, traffic,
+                                             num_announces, clock)
+            operations = num_queriers * (num_announces + 1)
+            results[name] = seconds
+            print ("generator=%s operations=%d valid=%d seconds=%.3f "
+                   "ops_per_second=%d" % (name, operations, valid, seconds,
+                   operations / max(seconds, 1e-9)))
+        print "speedup=%.2f" % (results["sha1"] / max(results["hmac"], 1e-9))
+    finally:
+        krpc_responder.time.time = original_time
+
+if __name__ == "__main__":
+    num_queriers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_announces = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    run(num_queriers, num_announces)
@@ -10,7 +10,7 @@ originating from and destined to the DHT network
 from dhtbot import contact
 from dhtbot.coding import basic_coder
 from dhtbot.coding.bencode import bdecode, bencode, BTFailure
-from dhtbot.krpc_types import Query, Response, Error
+from dhtbot.krpc_types import Query, Response, Error, RawField
 
 class InvalidKRPCError(Exception):
     """
@@ -37,12 +37,54 @@ def decode(packet):
 
    """
     try:
-        dpacket = _decode(packet)
-    except (ValueError, KeyError, AttributeError, _ProtocolFormatError,
-            basic_coder.InvalidDataError, BTFailure):
+        return decode_parsed(parse(packet))
+    except InvalidKRPCError:
         raise InvalidKRPCError(packet)
-    else:
-        return dpacket
+
+def parse(packet):
+    """
+    Bdecode the raw network packet, without decoding it into a KRPC yet
+
+    Bdecoding is most of the cost of a decode, and already yields the
+    message type and transaction ID, which are enough to drop replies
+    that match no outstanding query. The rest of the decode
+    (@see decode_parsed) is then only paid for the packets that are
+    kept, while every other packet is still bdecoded only once
+
+    @return a (msgtype, transaction_id, rpc_dict) tuple, where msgtype
+        is one of 'q', 'r', or 'e' and rpc_dict is the bdecoded packet
+    @raises InvalidKRPCError if the given packet is invalid
+
+    """
+    try:
+        rpc_dict = bdecode(packet)
+        msgtype = rpc_dict['y']
+        transaction_id = rpc_dict['t']
+        if (msgtype not in _message_decoders or
+                not isinstance(transaction_id, str)):
+            raise _ProtocolFormatError()
+        return (msgtype, basic_coder.btol(transaction_id), rpc_dict)
+    except (ValueError, KeyError, TypeError, RuntimeError,
+            _ProtocolFormatError, BTFailure):
+        # (a RuntimeError is raised by deeply nested packets)
+        raise InvalidKRPCError(packet)
+
+def decode_parsed(parsed):
+    """
+    Decode the result of parse into a valid KRPC
+
+    @return an instance of either Query, Response, or Error
+    @raises InvalidKRPCError if the parsed packet is not a valid KRPC
+
+    """
+    (msgtype, transaction_id, rpc_dict) = parsed
+    try:
+        rpc = _message_decoders[msgtype](rpc_dict)
+    except (ValueError, KeyError, AttributeError, TypeError,
+            _ProtocolFormatError, basic_coder.InvalidDataError):
+        raise InvalidKRPCError(parsed)
+    rpc._transaction_id = transaction_id
+    return rpc
 
 def encode(message):
     """
@@ -77,23 +119,6 @@ class _ProtocolFormatError(Exception):
     """
     pass
 
-def _decode(packet):
-    """@see decode"""
-    # Decode the bencoded dict into a python dict
-    rpc_dict = bdecode(packet)
-
-    # Decode the message into one of Query/Response/Error (as found
-    # in message_types)
-    msgtype = rpc_dict["y"]
-    message_decoders = {'q': _query_decoder, 
-                        'r': _response_decoder,
-                        'e': _error_decoder}
-    rpc = message_decoders[msgtype](rpc_dict)
-
-    # Attach the transaction id
-    rpc._transaction_id = basic_coder.btol(rpc_dict['t'])
-    return rpc 
-
 def _query_decoder(rpc_dict):
     """
     Decode the given KRPC dictionary into a valid Query
@@ -117,7 +142,9 @@ def _query_decoder(rpc_dict):
         # Try encoding the port (to ensure it is within range)
         basic_coder.encode_port(rpc_dict['a']['port'])
         q.port = rpc_dict['a']['port']
-        q.token = basic_coder.btol(rpc_dict['a']['token'])
+        q.token = _decode_token(rpc_dict['a']['token'])
+    elif rpctype == 'sample_infohashes':
+        q.target_id = basic_coder.decode_network_id(rpc_dict['a']['target'])
     else:
         raise _ProtocolFormatError()
     return q
@@ -135,16 +162,58 @@ def _response_decoder(rpc_dict):
     r._from = basic_coder.decode_network_id(rpc_dict['r']['id'])
     # find_node always returns a list of nodes
     # get_peers sometimes returns a list of nodes
+    # (nodes and peers are only decoded when they are used, but
+    # are validated here so that decoding them later cannot fail)
     if 'nodes' in rpc_dict['r']:
-        r.nodes = _decode_nodes(rpc_dict['r']['nodes'])
+        r.nodes = RawField(_decode_nodes,
+                           _validate_chunks(rpc_dict['r']['nodes'], 26))
     # get_peers always returns a list of peers
     if 'values' in rpc_dict['r']:
-        r.peers = _decode_addresses(rpc_dict['r']['values'])
+        r.peers = RawField(_decode_addresses,
+                           _validate_chunks(rpc_dict['r']['values'], 6))
     # get_peers returns a token
     if 'token' in rpc_dict['r']:
-        r.token = basic_coder.btol(rpc_dict['r']['token'])
+        r.token = _decode_token(rpc_dict['r']['token'])
+    # sample_infohashes returns samples, num, and interval
+    if 'samples' in rpc_dict['r']:
+        r.samples = _decode_network_ids(rpc_dict['r']['samples'])
+    if 'num' in rpc_dict['r']:
+        r.num = _decode_int(rpc_dict['r']['num'])
+    if 'interval' in rpc_dict['r']:
+        r.interval = _decode_int(rpc_dict['r']['interval'])
     return r
 
+def _decode_token(value):
+    """
+    Ensure the given bdecoded token is a string
+
+    Tokens are opaque to everyone but the node that issued them,
+    so they are kept as the exact byte string that was received
+
+    """
+    if not isinstance(value, str):
+        raise _ProtocolFormatError()
+    return value
+
+def _decode_int(value):
+    """Ensure the given bdecoded value is a non negative integer"""
+    if not isinstance(value, (int, long)) or value < 0:
+        raise _ProtocolFormatError()
+    return value
+
+def _decode_network_ids(id_string):
+    """Decode a concatenated network id string into a list of ids"""
+    if len(id_string) % 20 != 0:
+        raise _ProtocolFormatError()
+    return [basic_coder.decode_network_id(encoded_id)
+            for encoded_id in _chunkify(id_string, 20)]
+
+def _validate_chunks(string, n):
+    """Ensure the given bdecoded value is a string of n sized chunks"""
+    if not isinstance(string, str) or len(string) % n != 0:
+        raise _ProtocolFormatError()
+    return string
+
 def _decode_addresses(address_string):
     """Decode a concatenated address string into a list of addres tuples"""
     addresses = []
@@ -226,12 +295,15 @@ def _query_encoder(query):
         query_dict['a']['info_hash'] = (
                 basic_coder.encode_network_id(query.target_id))
     elif query.rpctype == 'announce_peer':
-        query_dict['a']['token'] = basic_coder.ltob(query.token)
+        query_dict['a']['token'] = _encode_token(query.token)
         # Try encoding the port, to see if it is within range
         basic_coder.encode_port(query.port)
         query_dict['a']['port'] = query.port
         query_dict['a']['info_hash'] = (
                 basic_coder.encode_network_id(query.target_id))
+    elif query.rpctype == 'sample_infohashes':
+        query_dict['a']['target'] = (
+                basic_coder.encode_network_id(query.target_id))
     else:
         raise _ProtocolFormatError()
     return query_dict
@@ -240,16 +312,35 @@ def _response_encoder(response):
     """@see encode"""
     resp_dict = {"r": {"id": basic_coder.encode_network_id(response._from)}}
     if response.nodes is not None:
-        encoded_nodes = [contact.encode_node(node) for node in response.nodes]
-        resp_dict['r']['nodes'] = "".join(encoded_nodes)
+        # Node lists that were already encoded carry their encoding
+        # @see dhtbot.kademlia.node_cache.EncodedNodes
+        encoded_nodes = getattr(response.nodes, "encoded", None)
+        if encoded_nodes is None:
+            encoded_nodes = "".join([contact.encode_node(node)
+                                        for node in response.nodes])
+        resp_dict['r']['nodes'] = encoded_nodes
     if response.peers is not None:
         encoded_peers = [basic_coder.encode_address(peer)
                             for peer in response.peers]
         resp_dict['r']['values'] = "".join(encoded_peers)
     if response.token is not None:
-        resp_dict['r']['token'] = basic_coder.ltob(response.token)
+        resp_dict['r']['token'] = _encode_token(response.token)
+    if response.samples is not None:
+        encoded_samples = [basic_coder.encode_network_id(sample)
+                            for sample in response.samples]
+        resp_dict['r']['samples'] = "".join(encoded_samples)
+    if response.num is not None:
+        resp_dict['r']['num'] = _decode_int(response.num)
+    if response.interval is not None:
+        resp_dict['r']['interval'] = _decode_int(response.interval)
     return resp_dict
 
+def _encode_token(token):
+    """Encode a token (a byte string, or a number for older callers)"""
+    if isinstance(token, str):
+        return token
+    return basic_coder.ltob(token)
+
 def _error_encoder(error):
     """@see encode"""
     # Verify the error code is in the valid range
@@ -259,3 +350,8 @@ def _error_encoder(error):
     error.message = str(error.message)
     err_dict = {"e": [error.code, error.message]}
     return err_dict
+
+# msgtype -> the function decoding a KRPC dictionary of that type
+_message_decoders = {'q': _query_decoder,
+                     'r': _response_decoder,
+                     'e': _error_decoder}
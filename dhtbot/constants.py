@@ -5,6 +5,10 @@
 # k as used in Kademlia
 k = 8
 
+# alpha as used in Kademlia: the number of queries a lookup
+# keeps in flight at once
+alpha = 3
+
 # The size of the identification number used for resources and
 # nodes in the Kademlia network (bits)
 id_size = 160
@@ -16,26 +20,123 @@ rpctimeout = 30
 # should timeout (seconds)
 query_timeout = 60           # 1 minute
 
+# Time for which the result of a lookup is remembered and
+# reused by later lookups of the same target (seconds)
+lookup_cache_timeout = 60   # 1 minute
+
+# The maximum number of targets whose lookup results are remembered
+lookup_cache_size = 1024
+
+# Time between two announces of the same infohash by the
+# announce scheduler (seconds)
+announce_interval = 1800    # 30 minutes
+
+# Time between two ticks of the announce scheduler (seconds)
+announce_tick = 1
+
+# The maximum number of infohashes the announce scheduler
+# announces in a single tick
+announce_max_per_tick = 4
+
+# The crawler sweeps the keyspace with one lookup in each
+# of 2**crawl_sweep_bits slices
+crawl_sweep_bits = 8
+
+# The maximum number of lookups the crawler runs at once
+crawl_max_lookups = 8
+
+# The maximum number of lookups the crawler starts per second
+crawl_lookup_rate = 4
+
+# The number of nodes the crawler's seen-set is sized for, and
+# the rate at which it falsely reports unseen nodes as seen
+crawl_seen_capacity = 2**20
+crawl_seen_error_rate = 0.001
+
 # Quarantine timeout: time after which a node is removed from the quarantine
 # (seconds)
 quarantine_timeout = 180    # 3 minutes
 
+# The maximum number of nodes held in the quarantine at once
+# (@see dhtbot.extensions.quarantine)
+quarantine_max_prisoners = 1024
+
+# The number of prisoners pinged at once, and the time between
+# such batches (seconds)
+quarantine_batch_size = 8
+quarantine_interval = 1
+
+# The timeout of a quarantine ping (seconds) and the number of pings
+# a prisoner may fail before it is removed from the quarantine
+quarantine_ping_timeout = 5
+quarantine_max_attempts = 2
+
 # Peer timeout
 # Time after which a peer that has been announced for a torrent will be
 # removed from the torrent dictionary (unless reset by being reannounced)
 # (seconds)
 peer_timeout = 43200        # 12 hours
 
+# The time a sample_infohashes sample is reused before a new random
+# sample is drawn; also returned to queriers as the interval
+# they should wait before asking again (seconds, @see BEP 51)
+sample_infohashes_interval = 300    # 5 minutes
+
+# The maximum number of infohashes returned in a sample
+# (20 fit comfortably into a single UDP packet)
+sample_infohashes_max = 20
+
 # Time after which a node is considered stale (seconds)
 node_timeout = 900         # 15 minutes
 
 # Time between each call to the NICE routing table update algorithm (seconds)
 NICEinterval = 6
 
+# The maximum number of queries the NICE algorithm may have outstanding
+# (and so send) at any one time (@see dhtbot.extensions.nice)
+NICEbudget = 4
+
 # This interval determines how often the DHT's state data will be
 # saved into a file on disk (seconds)
 DUMPinterval = 180          # 3 minutes
 
+# The maximum number of queries that may be outstanding at
+# once (queries beyond this limit wait until a transaction completes)
+max_outstanding_queries = 128
+
+# The maximum number of queries that may be outstanding
+# to a single address at once
+max_outstanding_queries_per_host = 4
+
+# The number of nodes restored from a routing table snapshot that
+# are pinged at once, and the time between such batches (seconds)
+revalidate_batch_size = 16
+revalidate_interval = 1
+
+# The number of leading target ID bits that key the closest node cache
+# (targets sharing this prefix are answered with the same nodes)
+closest_nodes_cache_prefix = 24
+# The maximum number of target prefixes held in the closest node cache
+closest_nodes_cache_size = 4096
+
+# Load shedding of inbound queries (@see dhtbot.extensions.overload)
+# The reactor lag (seconds) and the number of waiting queries at which
+# we are considered to be fully overloaded
+overload_max_lag = 0.5
+overload_max_queue = 1024
+# How often the reactor lag is measured (seconds)
+overload_heartbeat_interval = 0.1
+# The number of queued queries processed per reactor iteration
+overload_batch_size = 64
+
+# Whether protocols keep counters and round trip time histograms of
+# their KRPC traffic (@see dhtbot.metrics). When False, no metrics
+# are kept at all
+metrics_enabled = True
+# Upper bounds (seconds) of the round trip time histogram buckets
+# (a final bucket holds every round trip time above the last bound)
+metrics_rtt_buckets = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 # Size of the token (bits)
 tokensize = 32
 
@@ -62,16 +163,49 @@ bootstrap_nodes = [("127.0.0.1", 2323),
                    ("router.utorrent.com", 6881)]
 
 
+# Time for which a resolved bootstrap hostname is cached on disk
+# (expired entries are still used if resolving the hostname fails)
+# (seconds)
+bootstrap_cache_timeout = 86400     # 1 day
+
+
 # Global outgoing bandwidth limit (bytes / second)
 global_bandwidth_rate = 20 * 1024   # 20 kilobytes
 
 # Outgoing bandwidth limit per host (bytes / second)
 host_bandwidth_rate = 5 * 1024      # 5 kilobytes
 
+# Bandwidth limits (bytes / second) shared by all the addresses of a
+# single IP, of a /24 subnet and of a /16 subnet (inbound and outbound
+# traffic are limited separately)
+ip_bandwidth_rate = 8 * 1024        # 8 kilobytes
+subnet24_bandwidth_rate = 12 * 1024 # 12 kilobytes
+subnet16_bandwidth_rate = 16 * 1024 # 16 kilobytes
+
+# An IP that keeps sending more than heavy_hitter_rate bytes / second
+# (counting dropped packets too) is treated as a flooder, and all of
+# its packets are dropped for heavy_hitter_penalty seconds. Traffic is
+# tallied in a sketch whose counts halve every heavy_hitter_window
+# seconds, so a steady rate r settles at an estimate of at most
+# 2 * r * heavy_hitter_window bytes, which is the threshold used
+# (an IP that stays within ip_bandwidth_rate is never penalized)
+heavy_hitter_window = 10
+heavy_hitter_rate = 16 * 1024       # 16 kilobytes
+heavy_hitter_penalty = 60
+
+# The maximum number of hosts whose bandwidth use is tracked at once
+# (idle hosts are forgotten, and the least recently seen hosts
+# are evicted once this limit is reached)
+rate_limiter_max_hosts = 65536
+
 
 # The default port on which DHTBot will run
 dht_port = 1800
 
+# The default (local) port of the HTTP metrics endpoint
+# (@see dhtbot.metrics_server.listen_metrics)
+metrics_port = 1801
+
 ###
 ### Internal use
 ###
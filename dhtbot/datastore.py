@@ -6,6 +6,7 @@ used for maintaing infohash->peer information
 
 """
 import time
+import random
 from collections import defaultdict
 
 from zope.interface import (Interface, implements)
@@ -40,6 +41,17 @@ class IDataStore(Interface):
 
         """
 
+    def sample(self, max_size):
+        """
+        Returns a random sample of the stored infohashes
+
+        @param max_size: the maximum number of infohashes in the sample
+        @return a tuple (sample, num) where sample is a list of at most
+            max_size infohashes and num is the number of stored infohashes
+        @see BEP 51
+
+        """
+
 class MemoryDataStore(object):
 
     implements(IDataStore)
@@ -54,13 +66,26 @@ class MemoryDataStore(object):
     """
     # torrents[] maps an infohash to a dictionary of addresses
     # torrents[infohash][] maps an address to its last announce time
+    #
+    # _infohashes holds every stored infohash (in no particular order)
+    # and _infohash_index maps an infohash onto its position in that
+    # list, so that infohashes can be added, removed (by swapping in the
+    # last element) and sampled in constant time
     def __init__(self, reactor):
         self.reactor = reactor
         self.torrents = defaultdict(dict)
+        self._infohashes = []
+        self._infohash_index = dict()
+        self._sample = None
+        self._sample_size = None
+        self._sample_time = None
 
     def put(self, infohash, address):
         """@see Datastore.put"""
         last_announced = time.time()
+        if infohash not in self._infohash_index:
+            self._infohash_index[infohash] = len(self._infohashes)
+            self._infohashes.append(infohash)
         self.torrents[infohash][address] = last_announced
         self._register_for_cleanup(infohash, address)
 
@@ -71,6 +96,33 @@ class MemoryDataStore(object):
         else:
             return list()
 
+    def sample(self, max_size):
+        """
+        @see Datastore.sample
+
+        The same sample is returned (for the same max_size) for
+        constants.sample_infohashes_interval seconds, so that answering
+        many sample_infohashes queries costs no more than a lookup
+
+        """
+        now = time.time()
+        interval = constants.sample_infohashes_interval
+        if (self._sample is None or self._sample_size != max_size or
+                now - self._sample_time >= interval):
+            size = min(max_size, len(self._infohashes))
+            self._sample = random.sample(self._infohashes, size)
+            self._sample_size = max_size
+            self._sample_time = now
+        return (list(self._sample), len(self._infohashes))
+
+    def _remove_infohash(self, infohash):
+        """Remove an infohash from the sampling list in constant time"""
+        index = self._infohash_index.pop(infohash)
+        last_infohash = self._infohashes.pop()
+        if last_infohash != infohash:
+            self._infohashes[index] = last_infohash
+            self._infohash_index[last_infohash] = index
+
     def _register_for_cleanup(self, infohash, address):
         """
         Set up a delayed call that will clean up the peer at the right time
@@ -100,3 +152,4 @@ class MemoryDataStore(object):
                 del self.torrents[infohash][address]
                 if len(self.torrents[infohash]) == 0:
                     del self.torrents[infohash]
+                    self._remove_infohash(infohash)
@@ -0,0 +1,151 @@
+"""
+Capture files of inbound datagrams (along with a patcher that records
+every datagram an IKRPC_Sender implementation receives)
+
+Captures are replayed through a protocol instance to benchmark the
+receive path on real (or synthetic) traffic
+
+@see dhtbot.benchmarks.replay
+
+"""
+import socket
+import struct
+
+from twisted.python import log
+from twisted.python.components import proxyForInterface
+
+from dhtbot.protocols.krpc_sender import IKRPC_Sender
+
+# File format (all integers are big endian)
+#
+#   header: magic, version
+#   record: time of arrival (double), IPv4 address (4 bytes), port,
+#           length of the datagram, followed by the datagram itself
+_MAGIC = "DHTC"
+_VERSION = 1
+_HEADER = struct.Struct("!4sB")
+_RECORD = struct.Struct("!d4sHH")
+
+class CaptureError(Exception):
+    """
+    Raised when a capture file can not be read
+
+    reason: a string describing why the capture was rejected
+
+    """
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "CaptureError: %s" % self.reason
+
+class CaptureWriter(object):
+    """
+    Append datagrams to a capture file
+
+    count: the number of datagrams written so far
+
+    """
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+        self.count = 0
+
+    def write(self, data, address, timestamp):
+        """
+        Record that data arrived from address at the given timestamp
+        """
+        (ip, port) = address
+        self._file.write(_RECORD.pack(timestamp, socket.inet_aton(ip),
+                                      port, len(data)))
+        self._file.write(data)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+def write_capture(path, records):
+    """
+    Write the given (timestamp, data, address) records to path
+
+    @returns the number of records written
+
+    """
+    writer = CaptureWriter(path)
+    try:
+        for (timestamp, data, address) in records:
+            writer.write(data, address, timestamp)
+    finally:
+        writer.close()
+    return writer.count
+
+def read_capture(path):
+    """
+    Read every record of the capture stored at path
+
+    @raises CaptureError if the file is missing, truncated,
+        or not a capture
+    @returns a list of (timestamp, data, address) tuples,
+        in the order in which they were recorded
+
+    """
+    try:
+        capture_file = open(path, "rb")
+        try:
+            contents = capture_file.read()
+        finally:
+            capture_file.close()
+    except (IOError, OSError), e:
+        raise CaptureError("can not read %s (%s)" % (path, e))
+    if len(contents) < _HEADER.size:
+        raise CaptureError("truncated header")
+    (magic, version) = _HEADER.unpack_from(contents)
+    if magic != _MAGIC:
+        raise CaptureError("not a capture file")
+    if version != _VERSION:
+        raise CaptureError("unsupported version %d" % version)
+    records = []
+    offset = _HEADER.size
+    while offset < len(contents):
+        if offset + _RECORD.size > len(contents):
+            raise CaptureError("truncated record")
+        (timestamp, ip, port, length) = _RECORD.unpack_from(contents, offset)
+        offset += _RECORD.size
+        data = contents[offset:offset + length]
+        if len(data) != length:
+            raise CaptureError("truncated datagram")
+        offset += length
+        records.append((timestamp, data, (socket.inet_ntoa(ip), port)))
+    return records
+
+class Capture_Patcher(proxyForInterface(IKRPC_Sender)):
+    """
+    Record every datagram received by an IKRPC_Sender to a capture file
+
+    Datagrams are recorded as they arrive (before any decoding, so
+    that malformed packets are captured as well) and then passed on
+    to the original. The capture file is closed when the protocol stops
+
+    """
+    def __init__(self, original, path, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.original = original
+        self._reactor = reactor
+        self.writer = CaptureWriter(path)
+
+    def startProtocol(self):
+        self.original.startProtocol()
+
+    def stopProtocol(self):
+        self.writer.close()
+        self.original.stopProtocol()
+
+    def datagramReceived(self, data, address):
+        try:
+            self.writer.write(data, address, self._reactor.seconds())
+        except (ValueError, socket.error, struct.error), e:
+            # IPv6 addresses and oversized datagrams can not be captured
+            log.msg("Not capturing the datagram from %s: %s" %
+                    (address, e))
+        self.original.datagramReceived(data, address)
@@ -1,9 +1,176 @@
+"""
+Implementation of the NICE routing table maintenance algorithm
+(along with a patcher that patches it into a KRPC_Responder)
+as described in section 5 of the subsecond paper
+
+@see references/subsecond.pdf
+
+"""
+import random
+
+from twisted.internet import task
 from twisted.python.components import proxyForInterface
 
+from dhtbot import constants
+from dhtbot.coding.krpc_coder import InvalidKRPCError
+from dhtbot.extensions.quarantine import Quarantine
+from dhtbot.protocols.errors import TimeoutError, KRPCError
 from dhtbot.protocols.krpc_responder import IKRPC_Responder
 
 class NICE(object):
-    pass
+    """
+    Keep the routing table fresh without waiting for queries to fail
+
+    Every `interval` seconds (a tick), NICE
+        1) pings the stalest node in the routing table
+           (@see dhtbot.kademlia.kbucket.KBucket.get_stalest_node),
+           so that dead nodes are found and evicted by the protocol
+        2) refreshes under-populated kbuckets by asking the closest
+           known node for nodes around a random ID in the kbucket's range
+           (the kbuckets are visited round robin over the ticks)
+
+    The nodes returned by a refresh have not been contacted yet, so
+    they are jailed in a quarantine (which pings them in its own rate
+    limited batches) rather than offered to the routing table directly
+
+    Each ping or refresh counts as one unit of work. At most `budget`
+    units are spent per tick, and no new work is started while `budget`
+    NICE queries are still outstanding, so maintenance never competes
+    with regular query processing for more than a small slice
+    of the query window
+
+    @param ping: a function ping(address) returning a deferred
+    @param find_node: a function find_node(address, node_id)
+        returning a deferred
+    @param routing_table: a TreeRoutingTable
+    @param quarantine: the Quarantine that refreshed nodes are jailed in
+        (defaults to a new Quarantine of the routing table)
+
+    Statistics:
+        pings: the number of stalest node pings sent
+        refreshes: the number of kbucket refreshes sent
+        failures: the number of NICE queries that failed
+
+    """
+    def __init__(self, ping, find_node, routing_table, reactor,
+                 interval=None, budget=None, quarantine=None):
+        self.ping = ping
+        self.find_node = find_node
+        self.routing_table = routing_table
+        self._reactor = reactor
+        if quarantine is None:
+            quarantine = Quarantine(ping, routing_table, reactor)
+        self.quarantine = quarantine
+        self.interval = (interval if interval is not None
+                         else constants.NICEinterval)
+        self.budget = budget if budget is not None else constants.NICEbudget
+        self.outstanding = 0
+        self.pings = 0
+        self.refreshes = 0
+        self.failures = 0
+        self._next_kbucket = 0
+        self._looping_call = None
+
+    def start(self):
+        """Start running a tick every self.interval seconds"""
+        self._looping_call = task.LoopingCall(self.tick)
+        self._looping_call.clock = self._reactor
+        self._looping_call.start(self.interval, now=False)
+
+    def stop(self):
+        if self._looping_call is not None and self._looping_call.running:
+            self._looping_call.stop()
+        self._looping_call = None
+        self.quarantine.stop()
+
+    def tick(self):
+        """Ping the stalest node, then refresh kbuckets within the budget"""
+        work_left = self.budget - self.outstanding
+        if work_left <= 0:
+            return
+        kbuckets = list(self.routing_table.get_kbuckets())
+        stalest_node = self._get_stalest_node(kbuckets)
+        if stalest_node is not None:
+            work_left -= 1
+            self.pings += 1
+            self._track(self.ping(stalest_node.address))
+        # Visit every kbucket at most once per tick
+        for i in xrange(len(kbuckets)):
+            if work_left <= 0:
+                break
+            kbucket = kbuckets[self._next_kbucket % len(kbuckets)]
+            self._next_kbucket = (self._next_kbucket + 1) % len(kbuckets)
+            if kbucket.full():
+                continue
+            if self._refresh(kbucket):
+                work_left -= 1
+
+    def _get_stalest_node(self, kbuckets):
+        stalest_node = None
+        for kbucket in kbuckets:
+            node = kbucket.get_stalest_node()
+            if node is not None and (stalest_node is None or
+                    node.last_updated < stalest_node.last_updated):
+                stalest_node = node
+        return stalest_node
+
+    def _refresh(self, kbucket):
+        """
+        Look for new nodes that would fall into the given kbucket
+
+        @returns whether a query was sent
+
+        """
+        target_id = random.randrange(kbucket.range_min, kbucket.range_max)
+        closest = self.routing_table.get_closest_nodes(target_id, 1)
+        if len(closest) == 0:
+            return False
+        self.refreshes += 1
+        d = self.find_node(closest[0].address, target_id)
+        d.addCallback(self._offer_nodes_callback)
+        self._track(d)
+        return True
+
+    def _offer_nodes_callback(self, response):
+        if response.nodes is not None:
+            for node in response.nodes:
+                self.quarantine.jail(node)
+        return response
+
+    def _track(self, d):
+        self.outstanding += 1
+        d.addBoth(self._done_bothback)
+        d.addErrback(self._failed_errback)
+
+    def _done_bothback(self, result):
+        self.outstanding -= 1
+        return result
+
+    def _failed_errback(self, failure):
+        failure.trap(TimeoutError, KRPCError, InvalidKRPCError)
+        self.failures += 1
+
 
 class NICE_Patcher(proxyForInterface(IKRPC_Responder)):
-    pass
+    """
+    Patches NICE routing table maintenance into a KRPC_Responder instance
+
+    NICE runs while the protocol is started
+
+    @see NICE
+
+    """
+    def __init__(self, original, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.original = original
+        self.nice = NICE(self.ping, self.find_node, original.routing_table,
+                         reactor)
+
+    def startProtocol(self):
+        self.original.startProtocol()
+        self.nice.start()
+
+    def stopProtocol(self):
+        self.nice.stop()
+        self.original.stopProtocol()
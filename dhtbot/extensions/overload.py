@@ -0,0 +1,194 @@
+"""
+Priority based load shedding of inbound queries (along with a
+patcher that patches it into an IKRPC_Sender implementation)
+
+"""
+import heapq
+from collections import defaultdict
+
+from twisted.python.components import proxyForInterface
+
+from dhtbot import constants
+from dhtbot.coding import krpc_coder
+from dhtbot.protocols.krpc_sender import IKRPC_Sender
+
+# Lower values are more important. Cheap queries that keep the
+# network (and our place in it) healthy come first, queries that
+# make us search and encode many nodes/peers next, and announces
+# (which only add load to our datastore) last
+query_priorities = {
+    "ping": 0,
+    "find_node": 1,
+    "get_peers": 2,
+    "sample_infohashes": 2,
+    "announce_peer": 3,
+}
+# Priority of queries with any other rpctype
+default_priority = 4
+
+# The pressure at which queries of each priority start being shed
+# (a pressure of 1 means we are as far behind as we allow)
+shed_thresholds = [1.0, 0.9, 0.75, 0.5, 0.25]
+
+class OverloadController(object):
+    """
+    Measure how far behind we are and decide which queries to shed
+
+    Two signals are combined into a single pressure value:
+        - the reactor lag: how late a heartbeat that is scheduled every
+          `heartbeat_interval` seconds actually runs (smoothed), as a
+          fraction of `max_lag`
+        - the number of queries waiting to be processed, as a fraction
+          of `max_queue`
+
+    A query is shed when the pressure reaches the shed threshold of
+    its priority (@see query_priorities, shed_thresholds), so that
+    expensive and unimportant queries are dropped well before cheap
+    and important ones are
+
+    Statistics:
+        shed_counts: rpctype -> the number of queries of that type shed
+        lag: the (smoothed) reactor lag in seconds
+
+    """
+    def __init__(self, reactor, max_lag=None, max_queue=None,
+                 heartbeat_interval=None):
+        self._reactor = reactor
+        self.max_lag = (max_lag if max_lag is not None
+                        else constants.overload_max_lag)
+        self.max_queue = (max_queue if max_queue is not None
+                          else constants.overload_max_queue)
+        self.heartbeat_interval = (heartbeat_interval
+                if heartbeat_interval is not None
+                else constants.overload_heartbeat_interval)
+        self.lag = 0.0
+        self.queue_depth = 0
+        self.shed_counts = defaultdict(int)
+        self._expected_time = None
+        self._heartbeat_call = None
+
+    def start(self):
+        """Start measuring the reactor lag"""
+        self._schedule_heartbeat()
+
+    def stop(self):
+        call = self._heartbeat_call
+        if call is not None and call.active():
+            call.cancel()
+        self._heartbeat_call = None
+
+    def pressure(self):
+        """Returns how overloaded we are (0 means not at all)"""
+        return max(self.lag / self.max_lag,
+                   float(self.queue_depth) / self.max_queue)
+
+    def admit(self, rpctype):
+        """
+        Tells whether a query of the given rpctype should be processed
+
+        Queries that are not admitted are counted in shed_counts
+
+        """
+        priority = query_priorities.get(rpctype, default_priority)
+        if (self.queue_depth < self.max_queue and
+                self.pressure() < shed_thresholds[priority]):
+            return True
+        self.shed_counts[rpctype] += 1
+        return False
+
+    def shed_count(self):
+        """Returns the total number of queries that were shed"""
+        return sum(self.shed_counts.itervalues())
+
+    def _schedule_heartbeat(self):
+        self._expected_time = (self._reactor.seconds() +
+                               self.heartbeat_interval)
+        self._heartbeat_call = self._reactor.callLater(
+                self.heartbeat_interval, self._heartbeat)
+
+    def _heartbeat(self):
+        lag = max(0.0, self._reactor.seconds() - self._expected_time)
+        # Smooth the lag so that one slow iteration does not shed load,
+        # while recovering from a burst does not take long either
+        self.lag = (self.lag + lag) / 2
+        self._schedule_heartbeat()
+
+
+class Overload_Patcher(proxyForInterface(IKRPC_Sender)):
+    """
+    Shed and defer inbound queries of an IKRPC_Sender under overload
+
+    Responses and errors (replies to our own queries) are processed
+    as soon as they arrive, so that our own lookups keep their latency.
+    Inbound queries are instead put onto a priority queue that is
+    drained (most important queries first) in batches of
+    constants.overload_batch_size per reactor iteration. Queries are
+    shed on arrival when the OverloadController says we are too far
+    behind for their priority
+
+    Datagrams are only bdecoded here (@see krpc_coder.parse): a shed
+    query is never decoded any further, and the parsed datagrams that
+    are let through are handed to the original's parsedReceived, so
+    that nothing is parsed twice. Malformed datagrams are left to the
+    original (which counts and drops them). As it bypasses the
+    original's datagramReceived, this patcher should be applied
+    directly to the protocol (inside any datagram level patcher)
+
+    @see OverloadController
+
+    """
+    def __init__(self, original, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.original = original
+        self._reactor = reactor
+        self.overload = OverloadController(reactor)
+        # (priority, sequence number, parsed datagram, address) heap
+        self._queries = []
+        self._sequence = 0
+        self._drain_call = None
+
+    def startProtocol(self):
+        self.original.startProtocol()
+        self.overload.start()
+
+    def stopProtocol(self):
+        self.overload.stop()
+        self.original.stopProtocol()
+
+    def datagramReceived(self, data, address):
+        try:
+            parsed = krpc_coder.parse(data)
+        except krpc_coder.InvalidKRPCError:
+            self.original.datagramReceived(data, address)
+            return
+        (msgtype, transaction_id, rpc_dict) = parsed
+        if msgtype != 'q':
+            # Replies are not held back
+            self.original.parsedReceived(parsed, address)
+            return
+        rpctype = rpc_dict.get('q', None)
+        if not isinstance(rpctype, str) or rpctype not in query_priorities:
+            # Do not keep a shed count for every made up rpctype
+            rpctype = "other"
+        if not self.overload.admit(rpctype):
+            return
+        priority = query_priorities.get(rpctype, default_priority)
+        self._sequence += 1
+        heapq.heappush(self._queries,
+                       (priority, self._sequence, parsed, address))
+        self.overload.queue_depth = len(self._queries)
+        if self._drain_call is None:
+            self._drain_call = self._reactor.callLater(0, self._drain)
+
+    def _drain(self):
+        """Process a batch of queries, most important first"""
+        self._drain_call = None
+        for i in xrange(min(constants.overload_batch_size,
+                            len(self._queries))):
+            (priority, sequence, parsed, address) = heapq.heappop(
+                    self._queries)
+            self.original.parsedReceived(parsed, address)
+        self.overload.queue_depth = len(self._queries)
+        if len(self._queries) > 0:
+            self._drain_call = self._reactor.callLater(0, self._drain)
@@ -8,112 +8,220 @@ as suggested by section 5B of the subsecond paper
 @see references/subsecond.pdf
 
 """
-from twisted.python import log
+from collections import OrderedDict
+
+from twisted.internet import task
 from twisted.python.components import proxyForInterface
 
+from dhtbot import constants, contact
+from dhtbot.krpc_types import Query, Response
 from dhtbot.protocols.errors import TimeoutError, KRPCError
 from dhtbot.protocols.krpc_responder import IKRPC_Responder
 
-# TODO
-## <integrate into="callback chain of query response">
-#   # If there are any nodes in response, lets try to
-#   # add them to the routing table
-#   if response.nodes is not None:
-#       for prisoner in response.nodes:
-#           self.quarantine.jail(prisoner)
-## </integrate>
-
 class Quarantine(object):
     """
     Simulate a quarantine
 
     A quarantine is an object that will accept a node into
     a temporary 'holding' center where the node will reside until
-    it has been verified. A node is verified if it responds to a certain
-    number of ping queries within a certain timeout period. Once it has
-    been verified, the node is added to the routing table.
-
-    This particular implementation requires that the node respond to atleast
-    one ping query (out of a total of two ping queries sent one after another)
+    it has been verified. A node is verified if it responds to a ping
+    query or to any other query of ours while it is in the prison
+    (queries from a prisoner prove nothing, as their source address
+    may be spoofed). Once it has been verified, the node is offered
+    to the routing table.
+
+    The prison holds at most max_prisoners nodes: when it is full, the
+    prisoner that was jailed (or seen) the longest time ago is evicted.
+    Prisoners are not pinged as soon as they are jailed; instead, every
+    `interval` seconds at most `batch_size` of them are pinged (with a
+    short timeout). A prisoner that fails max_attempts pings is executed
+
+    @see dhtbot.constants.quarantine_max_prisoners
+    @see dhtbot.constants.quarantine_batch_size
+    @see dhtbot.constants.quarantine_interval
+
+    Statistics:
+        freed: the number of prisoners offered to the routing table
+        executed: the number of prisoners that failed verification
+        evicted: the number of prisoners evicted from a full prison
+        observed: the number of the freed prisoners that were verified
+            by a response to some query other than our ping
 
     """
-    def __init__(self, ping, routing_table):
-        self.prison = set()
+    def __init__(self, ping, routing_table, reactor=None, max_prisoners=None,
+                 batch_size=None, interval=None):
+        if reactor is None:
+            from twisted.internet import reactor
         self.ping = ping
         self.routing_table = routing_table
+        self._reactor = reactor
+        self.max_prisoners = (max_prisoners if max_prisoners is not None
+                              else constants.quarantine_max_prisoners)
+        self.batch_size = (batch_size if batch_size is not None
+                           else constants.quarantine_batch_size)
+        self.interval = (interval if interval is not None
+                         else constants.quarantine_interval)
+        # prisoner -> the number of pings it has failed, ordered
+        # from the least to the most recently jailed (or seen)
+        self.prison = OrderedDict()
+        # Prisoners waiting to be pinged, in the order they will be pinged
+        self._unverified = OrderedDict()
+        self._in_flight = set()
+        self._looping_call = None
+        self.freed = 0
+        self.executed = 0
+        self.evicted = 0
+        self.observed = 0
 
     def jail(self, prisoner):
         """
         Introduce the prisoner node into the testing chamber
-        
+
         A prisoner already found in the jail will not be added
         twice. If the prisoner is not in the routing table or
-        the prison, it will be tested. If the prisoner
-        passes the test, it will be added to the routing table
-        
+        the prison, it will be queued for testing. If the prisoner
+        passes the test, it will be offered to the routing table
+
         """
+        if prisoner in self.prison:
+            self._touch(prisoner)
+            return
         rt_node = self.routing_table.get_node(prisoner.node_id)
-        if rt_node is None and prisoner not in self.prison:
-            self.prison.add(prisoner)
-            d = self.ping(prisoner.address)
-            d.addCallback(lambda ignored_result: prisoner)
-            d.addCallback(self.free)
-            d.addErrback(self._one_more_chance, prisoner)
+        if rt_node is not None:
+            return
+        self.prison[prisoner] = 0
+        self._unverified[prisoner] = None
+        while len(self.prison) > self.max_prisoners:
+            (oldest, failures) = self.prison.popitem(last=False)
+            self._unverified.pop(oldest, None)
+            self._in_flight.discard(oldest)
+            self.evicted += 1
+        self._schedule()
+
+    def observe(self, node):
+        """
+        Record that the given node responded to one of our queries
+
+        If the node is a prisoner, the response proves it is alive,
+        so it is freed without being pinged. A prisoner that is being
+        pinged is left to the ping (the response may well be the
+        response to the ping itself)
+
+        @returns whether the node was a prisoner
+
+        """
+        if node not in self.prison:
+            return False
+        if node not in self._in_flight:
+            self.observed += 1
+            self.free(node)
+        return True
 
     def free(self, prisoner):
         """Transfer the prisoner from the jail to the routing table"""
         if prisoner in self.prison:
-            self.prison.remove(prisoner)
-            self.routing_table.add_node(prisoner)
+            self._release(prisoner)
+            self.freed += 1
+            self.routing_table.offer_node(prisoner)
 
     def execute(self, prisoner):
         """Remove the prisoner without adding it to the routing table"""
         if prisoner in self.prison:
-            self.prison.remove(prisoner)
-
-    def _one_more_chance(self, failure, prisoner):
+            self._release(prisoner)
+            self.executed += 1
+
+    def verify_batch(self):
+        """Ping (at most batch_size) prisoners that are awaiting a ping"""
+        sent = 0
+        while sent < self.batch_size and len(self._unverified) > 0:
+            (prisoner, ignored) = self._unverified.popitem(last=False)
+            sent += 1
+            self._in_flight.add(prisoner)
+            d = self.ping(prisoner.address,
+                          constants.quarantine_ping_timeout)
+            d.addCallbacks(self._ping_callback, self._ping_errback,
+                           callbackArgs=(prisoner,), errbackArgs=(prisoner,))
+        if len(self._unverified) == 0:
+            self.stop()
+
+    def stop(self):
+        """Stop pinging prisoners (until a new prisoner is jailed)"""
+        if self._looping_call is not None and self._looping_call.running:
+            self._looping_call.stop()
+        self._looping_call = None
+
+    def _schedule(self):
+        if self._looping_call is None:
+            self._looping_call = task.LoopingCall(self.verify_batch)
+            self._looping_call.clock = self._reactor
+            self._looping_call.start(self.interval, now=False)
+
+    def _touch(self, prisoner):
+        """Mark the prisoner as the most recently seen one"""
+        self.prison[prisoner] = self.prison.pop(prisoner)
+
+    def _release(self, prisoner):
+        del self.prison[prisoner]
+        self._unverified.pop(prisoner, None)
+        self._in_flight.discard(prisoner)
+
+    def _ping_callback(self, response, prisoner):
+        if prisoner in self._in_flight:
+            self.free(prisoner)
+
+    def _ping_errback(self, failure, prisoner):
         failure.trap(TimeoutError, KRPCError)
-        d = self.ping(prisoner.address)
-        # Ignore the regular deferred result
-        # and pass the prisoner into the free function instead
-        d.addCallback(lambda ignored_result: prisoner)
-        d.addCallback(self.free)
-        d.addErrback(self._remove_prisoner, prisoner)
-
-    def _remove_prisoner(self, failure, prisoner):
-        failure.trap(TimeoutError, KRPCError)
-        self.execute(prisoner)
+        if prisoner not in self._in_flight:
+            return
+        self._in_flight.remove(prisoner)
+        self.prison[prisoner] += 1
+        if self.prison[prisoner] >= constants.quarantine_max_attempts:
+            self.execute(prisoner)
+        else:
+            # Give the prisoner another chance in a later batch
+            self._unverified[prisoner] = None
+            self._schedule()
 
 
 class Quarantine_Patcher(proxyForInterface(IKRPC_Responder)):
     """
     Patches quarantine functionality into a KRPC_Responder instance
 
+    Unknown nodes that query us are jailed. A response from a
+    prisoner (which is matched to one of our own queries, so its
+    source address cannot simply be spoofed) frees it without a ping.
+    Further queries from a prisoner only mark it as recently seen
+
+    The patcher observes the krpcs decoded by the original protocol
+    (@see IKRPC_Sender.registerKRPCObserver), so datagrams are still
+    parsed, decoded and counted by the original alone
+
     @see DHTBot/references/subsecond.pdf : This paper
         covers the quarantine idea
-    
+
     """
-    # TODO
-    # quarantiner has not been tested
-    # NOTICE: there is an idea in DHTBot/ODO that
-    # pertains to an enhancement over the original
-    # quarantiner implementation
-
-    def __init__(self, original):
-        # TODO verify that 'original' satisfies
-        # the IKRPC_Responder interface
+    def __init__(self, original, reactor=None):
         self.original = original
-        self._quarantine = Quarantine(self.ping, self.routing_table)
-
-    def queryReceived(self, query, address):
-        # Find or create node corresponding to this query
-        rt_node = self.routing_table.get_node(query._from)
-        querying_node = (rt_node if rt_node is not None
-                         else contact.Node(query._from, address))
-        # Test the querying_node to see if it responds
-        # to a ping query, if it does, add it to the routing table
-        # @see dhtbot.quarantine.Quarantine.jail
-        self._quarantine.jail(querying_node)
-        # Relay the query onto the original implementation
-        # so that it can dispatch it to the proper "RPCTYPE_Received" method
-        return self.original.queryReceived(query, address)
+        self._quarantine = Quarantine(self.ping, original.routing_table,
+                                      reactor)
+        original.registerKRPCObserver(self._krpc_observed)
+
+    def startProtocol(self):
+        self.original.startProtocol()
+
+    def stopProtocol(self):
+        self._quarantine.stop()
+        self.original.stopProtocol()
+
+    def datagramReceived(self, data, address):
+        self.original.datagramReceived(data, address)
+
+    def _krpc_observed(self, krpc, address):
+        if isinstance(krpc, Query):
+            # Test the querying_node with a ping query,
+            # if it responds, it is added to the routing table
+            # @see dhtbot.quarantine.Quarantine.jail
+            self._quarantine.jail(contact.Node(krpc._from, address))
+        elif isinstance(krpc, Response):
+            # A response from a prisoner proves that it is alive
+            self._quarantine.observe(contact.Node(krpc._from, address))
@@ -4,33 +4,71 @@ a patcher for IKRPC_Sender implementations
 
 """
 import time
+from array import array
+from collections import OrderedDict
 
-from collections import defaultdict
 from twisted.python.components import proxyForInterface
 
 from dhtbot import constants
 from dhtbot.protocols.krpc_sender import IKRPC_Sender
-from dhtbot.coding import krpc_coder
 
 class RateLimiter(object):
     """
     Determine whether a packet should be sent/received
 
     The RateLimiter keeps track of how much data has been received
-    and sent from every host. If that amount is higher than
-    the specified constant value, the RateLimiter will suggest
-    that the packet be dropped
+    and sent from every host, IP, /24 and /16 subnet. If any of those
+    amounts is higher than the specified constant value, the
+    RateLimiter will suggest that the packet be dropped (so rotating
+    source ports or spreading a flood over a subnet does not buy an
+    attacker a fresh budget)
+
+    The state of every level is kept in a HostBuckets table, so the
+    memory used by the RateLimiter is bounded no matter how many
+    distinct addresses are seen. On top of that, a CountMinSketch
+    estimates the traffic of every IP: an IP that keeps sending more
+    than constants.heavy_hitter_rate is dropped outright for
+    constants.heavy_hitter_penalty seconds. The outgoing traffic of a
+    node is not a flood from its destinations, so a RateLimiter for
+    outgoing packets should be created with penalize=False
+
+    @param penalize: whether heavy hitters should be penalized
 
     @see dhtbot.constants.global_bandwidth_rate
     @see dhtbot.constants.host_bandwidth_rate
+    @see dhtbot.constants.ip_bandwidth_rate
+    @see dhtbot.constants.subnet24_bandwidth_rate
+    @see dhtbot.constants.subnet16_bandwidth_rate
+    @see dhtbot.constants.rate_limiter_max_hosts
+    @see dhtbot.constants.heavy_hitter_rate
+
+    Statistics:
+        penalties: the number of times an IP was penalized
+        penalized_drops: the number of packets dropped due to a penalty
 
     """
-    def __init__(self):
+    def __init__(self, penalize=True):
+        self.penalize = penalize
         self.global_bucket = TokenBucket(constants.global_bandwidth_rate,
                                          constants.global_bandwidth_rate)
-        self.host_buckets = defaultdict(
-                lambda: TokenBucket(constants.host_bandwidth_rate,
-                                    constants.host_bandwidth_rate))
+        self.host_buckets = HostBuckets(constants.host_bandwidth_rate,
+                                        constants.host_bandwidth_rate)
+        self.ip_buckets = HostBuckets(constants.ip_bandwidth_rate,
+                                      constants.ip_bandwidth_rate)
+        self.subnet24_buckets = HostBuckets(
+                constants.subnet24_bandwidth_rate,
+                constants.subnet24_bandwidth_rate)
+        self.subnet16_buckets = HostBuckets(
+                constants.subnet16_bandwidth_rate,
+                constants.subnet16_bandwidth_rate)
+        self.heavy_hitters = CountMinSketch(constants.heavy_hitter_window)
+        # The estimate a steady heavy_hitter_rate settles at
+        self.heavy_hitter_threshold = self.heavy_hitters.steady_estimate(
+                constants.heavy_hitter_rate)
+        # ip -> the time its penalty ends (in order of expiry)
+        self.penalized = OrderedDict()
+        self.penalties = 0
+        self.penalized_drops = 0
 
     def consume(self, packet, address):
         """
@@ -41,17 +79,249 @@ class RateLimiter(object):
         was not enough bandwidth in the rate limiter
 
         """
-        consumed = False
+        now = time.time()
         packet_len = len(packet)
-        host_bucket = self.host_buckets[address]
+        ip = address[0]
+        if self.penalize:
+            if self._is_penalized(ip, now):
+                self.penalized_drops += 1
+                return False
+            # Every attempt counts towards becoming a heavy hitter
+            if (self.heavy_hitters.add(ip, packet_len) >
+                    self.heavy_hitter_threshold):
+                self._penalize(ip, now)
+                return False
+
+        if not self.global_bucket.can_consume(packet_len):
+            return False
+        octets = ip.split(".")
+        levels = ((self.subnet16_buckets, ".".join(octets[:2])),
+                  (self.subnet24_buckets, ".".join(octets[:3])),
+                  (self.ip_buckets, ip),
+                  (self.host_buckets, address))
+        for (buckets, key) in levels:
+            if buckets.tokens(key) < packet_len:
+                return False
+        for (buckets, key) in levels:
+            buckets.consume(key, packet_len)
+        self.global_bucket.consume(packet_len)
+        return True
 
-        enough_global_bw = self.global_bucket.can_consume(packet_len)
-        enough_host_bw = host_bucket.can_consume(packet_len)
-        if enough_global_bw and enough_host_bw:
-            self.global_bucket.consume(len(packet))
-            host_bucket.consume(len(packet))
-            consumed = True
-        return consumed
+    def _is_penalized(self, ip, now):
+        # Penalties expire in the order they were handed out
+        while len(self.penalized) > 0:
+            (oldest_ip, end_time) = next(self.penalized.iteritems())
+            if end_time > now:
+                break
+            del self.penalized[oldest_ip]
+        return ip in self.penalized
+
+    def _penalize(self, ip, now):
+        if ip not in self.penalized:
+            self.penalties += 1
+            self.penalized[ip] = now + constants.heavy_hitter_penalty
+            if len(self.penalized) > constants.rate_limiter_max_hosts:
+                self.penalized.popitem(last=False)
+
+class CountMinSketch(object):
+    """
+    Estimate the amount counted for each of a huge number of keys
+
+    A count-min sketch uses a fixed amount of memory (depth rows of
+    width counters). Estimates are never too low, and are too high by
+    at most a small fraction of the total count. Every `window` seconds
+    all counters are halved, so that the estimates follow recent
+    traffic rather than all traffic ever seen (@see steady_estimate)
+
+    @see http://en.wikipedia.org/wiki/Count-Min_sketch
+
+    """
+    def __init__(self, window, width=1024, depth=4):
+        self.window = window
+        self.width = width
+        self.depth = depth
+        self._rows = [array("d", [0]) * width for i in xrange(depth)]
+        self._last_decay = time.time()
+
+    def add(self, key, count):
+        """
+        Add count to the key
+
+        @returns the new estimate for the key
+
+        """
+        self._decay()
+        estimate = None
+        for (seed, row) in enumerate(self._rows):
+            index = hash((seed, key)) % self.width
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        """Returns the (over)estimate of the count of the key"""
+        self._decay()
+        return min(row[hash((seed, key)) % self.width]
+                   for (seed, row) in enumerate(self._rows))
+
+    def steady_estimate(self, rate):
+        """
+        Returns the highest estimate of a key added to at a steady rate
+
+        Just before every decay, such a key holds rate * window from
+        the last window, plus half of that from the one before it, and
+        so on: rate * window * (1 + 1/2 + 1/4 + ...)
+
+        @param rate: the amount added to the key per second
+
+        """
+        return 2 * rate * self.window
+
+    def _decay(self):
+        now = time.time()
+        windows = int((now - self._last_decay) // self.window)
+        if windows < 1:
+            return
+        # Halve once for every window that passed (even if no key
+        # was added to in some of them)
+        self._last_decay += windows * self.window
+        factor = 0.5 ** windows
+        for row in self._rows:
+            for i in xrange(self.width):
+                row[i] *= factor
+
+class HostBuckets(object):
+    """
+    A bounded table of per host token buckets
+
+    Each host's bucket is stored as a slot in two flat arrays (its
+    tokens and the time they were last refilled) rather than as a
+    TokenBucket object. A bucket that has been idle for long enough to
+    refill completely is indistinguishable from a new one, so such
+    slots are recycled: every call inspects a few slots (a clock hand
+    sweeping the table), which expires idle hosts in O(1) amortized
+    time. If the table is full (ie: under a flood of spoofed source
+    addresses), the least recently refilled of a small sample of
+    slots is evicted to make room
+
+    @param capacity: the size of every host's bucket (tokens)
+    @param fill_rate: the rate at which every bucket refills (tokens/s)
+    @param max_hosts: the maximum number of hosts tracked at once
+
+    Statistics:
+        expirations: the number of idle hosts that were recycled
+        evictions: the number of hosts that were evicted from a full table
+
+    """
+    # The number of slots inspected by the clock hand per call
+    _sweep_size = 2
+    # The number of slots sampled when an eviction is needed
+    _eviction_sample = 8
+
+    def __init__(self, capacity, fill_rate, max_hosts=None):
+        self.capacity = capacity
+        self.fill_rate = fill_rate
+        self.max_hosts = (max_hosts if max_hosts is not None
+                          else constants.rate_limiter_max_hosts)
+        # Time after which an untouched bucket is full again
+        self.idle_timeout = float(capacity) / fill_rate
+        # address -> slot
+        self._slots = dict()
+        # slot -> address (None for free slots)
+        self._addresses = []
+        self._tokens = array("d")
+        self._timestamps = array("d")
+        self._free_slots = []
+        self._hand = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def consume(self, address, tokens):
+        """
+        Consume tokens from the bucket of the given address
+
+        @returns: True if there were sufficient tokens otherwise False
+
+        """
+        now = time.time()
+        self._sweep(now, self._sweep_size)
+        slot = self._slots.get(address, None)
+        if slot is None:
+            slot = self._allocate(address, now)
+        else:
+            self._refill(slot, now)
+        if self._tokens[slot] >= tokens:
+            self._tokens[slot] -= tokens
+            return True
+        return False
+
+    def tokens(self, address):
+        """Returns the number of tokens available to the given address"""
+        slot = self._slots.get(address, None)
+        if slot is None:
+            return self.capacity
+        self._refill(slot, time.time())
+        return self._tokens[slot]
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, address):
+        return address in self._slots
+
+    def _refill(self, slot, now):
+        elapsed = now - self._timestamps[slot]
+        if elapsed > 0:
+            self._tokens[slot] = min(self.capacity,
+                    self._tokens[slot] + self.fill_rate * elapsed)
+        self._timestamps[slot] = now
+
+    def _allocate(self, address, now):
+        """Find a slot for a new address (recycling one if necessary)"""
+        if len(self._free_slots) > 0:
+            slot = self._free_slots.pop()
+        elif len(self._addresses) < self.max_hosts:
+            slot = len(self._addresses)
+            self._addresses.append(None)
+            self._tokens.append(0)
+            self._timestamps.append(0)
+        else:
+            slot = self._evict(now)
+        self._slots[address] = slot
+        self._addresses[slot] = address
+        self._tokens[slot] = self.capacity
+        self._timestamps[slot] = now
+        return slot
+
+    def _sweep(self, now, count):
+        """Advance the clock hand over count slots, freeing idle ones"""
+        num_slots = len(self._addresses)
+        for i in xrange(min(count, num_slots)):
+            self._hand = (self._hand + 1) % num_slots
+            slot = self._hand
+            if (self._addresses[slot] is not None and
+                    now - self._timestamps[slot] >= self.idle_timeout):
+                self._release(slot)
+                self._free_slots.append(slot)
+                self.expirations += 1
+
+    def _evict(self, now):
+        """Evict the stalest of a few slots and return the freed slot"""
+        num_slots = len(self._addresses)
+        victim = None
+        for i in xrange(min(self._eviction_sample, num_slots)):
+            self._hand = (self._hand + 1) % num_slots
+            if (victim is None or self._timestamps[self._hand] <
+                    self._timestamps[victim]):
+                victim = self._hand
+        self._release(victim)
+        self.evictions += 1
+        return victim
+
+    def _release(self, slot):
+        del self._slots[self._addresses[slot]]
+        self._addresses[slot] = None
 
 class TokenBucket(object):
     """An implementation of the token bucket algorithm.
@@ -63,7 +333,7 @@ class TokenBucket(object):
     # http://code.activestate.com/recipes/511490-implementation-of-the-token-bucket-algorithm/
     # Note: changes have been made (Greg Skoczek, 26 April 2012)
 
-    def __init__(self, tokens, fill_rate):
+    def __init__(self, tokens, fill_rate, clock=None):
         """
         Create a token bucket of 'tokens' size that fills at 'fill_rate'
 
@@ -71,12 +341,15 @@ class TokenBucket(object):
             token bucket can hold
         @param fill_rate: the rate at which tokens enter the token
             bucket (tokens / second)
+        @param clock: an IReactorTime whose seconds() the bucket
+            follows (if None, the bucket follows time.time)
 
         """
         self.capacity = tokens
         self._tokens = tokens
         self.fill_rate = fill_rate
-        self.timestamp = time.time()
+        self._clock = clock
+        self.timestamp = self._now()
 
     def can_consume(self, tokens):
         """
@@ -108,12 +381,17 @@ class TokenBucket(object):
         
         """
         if self._tokens < self.capacity:
-            now = time.time()
+            now = self._now()
             delta = long(round(self.fill_rate * (now - self.timestamp)))
             self._tokens = min(self.capacity, self._tokens + delta)
             self.timestamp = now
         return self._tokens
 
+    def _now(self):
+        if self._clock is None:
+            return time.time()
+        return self._clock.seconds()
+
 
 class RateLimiter_Patcher(proxyForInterface(IKRPC_Sender, '_original')):
     """
@@ -125,27 +403,29 @@ class RateLimiter_Patcher(proxyForInterface(IKRPC_Sender, '_original')):
     be allowed to be received/sent at a time (on a global
     and per host limit)
 
+    Outgoing packets are limited through a send filter of the
+    original (@see IKRPC_Sender.registerSendFilter), so that the
+    queries, responses and errors the original sends itself are
+    limited too
+
     @see dhtbot.rate_limiter.RateLimiter
     @see dhtbot.constants.host_bandwidth_rate
     @see dhtbot.constants.global_bandwidth_rate
 
     """
-    # TODO this method should not be needed, but
-    # removing it causes weird errors
     def __init__(self, original):
         self._original = original
+        original.registerSendFilter(self._send_filter)
 
     def startProtocol(self):
         self._original.startProtocol()
         self._incoming_rate_limiter = RateLimiter()
-        self._outgoing_rate_limiter = RateLimiter()
-
-    def sendKRPC(self, krpc, address):
-        encoded_krpc = krpc_coder.encode(krpc)
-        enough_bandwidth_to_send = \
-                self._outgoing_rate_limiter.consume(encoded_krpc, address)
-        if enough_bandwidth_to_send:
-            self._original.sendKRPC(krpc, address)
+        # Never penalize the nodes we query (or respond to)
+        self._outgoing_rate_limiter = RateLimiter(penalize=False)
+
+    def _send_filter(self, packet, address):
+        # Only let packets out if the rate limiter agrees
+        return self._outgoing_rate_limiter.consume(packet, address)
 
     def datagramReceived(self, datagram, address):
         # Only pass datagrams down the processing chain
@@ -0,0 +1,270 @@
+"""
+Periodic snapshots of the routing table (along with a patcher that
+restores a KRPC_Responder's routing table from its last snapshot)
+
+Restarting without a snapshot means bootstrapping from
+constants.bootstrap_nodes, which takes minutes to fill the kbuckets.
+Restoring the last snapshot makes lookups possible immediately, while
+the restored nodes are revalidated in the background
+
+"""
+import os
+import time
+import struct
+from collections import deque
+
+from twisted.python import log
+from twisted.internet import task
+from twisted.python.components import proxyForInterface
+
+from dhtbot import constants, contact
+from dhtbot.coding import basic_coder
+from dhtbot.protocols.errors import TimeoutError, KRPCError
+from dhtbot.protocols.krpc_responder import IKRPC_Responder
+
+# File format (all integers are big endian)
+#
+#   header: magic, version, time of the snapshot (double),
+#           node_id of the owner (20 bytes), number of records
+#   record: compact node (26 bytes, @see contact.encode_node),
+#           last_updated (double), totalrtt (double),
+#           successcount, failcount
+_MAGIC = "DHTS"
+_VERSION = 1
+_HEADER = struct.Struct("!4sBd20sI")
+_STATS = struct.Struct("!ddII")
+_NODE_SIZE = 26
+_RECORD_SIZE = _NODE_SIZE + _STATS.size
+
+class SnapshotError(Exception):
+    """
+    Raised when a snapshot file can not be read
+
+    reason: a string describing why the snapshot was rejected
+
+    """
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "SnapshotError: %s" % self.reason
+
+class Snapshot(object):
+    """
+    The contents of a snapshot file
+
+    node_id: the node_id of the routing table that was saved
+    time: the time at which the snapshot was taken
+    nodes: a list of contact.Node's (with their statistics restored)
+
+    """
+    def __init__(self, node_id, time, nodes):
+        self.node_id = node_id
+        self.time = time
+        self.nodes = nodes
+
+def save_snapshot(routing_table, path):
+    """
+    Write a snapshot of every node in the routing table to path
+
+    The snapshot is written to a temporary file which then replaces
+    path, so a crash halfway through never leaves a corrupt snapshot
+
+    @returns the number of nodes that were saved
+
+    """
+    nodes = routing_table.nodes_dict.values()
+    chunks = [_HEADER.pack(_MAGIC, _VERSION, time.time(),
+                           basic_coder.encode_network_id(
+                                routing_table.node_id),
+                           len(nodes))]
+    for node in nodes:
+        chunks.append(contact.encode_node(node))
+        chunks.append(_STATS.pack(node.last_updated, node.totalrtt,
+                                  node.successcount, node.failcount))
+    temp_path = "%s.tmp" % path
+    snapshot_file = open(temp_path, "wb")
+    try:
+        snapshot_file.write("".join(chunks))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    finally:
+        snapshot_file.close()
+    os.rename(temp_path, path)
+    return len(nodes)
+
+def load_snapshot(path):
+    """
+    Read the snapshot stored at path
+
+    @raises SnapshotError if the file is missing, truncated,
+        or not a snapshot
+    @returns a Snapshot
+
+    """
+    try:
+        snapshot_file = open(path, "rb")
+        try:
+            data = snapshot_file.read()
+        finally:
+            snapshot_file.close()
+    except IOError, e:
+        raise SnapshotError("Could not read %s: %s" % (path, e))
+    if len(data) < _HEADER.size:
+        raise SnapshotError("Truncated header")
+    (magic, version, snapshot_time, encoded_id, count) = (
+            _HEADER.unpack_from(data))
+    if magic != _MAGIC or version != _VERSION:
+        raise SnapshotError("Unknown snapshot format")
+    if len(data) != _HEADER.size + count * _RECORD_SIZE:
+        raise SnapshotError("Expected %d node records" % count)
+    nodes = []
+    offset = _HEADER.size
+    for i in xrange(count):
+        node = contact.decode_node(data[offset:offset + _NODE_SIZE])
+        (node.last_updated, node.totalrtt,
+         node.successcount, node.failcount) = _STATS.unpack_from(
+                data, offset + _NODE_SIZE)
+        nodes.append(node)
+        offset += _RECORD_SIZE
+    return Snapshot(basic_coder.decode_network_id(encoded_id),
+                    snapshot_time, nodes)
+
+class Revalidator(object):
+    """
+    Ping restored nodes in rate limited batches
+
+    Every `interval` seconds, at most `batch_size` of the queued nodes
+    are pinged. A node that does not respond is removed from the
+    routing table (a node that responds is refreshed by the protocol
+    itself, @see KRPC_Sender._query_success_callback)
+
+    Statistics:
+        revalidated: the number of nodes that responded
+        evicted: the number of nodes that were removed
+
+    """
+    def __init__(self, ping, routing_table, reactor, batch_size=None,
+                 interval=None):
+        self.ping = ping
+        self.routing_table = routing_table
+        self._reactor = reactor
+        self.batch_size = (batch_size if batch_size is not None
+                           else constants.revalidate_batch_size)
+        self.interval = (interval if interval is not None
+                         else constants.revalidate_interval)
+        self._queue = deque()
+        self._looping_call = None
+        self.revalidated = 0
+        self.evicted = 0
+
+    def revalidate(self, nodes):
+        """Queue the given nodes to be pinged"""
+        self._queue.extend(nodes)
+        if self._looping_call is None and len(self._queue) > 0:
+            self._looping_call = task.LoopingCall(self._ping_batch)
+            self._looping_call.clock = self._reactor
+            self._looping_call.start(self.interval)
+
+    def pending(self):
+        """Returns the number of nodes that have not been pinged yet"""
+        return len(self._queue)
+
+    def stop(self):
+        self._queue.clear()
+        if self._looping_call is not None and self._looping_call.running:
+            self._looping_call.stop()
+        self._looping_call = None
+
+    def _ping_batch(self):
+        for i in xrange(min(self.batch_size, len(self._queue))):
+            node = self._queue.popleft()
+            d = self.ping(node.address)
+            d.addCallbacks(self._ping_callback, self._ping_errback,
+                           errbackArgs=(node,))
+        if len(self._queue) == 0:
+            self.stop()
+
+    def _ping_callback(self, response):
+        self.revalidated += 1
+
+    def _ping_errback(self, failure, node):
+        failure.trap(TimeoutError, KRPCError)
+        if self.routing_table.remove_node(node):
+            self.evicted += 1
+
+
+class Snapshot_Patcher(proxyForInterface(IKRPC_Responder)):
+    """
+    Restore the routing table on startup and snapshot it periodically
+
+    When the protocol starts, the snapshot at `path` (if any) is
+    loaded into the routing table and its nodes are revalidated
+    (@see Revalidator). From then on, a snapshot is saved every
+    constants.DUMPinterval seconds and once more when the
+    protocol stops
+
+    To keep the restored routing table's layout, the protocol
+    should be created with the node_id of the snapshot
+    (@see load_snapshot). If it was not, the restored nodes are
+    placed into the buckets of the protocol's own node_id instead
+
+    """
+    def __init__(self, original, path, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.original = original
+        self.path = path
+        self._reactor = reactor
+        self.revalidator = Revalidator(self.ping, original.routing_table,
+                                       reactor)
+        self._looping_call = None
+
+    def startProtocol(self):
+        self.original.startProtocol()
+        self.restore()
+        self._looping_call = task.LoopingCall(self.save)
+        self._looping_call.clock = self._reactor
+        self._looping_call.start(constants.DUMPinterval, now=False)
+
+    def stopProtocol(self):
+        if self._looping_call is not None and self._looping_call.running:
+            self._looping_call.stop()
+        self._looping_call = None
+        self.revalidator.stop()
+        self.save()
+        self.original.stopProtocol()
+
+    def save(self):
+        """Save a snapshot of the routing table"""
+        try:
+            save_snapshot(self.original.routing_table, self.path)
+        except (IOError, OSError), e:
+            log.msg("Saving the routing table snapshot failed: %s" % e)
+
+    def restore(self):
+        """
+        Offer every node of the last snapshot to the routing table
+
+        @returns the number of restored nodes
+
+        """
+        try:
+            snapshot = load_snapshot(self.path)
+        except SnapshotError, e:
+            log.msg("Not restoring the routing table: %s" % e.reason)
+            return 0
+        routing_table = self.original.routing_table
+        nodes = snapshot.nodes
+        if snapshot.node_id != routing_table.node_id:
+            # The snapshot was bucketed around another node_id,
+            # so its nodes are rebucketed around ours (a node
+            # that has our own node_id can not be kept)
+            log.msg("Rebucketing a routing table snapshot of node %d" %
+                    snapshot.node_id)
+            nodes = [node for node in nodes
+                     if node.node_id != routing_table.node_id]
+        restored = [node for node in nodes
+                    if routing_table.offer_node(node)]
+        self.revalidator.revalidate(restored)
+        return len(restored)
@@ -0,0 +1,95 @@
+"""
+A cache of (encoded) closest nodes for responding to queries
+
+Responding to find_node, get_peers, and sample_infohashes queries
+requires a search of the routing table followed by the encoding of
+every node found. Queries tend to target nearby IDs while the routing
+table barely changes between them, so the encoded result is cached
+per target ID prefix until the routing table changes
+
+"""
+from collections import OrderedDict
+
+from dhtbot import constants, contact
+
+class EncodedNodes(list):
+    """
+    A list of nodes that remembers its compact (26 bytes per node) encoding
+
+    The encoding is used as is by the krpc_coder when a
+    response carrying an EncodedNodes instance is encoded
+
+    @see dhtbot.coding.krpc_coder
+
+    """
+    def __init__(self, nodes):
+        list.__init__(self, nodes)
+        self.encoded = "".join([contact.encode_node(node) for node in nodes])
+
+class ClosestNodesCache(object):
+    """
+    Remember the closest nodes (and their encoding) per target prefix
+
+    Targets are keyed by their `prefix_bits` leading bits, so every target
+    sharing a prefix is answered with the nodes closest to the first
+    target seen with that prefix. The whole cache is dropped whenever
+    the routing table's version changes (@see IRoutingTable.version)
+    and at most `max_entries` prefixes are kept (least recently
+    used prefixes are evicted first). A routing table without a
+    version is searched on every lookup, as nothing tells when
+    its cached results become stale
+
+    Statistics:
+        hits: the number of lookups answered from the cache
+        misses: the number of lookups that searched the routing table
+
+    """
+    def __init__(self, routing_table, prefix_bits=None, max_entries=None):
+        self.routing_table = routing_table
+        prefix_bits = (prefix_bits if prefix_bits is not None
+                       else constants.closest_nodes_cache_prefix)
+        self._shift = constants.id_size - prefix_bits
+        self.max_entries = (max_entries if max_entries is not None
+                            else constants.closest_nodes_cache_size)
+        # target prefix -> EncodedNodes
+        self._cache = OrderedDict()
+        self._version = getattr(routing_table, "version", None)
+        self.hits = 0
+        self.misses = 0
+
+    def get_closest_nodes(self, target_id):
+        """
+        Retrieve the nodes closest to target_id
+
+        @returns an EncodedNodes list (which must not be modified,
+            as it is shared between lookups)
+
+        """
+        version = getattr(self.routing_table, "version", None)
+        if version is None:
+            self.misses += 1
+            return EncodedNodes(
+                    self.routing_table.get_closest_nodes(target_id))
+        if self._version != version:
+            self._cache.clear()
+            self._version = version
+        prefix = target_id >> self._shift
+        nodes = self._cache.pop(prefix, None)
+        if nodes is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            nodes = EncodedNodes(
+                    self.routing_table.get_closest_nodes(target_id))
+            if len(self._cache) >= self.max_entries:
+                self._cache.popitem(last=False)
+        # Mark the prefix as the most recently used one
+        self._cache[prefix] = nodes
+        return nodes
+
+    def hit_rate(self):
+        """Returns the fraction of lookups answered from the cache"""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
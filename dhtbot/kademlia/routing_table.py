@@ -12,7 +12,7 @@ import random
 from collections import defaultdict
 
 from twisted.python import log
-from zope.interface import Interface, implements
+from zope.interface import Attribute, Interface, implements
 
 from dhtbot import contact, constants
 from dhtbot.kademlia import kbucket
@@ -24,6 +24,11 @@ class IRoutingTable(Interface):
     @see DHBot/references/kademlia.pdf
 
     """
+    version = Attribute(
+        "A counter that changes whenever the set of nodes changes "
+        "(optional: caches of the routing table's contents are not "
+        "used with routing tables that lack it)")
+
     def offer_node(self, node):
         """Offers the given node to the RoutingTable
 
@@ -76,6 +81,10 @@ class TreeRoutingTable(object):
     design with some improvements noted in the subsecond.pdf paper
     (see the references in the module docstring, above)
 
+    version: a counter that is incremented whenever a node is
+        added to or removed from the table (so that anything derived
+        from the table's contents knows when it is out of date)
+
     """
 
     implements(IRoutingTable)
@@ -87,6 +96,7 @@ class TreeRoutingTable(object):
         self.nodes_dict = {}
         self.nodes_by_addr = defaultdict(set)
         self.active_kbuckets = [k]
+        self.version = 0
 
     def offer_node(self, node):
         # If node isn't in the routing table,
@@ -101,6 +111,7 @@ class TreeRoutingTable(object):
                 # for quick lookup later
                 self.nodes_dict[node.node_id] = node
                 self.nodes_by_addr[node.address].add(node)
+                self.version += 1
             return node_accepted
 
     def remove_node(self, node):
@@ -110,6 +121,7 @@ class TreeRoutingTable(object):
             if len(self.nodes_by_addr[node.address]) == 0:
                 del self.nodes_by_addr[node.address]
             self._remove_node(self.root, node)
+            self.version += 1
             return True
         else:
             return False
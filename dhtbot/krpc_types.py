@@ -5,6 +5,53 @@ Module containing classes that encapsulate
 KRPC Queries, Responses, and Errors
 
 """
+class RawField(object):
+    """
+    The raw (network) form of a KRPC field, decoded on first access
+
+    Decoding every node or peer of a message is wasted work when the
+    message is only matched against its transaction and then thrown
+    away (for example a reply to a query that already timed out).
+    Decoders put a RawField into a lazy field (@see _LazyField) instead,
+    so that the field is only decoded if it is actually read
+
+    @param decoder: a function turning `raw` into the field's value
+        (it must not fail: the raw value is validated beforehand)
+    @param raw: the field as found in the packet
+
+    """
+    __slots__ = ('decoder', 'raw')
+
+    def __init__(self, decoder, raw):
+        self.decoder = decoder
+        self.raw = raw
+
+    def decode(self):
+        return self.decoder(self.raw)
+
+class _LazyField(object):
+    """
+    A descriptor for a field that may hold a RawField
+
+    The RawField is decoded (and replaced by its value) the
+    first time the field is read
+
+    """
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = getattr(instance, self.slot)
+        if isinstance(value, RawField):
+            value = value.decode()
+            setattr(instance, self.slot, value)
+        return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.slot, value)
+
 class _KRPC(object):
     """
     A KRPC message always has a transaction ID
@@ -12,6 +59,8 @@ class _KRPC(object):
     _transaction_id: the transaction ID of this message
 
     """
+    __slots__ = ('_transaction_id',)
+
     def __init__(self):
         self._transaction_id = None
 
@@ -51,7 +100,8 @@ class Query(_KRPC):
     """
     A Query message has a type, querier ID, and various other details
 
-    rpctype: one of ["ping", "find_node", "get_peers", "announce_peer"]
+    rpctype: one of ["ping", "find_node", "get_peers", "announce_peer",
+                     "sample_infohashes"]
     _from: the node ID of the node from which this query originates
     target_id: the target ID of this query (every query except for
               ping uses the target_id field)
@@ -60,6 +110,8 @@ class Query(_KRPC):
     port: the port that the announcing peer will be listening on
 
     """
+    __slots__ = ('rpctype', '_from', 'target_id', 'token', 'port')
+
     def __init__(self):
         _KRPC.__init__(self)
         self.rpctype = None
@@ -68,7 +120,8 @@ class Query(_KRPC):
         self.token = None
         self.port = None
 
-    def build_response(self, nodes=None, token=None, peers=None):
+    def build_response(self, nodes=None, token=None, peers=None,
+                       samples=None, num=None, interval=None):
         """
         Builds a response using information found in the Query
 
@@ -83,6 +136,9 @@ class Query(_KRPC):
         r.nodes = nodes
         r.token = token
         r.peers = peers 
+        r.samples = samples
+        r.num = num
+        r.interval = interval
         return r
 
     def build_error(self, code=201, message="Generic Error"):
@@ -119,8 +175,21 @@ class Response(_KRPC):
     values: a list of peers that are associated with the target ID
             as specified in the originating query
     _from: the node that received the original query
+    samples: a sample of the infohashes stored by the responding
+             node (sample_infohashes responses only, @see BEP 51)
+    num: the number of infohashes stored by the responding node
+    interval: the time (seconds) the querier should wait before
+              asking the responding node for a new sample
+
+    nodes and peers are decoded lazily (@see RawField)
 
     """
+    __slots__ = ('_from', '_nodes', 'token', '_peers', 'rpctype',
+                 'samples', 'num', 'interval')
+
+    nodes = _LazyField('_nodes')
+    peers = _LazyField('_peers')
+
     def __init__(self):
         _KRPC.__init__(self)
         self._from = None
@@ -128,6 +197,9 @@ class Response(_KRPC):
         self.token = None
         self.peers = None
         self.rpctype = None
+        self.samples = None
+        self.num = None
+        self.interval = None
 
     def __repr__(self):
         printable_attributes = self._get_attrs()
@@ -135,8 +207,8 @@ class Response(_KRPC):
 
     # TODO see if we can replace these with a function (in Query too)
     def _get_attrs(self):
-        return ('_transaction_id', '_from',
-                    'nodes', 'token', 'peers', 'rpctype')
+        return ('_transaction_id', '_from', 'nodes', 'token', 'peers',
+                    'rpctype', 'samples', 'num', 'interval')
 
 class Error(_KRPC):
     """
@@ -146,6 +218,8 @@ class Error(_KRPC):
     message: the message associated with this error
 
     """
+    __slots__ = ('code', 'message')
+
     def __init__(self):
         _KRPC.__init__(self)
         self.code = None
@@ -0,0 +1,166 @@
+"""
+Counters and round trip time histograms of the KRPC traffic of a protocol
+
+Every KRPC_Sender keeps a KRPC_Metrics instance (unless
+constants.metrics_enabled is False) that is updated on the send and
+receive paths. Counts are kept in arrays that are allocated up front,
+one slot per rpctype, so updating them never grows a dictionary (and
+flooding us with made up rpctypes costs no memory).
+
+The metrics can be pulled (@see KRPC_Metrics.snapshot), rendered in the
+Prometheus text format (@see KRPC_Metrics.prometheus_text), or served
+over a local HTTP endpoint (@see dhtbot.metrics_server, which is kept
+apart so that the protocols do not depend on twisted.web)
+
+"""
+from array import array
+from bisect import bisect_left
+
+from dhtbot import constants
+
+# The rpctypes that are counted separately, every other
+# rpctype (ie: of an unknown query) is counted as "other"
+rpctypes = ("ping", "find_node", "get_peers", "announce_peer",
+            "sample_infohashes", "other")
+_other = len(rpctypes) - 1
+_rpctype_index = dict((rpctype, index)
+                      for (index, rpctype) in enumerate(rpctypes))
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets
+
+    bounds: the (sorted) upper bounds of the buckets
+    counts: counts[i] is the number of observations that were at most
+            bounds[i] (and above the previous bound), the last count
+            is the number of observations above every bound
+    count: the number of observations
+    sum: the sum of every observation
+
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = array('L', [0] * (len(self.bounds) + 1))
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        @returns a list of (upper bound, number of observations that
+            were at most that bound) pairs, the last bound being
+            float("inf")
+        """
+        result = []
+        total = 0
+        for (bound, count) in zip(self.bounds + (float("inf"),),
+                                  self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class KRPC_Metrics(object):
+    """
+    The counters and histograms kept by a KRPC_Sender
+
+    Per rpctype (@see rpctypes):
+        queries_sent: queries that we sent
+        queries_received: queries that we received
+        responses_received: responses to our queries
+        errors_received: KRPC errors in reply to our queries
+        timeouts: our queries that timed out
+        rtt: a Histogram of the round trip times (seconds) of
+             our queries that were answered
+    Overall:
+        malformed_packets: datagrams that could not be decoded
+        orphaned_replies: replies that matched no outstanding query
+
+    """
+    _counters = ("queries_sent", "queries_received", "responses_received",
+                 "errors_received", "timeouts")
+
+    def __init__(self, rtt_buckets=None):
+        rtt_buckets = (rtt_buckets if rtt_buckets is not None
+                       else constants.metrics_rtt_buckets)
+        for name in self._counters:
+            setattr(self, name, array('L', [0] * len(rpctypes)))
+        self.rtt = [Histogram(rtt_buckets) for rpctype in rpctypes]
+        self.malformed_packets = 0
+        self.orphaned_replies = 0
+
+    def query_sent(self, rpctype):
+        self.queries_sent[_rpctype_index.get(rpctype, _other)] += 1
+
+    def query_received(self, rpctype):
+        self.queries_received[_rpctype_index.get(rpctype, _other)] += 1
+
+    def response_received(self, rpctype, rtt):
+        index = _rpctype_index.get(rpctype, _other)
+        self.responses_received[index] += 1
+        self.rtt[index].observe(rtt)
+
+    def error_received(self, rpctype):
+        self.errors_received[_rpctype_index.get(rpctype, _other)] += 1
+
+    def timed_out(self, rpctype):
+        self.timeouts[_rpctype_index.get(rpctype, _other)] += 1
+
+    def malformed_packet(self):
+        self.malformed_packets += 1
+
+    def orphaned_reply(self):
+        self.orphaned_replies += 1
+
+    def snapshot(self):
+        """
+        @returns the current value of every metric as a dictionary
+            (of builtin types only, so that it can be encoded as JSON)
+        """
+        result = {"malformed_packets": self.malformed_packets,
+                  "orphaned_replies": self.orphaned_replies}
+        for name in self._counters:
+            result[name] = dict(zip(rpctypes, getattr(self, name)))
+        result["rtt"] = dict(
+                (rpctype, {"bounds": list(histogram.bounds),
+                           "counts": list(histogram.counts),
+                           "count": histogram.count,
+                           "sum": histogram.sum})
+                for (rpctype, histogram) in zip(rpctypes, self.rtt))
+        return result
+
+    def prometheus_text(self, prefix="dhtbot"):
+        """
+        @returns every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for name in self._counters:
+            metric = "%s_%s_total" % (prefix, name)
+            lines.append("# TYPE %s counter" % metric)
+            for (rpctype, value) in zip(rpctypes, getattr(self, name)):
+                lines.append('%s{rpctype="%s"} %d' % (metric, rpctype, value))
+        for name in ("malformed_packets", "orphaned_replies"):
+            metric = "%s_%s_total" % (prefix, name)
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %d" % (metric, getattr(self, name)))
+        metric = "%s_rtt_seconds" % prefix
+        lines.append("# TYPE %s histogram" % metric)
+        for (rpctype, histogram) in zip(rpctypes, self.rtt):
+            for (bound, count) in histogram.cumulative_counts():
+                lines.append('%s_bucket{rpctype="%s",le="%s"} %d' % (
+                        metric, rpctype, _format_bound(bound), count))
+            lines.append('%s_sum{rpctype="%s"} %r' % (
+                    metric, rpctype, histogram.sum))
+            lines.append('%s_count{rpctype="%s"} %d' % (
+                    metric, rpctype, histogram.count))
+        return "\n".join(lines) + "\n"
+
+def _format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
@@ -0,0 +1,53 @@
+"""
+Serve the metrics of a protocol over a local HTTP endpoint
+
+@see dhtbot.metrics
+
+"""
+import json
+
+from twisted.web import resource, server
+
+from dhtbot import constants
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the metrics of a KRPC_Metrics instance over HTTP
+
+    /metrics: the Prometheus text format
+    /metrics.json: the JSON encoded snapshot
+
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        path = "/".join(request.postpath)
+        if path == "metrics":
+            request.setHeader("Content-Type",
+                              "text/plain; version=0.0.4")
+            return self.metrics.prometheus_text()
+        if path == "metrics.json":
+            request.setHeader("Content-Type", "application/json")
+            return json.dumps(self.metrics.snapshot(), sort_keys=True)
+        request.setResponseCode(404)
+        return "Not found\n"
+
+def listen_metrics(metrics, port=None, interface="127.0.0.1",
+                   reactor=None):
+    """
+    Serve the given metrics over HTTP (@see MetricsResource)
+
+    The endpoint only listens on the loopback interface by default,
+    as the metrics tell a lot about who we talk to
+
+    @returns the twisted.internet.interfaces.IListeningPort
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    port = port if port is not None else constants.metrics_port
+    return reactor.listenTCP(port, server.Site(MetricsResource(metrics)),
+                             interface=interface)
@@ -0,0 +1,122 @@
+"""
+Periodic reannouncing of many infohashes
+
+@see dhtbot.protocols.krpc_iterator.KRPC_Iterator.announce
+
+"""
+import heapq
+import random
+
+from twisted.python import log
+from twisted.internet import task
+
+from dhtbot import constants
+from dhtbot.protocols.krpc_iterator import IterationError
+
+class AnnounceScheduler(object):
+    """
+    Reannounce a set of infohashes every constants.announce_interval
+
+    Announces are spread over time: every infohash is due at its own
+    (initially random) point in the interval, and every tick at most
+    max_per_tick due infohashes are announced. Infohashes that could
+    not be announced in their tick stay due and are announced first
+    in the following ticks
+
+    @param announce: a function announce(infohash, port) returning a
+        deferred (ie: KRPC_Iterator.announce)
+    @param reactor: the reactor used to drive the scheduler
+
+    Statistics:
+        announces_sent: the number of announces that were started
+        announce_failures: the number of announces that failed
+
+    """
+    def __init__(self, announce, reactor, interval=None, tick=None,
+                 max_per_tick=None):
+        self.announce = announce
+        self._reactor = reactor
+        self.interval = (interval if interval is not None
+                         else constants.announce_interval)
+        self.tick = tick if tick is not None else constants.announce_tick
+        self.max_per_tick = (max_per_tick if max_per_tick is not None
+                             else constants.announce_max_per_tick)
+        # infohash -> port
+        self.ports = dict()
+        # infohash -> the time its next announce is due
+        self._due = dict()
+        # (due time, infohash) heap, which may contain stale entries
+        # (at most as many as there are live ones, @see _compact)
+        self._schedule = []
+        self._looping_call = None
+        self.announces_sent = 0
+        self.announce_failures = 0
+
+    def add(self, infohash, port, delay=None):
+        """
+        Start reannouncing infohash on the given port
+
+        @param delay: the time until the first announce. If None, a
+            random point within the interval is chosen (so that many
+            infohashes added at once are spread over the interval)
+
+        """
+        if delay is None:
+            delay = random.uniform(0, self.interval)
+        self.ports[infohash] = port
+        self._set_due(infohash, self._reactor.seconds() + delay)
+
+    def remove(self, infohash):
+        """Stop reannouncing the given infohash"""
+        self.ports.pop(infohash, None)
+        self._due.pop(infohash, None)
+        self._compact()
+
+    def start(self):
+        """Start ticking every self.tick seconds"""
+        self._looping_call = task.LoopingCall(self._tick)
+        self._looping_call.clock = self._reactor
+        self._looping_call.start(self.tick, now=False)
+
+    def stop(self):
+        if self._looping_call is not None and self._looping_call.running:
+            self._looping_call.stop()
+        self._looping_call = None
+
+    def pending(self):
+        """Returns the number of infohashes that are being reannounced"""
+        return len(self.ports)
+
+    def _set_due(self, infohash, due_time):
+        self._due[infohash] = due_time
+        heapq.heappush(self._schedule, (due_time, infohash))
+        self._compact()
+
+    def _compact(self):
+        """Rebuild the heap once more than half of it is stale"""
+        if len(self._schedule) > 2 * len(self._due):
+            self._schedule = [(due_time, infohash) for (infohash, due_time)
+                              in self._due.iteritems()]
+            heapq.heapify(self._schedule)
+
+    def _tick(self):
+        """Announce (at most max_per_tick) infohashes that are due"""
+        now = self._reactor.seconds()
+        announced = 0
+        while (len(self._schedule) > 0 and announced < self.max_per_tick and
+                self._schedule[0][0] <= now):
+            (due_time, infohash) = heapq.heappop(self._schedule)
+            # Skip entries for removed or rescheduled infohashes
+            if self._due.get(infohash, None) != due_time:
+                continue
+            announced += 1
+            self._set_due(infohash, now + self.interval)
+            self.announces_sent += 1
+            d = self.announce(infohash, self.ports[infohash])
+            d.addErrback(self._announce_failed_errback, infohash)
+
+    def _announce_failed_errback(self, failure, infohash):
+        failure.trap(IterationError)
+        self.announce_failures += 1
+        log.msg("Reannouncing infohash %d failed: %s" % (
+                infohash, failure.value.reason))
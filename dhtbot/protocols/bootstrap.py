@@ -0,0 +1,255 @@
+"""
+Fill an empty routing table from constants.bootstrap_nodes
+
+Bootstrapping happens in three concurrent stages:
+    1) every bootstrap hostname is resolved (in parallel, falling back
+       onto addresses cached on disk by a previous run)
+    2) every bootstrap address is sent a find_node for our own ID
+    3) a lookup towards our own ID is started from the returned nodes,
+       after which every kbucket is refreshed with a parallel lookup
+
+@see dhtbot.protocols.krpc_iterator.KRPC_Iterator.find_lookup
+
+"""
+import os
+import time
+import random
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.error import DNSLookupError
+
+from dhtbot import constants
+from dhtbot.protocols.krpc_iterator import IterationError
+
+class StaticResolver(object):
+    """
+    A stand-in for the reactor's resolver that answers from a dictionary
+
+    Every name is answered synchronously; names that are not in
+    the dictionary fail with a DNSLookupError
+
+    @see twisted.internet.interfaces.IResolverSimple
+
+    """
+    def __init__(self, names):
+        self.names = names
+        self.lookups = []
+
+    def getHostByName(self, name, timeout=None):
+        self.lookups.append(name)
+        if name in self.names:
+            return defer.succeed(self.names[name])
+        return defer.fail(DNSLookupError(name))
+
+class ResolverCache(object):
+    """
+    Remember resolved hostnames on disk across restarts
+
+    Each line of the cache file holds "hostname ip time". Entries younger
+    than constants.bootstrap_cache_timeout are used instead of resolving
+    the hostname again. Older entries are only used when resolving fails
+
+    """
+    def __init__(self, path):
+        self.path = path
+        # hostname -> (ip, time resolved)
+        self.entries = dict()
+        self.load()
+
+    def get(self, hostname, allow_stale=False):
+        """Returns the cached ip of hostname (or None)"""
+        entry = self.entries.get(hostname, None)
+        if entry is None:
+            return None
+        (ip, resolved_time) = entry
+        age = time.time() - resolved_time
+        if allow_stale or age < constants.bootstrap_cache_timeout:
+            return ip
+        return None
+
+    def put(self, hostname, ip):
+        self.entries[hostname] = (ip, time.time())
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        cache_file = open(self.path, "r")
+        try:
+            for line in cache_file:
+                fields = line.split()
+                if len(fields) != 3 or not isIPAddress(fields[1]):
+                    continue
+                self.entries[fields[0]] = (fields[1], float(fields[2]))
+        finally:
+            cache_file.close()
+
+    def save(self):
+        """Write the cache to disk (atomically, @see snapshot.save_snapshot)"""
+        temp_path = "%s.tmp" % self.path
+        cache_file = open(temp_path, "w")
+        try:
+            for (hostname, (ip, resolved_time)) in self.entries.iteritems():
+                cache_file.write("%s %s %f\n" % (hostname, ip, resolved_time))
+        finally:
+            cache_file.close()
+        os.rename(temp_path, self.path)
+
+def resolve_addresses(addresses, resolver, cache=None):
+    """
+    Resolve the hostnames of the given addresses in parallel
+
+    Addresses that are already IP addresses are passed through as they
+    are. Hostnames found fresh in the cache are not resolved again, and
+    hostnames that fail to resolve fall back onto stale cache entries
+    (or are dropped, if there are none). Whatever the resolver fails
+    with (ie: a DNSLookupError, or a timeout), the failure is logged
+
+    @param addresses: a list of (hostname or ip, port) tuples
+    @param resolver: an IResolverSimple (ie: reactor.resolver)
+    @param cache: a ResolverCache, or None
+    @returns a deferred firing with a list of (ip, port) tuples
+
+    """
+    deferreds = []
+    for (host, port) in addresses:
+        cached_ip = cache.get(host) if cache is not None else None
+        if isIPAddress(host):
+            d = defer.succeed(host)
+        elif cached_ip is not None:
+            d = defer.succeed(cached_ip)
+        else:
+            d = resolver.getHostByName(host)
+            d.addCallback(_cache_resolved_callback, host, cache)
+            d.addErrback(_resolve_failed_errback, host, cache)
+        d.addCallback(_make_address_callback, port)
+        deferreds.append(d)
+    dl = defer.DeferredList(deferreds, consumeErrors=True)
+    dl.addCallback(_collect_addresses_callback)
+    return dl
+
+def _collect_addresses_callback(results):
+    addresses = []
+    for (success, result) in results:
+        if not success:
+            log.err(result, "Resolving a bootstrap address failed")
+        elif result is not None:
+            addresses.append(result)
+    return addresses
+
+def _make_address_callback(ip, port):
+    if ip is None:
+        return None
+    return (ip, port)
+
+def _cache_resolved_callback(ip, hostname, cache):
+    if cache is not None:
+        cache.put(hostname, ip)
+    return ip
+
+def _resolve_failed_errback(failure, hostname, cache):
+    log.msg("Could not resolve bootstrap node %s: %s" %
+            (hostname, failure.getErrorMessage()))
+    if cache is not None:
+        return cache.get(hostname, allow_stale=True)
+    return None
+
+class Bootstrapper(object):
+    """
+    Populate a KRPC_Iterator's routing table as fast as possible
+
+    @param protocol: a KRPC_Iterator
+    @param resolver: an IResolverSimple used to resolve the hostnames
+        of the bootstrap nodes (defaults to the reactor's resolver)
+    @param cache_path: where resolved hostnames are cached (or None)
+    @param bootstrap_nodes: a list of (hostname or ip, port) tuples
+        (defaults to constants.bootstrap_nodes)
+
+    Statistics:
+        addresses: the resolved bootstrap addresses
+        probes_answered: the number of bootstrap nodes that answered
+        refreshes: the number of kbucket refresh lookups that were run
+
+    """
+    def __init__(self, protocol, resolver=None, cache_path=None,
+                 bootstrap_nodes=None):
+        if resolver is None:
+            from twisted.internet import reactor
+            resolver = reactor.resolver
+        self.protocol = protocol
+        self.resolver = resolver
+        self.cache = (ResolverCache(cache_path)
+                      if cache_path is not None else None)
+        if bootstrap_nodes is None:
+            bootstrap_nodes = constants.bootstrap_nodes
+        self.bootstrap_nodes = bootstrap_nodes
+        self.addresses = []
+        self.probes_answered = 0
+        self.refreshes = 0
+
+    def bootstrap(self):
+        """
+        Run all three bootstrap stages
+
+        @returns a deferred that fires with the number of nodes in the
+            routing table, or errbacks with an IterationError if
+            no bootstrap node could be reached
+
+        """
+        d = resolve_addresses(self.bootstrap_nodes, self.resolver,
+                              self.cache)
+        d.addCallback(self._probe_callback)
+        d.addCallback(self._lookup_own_id_callback)
+        d.addCallback(self._refresh_kbuckets_callback)
+        d.addCallback(lambda ignored:
+                      len(self.protocol.routing_table.nodes_dict))
+        return d
+
+    def _probe_callback(self, addresses):
+        """Send a find_node(own ID) to every bootstrap address at once"""
+        self.addresses = addresses
+        if self.cache is not None:
+            try:
+                self.cache.save()
+            except (IOError, OSError), e:
+                log.msg("Could not save the resolver cache: %s" % e)
+        node_id = self.protocol.node_id
+        deferreds = [self.protocol.find_node(address, node_id)
+                     for address in addresses]
+        dl = defer.DeferredList(deferreds, consumeErrors=True)
+        dl.addCallback(self._collect_seeds_callback)
+        return dl
+
+    def _collect_seeds_callback(self, results):
+        seeds = set()
+        for (success, response) in results:
+            if success:
+                self.probes_answered += 1
+                if response.nodes is not None:
+                    seeds.update(response.nodes)
+        if self.probes_answered == 0:
+            raise IterationError("No bootstrap node could be reached")
+        return list(seeds)
+
+    def _lookup_own_id_callback(self, seeds):
+        d = self.protocol.find_lookup(self.protocol.node_id,
+                                      nodes=seeds or None)
+        d.addErrback(self._silence_iteration_error)
+        return d
+
+    def _refresh_kbuckets_callback(self, ignored):
+        """Run a lookup towards a random ID in every kbucket at once"""
+        deferreds = []
+        for kbucket in list(self.protocol.routing_table.get_kbuckets()):
+            target_id = random.randrange(kbucket.range_min,
+                                         kbucket.range_max)
+            self.refreshes += 1
+            d = self.protocol.find_lookup(target_id)
+            d.addErrback(self._silence_iteration_error)
+            deferreds.append(d)
+        return defer.DeferredList(deferreds)
+
+    def _silence_iteration_error(self, failure):
+        failure.trap(IterationError)
+        log.msg("Bootstrap lookup failed: %s" % failure.value.reason)
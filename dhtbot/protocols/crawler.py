@@ -0,0 +1,256 @@
+"""
+A crawler that maps the DHT by sweeping the keyspace with lookups
+
+@see dhtbot.protocols.krpc_iterator.KRPC_Iterator.find_lookup
+
+"""
+import math
+import random
+import hashlib
+
+from twisted.python import log
+from twisted.internet import defer
+
+from dhtbot import constants, contact
+from dhtbot.coding import basic_coder
+from dhtbot.extensions.rate_limiter import TokenBucket
+from dhtbot.protocols.krpc_iterator import IterationError
+
+class SeenSet(object):
+    """
+    A compact (probabilistic) set of keys
+
+    The SeenSet is a bloom filter: it never forgets a key that has been
+    added, but it may claim that a key was seen when it was not (with a
+    probability of about `error_rate` once `capacity` keys have been
+    added). Its memory use is fixed at creation time
+
+    """
+    def __init__(self, capacity, error_rate):
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                 (math.log(2) ** 2)))
+        self.num_bits = max(8, num_bits)
+        self.num_hashes = max(1, int(round(
+                (float(self.num_bits) / capacity) * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def add(self, key):
+        """
+        Add the key (a string) to the set
+
+        @returns True if the key was not in the set before
+
+        """
+        was_new = False
+        for bit in self._bit_positions(key):
+            byte_index, mask = bit >> 3, 1 << (bit & 7)
+            if not self._bits[byte_index] & mask:
+                self._bits[byte_index] |= mask
+                was_new = True
+        if was_new:
+            self.count += 1
+        return was_new
+
+    def __contains__(self, key):
+        for bit in self._bit_positions(key):
+            if not self._bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def _bit_positions(self, key):
+        """Derive num_hashes bit positions from one digest (double hashing)"""
+        digest = hashlib.md5(key).digest()
+        h1 = long(digest[:8].encode("hex"), 16)
+        h2 = long(digest[8:].encode("hex"), 16) | 1
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+class FileSink(object):
+    """
+    Write every discovered node to a file
+
+    Each node is written as its 26 byte compact encoding
+    (@see dhtbot.contact.encode_node)
+
+    """
+    def __init__(self, path):
+        self._file = open(path, "ab")
+
+    def __call__(self, node):
+        self._file.write(contact.encode_node(node))
+
+    def close(self):
+        self._file.close()
+
+class Crawler(object):
+    """
+    Sweep the 160 bit keyspace with find_node (or sample_infohashes) lookups
+
+    The keyspace is divided into 2**sweep_bits slices, and one lookup
+    is run towards a random target in every slice (the slices are
+    visited in bit-reversed order, so that the whole keyspace is
+    covered coarsely before it is covered finely). At most max_lookups
+    lookups run at once, and at most lookup_rate lookups are started
+    per second (the rate must be positive). Every newly discovered
+    node is passed onto the sink exactly once (nodes are deduplicated
+    in a SeenSet)
+
+    If a sample_sink is given, sample_infohashes lookups are run
+    instead (@see KRPC_Iterator.sample_lookup) and every newly
+    harvested infohash is passed onto the sample_sink exactly once
+
+    @param protocol: a KRPC_Iterator (its routing table seeds the lookups)
+    @param reactor: the clock of the rate limiter (and of throughput())
+    @param sink: a callable that is called with every discovered node
+        (for example a FileSink)
+    @param sample_sink: a callable that is called with every
+        harvested infohash
+
+    Statistics:
+        nodes_discovered: the number of distinct nodes discovered
+        samples_discovered: the number of distinct infohashes harvested
+        lookups_completed, lookups_failed: the number of lookups that
+            finished (and the number of those that failed)
+
+    """
+    def __init__(self, protocol, reactor, sink, sweep_bits=None,
+                 max_lookups=None, lookup_rate=None, seen_capacity=None,
+                 sample_sink=None):
+        self.protocol = protocol
+        self._reactor = reactor
+        self.sink = sink
+        self.sample_sink = sample_sink
+        self.sweep_bits = (sweep_bits if sweep_bits is not None
+                           else constants.crawl_sweep_bits)
+        self.max_lookups = (max_lookups if max_lookups is not None
+                            else constants.crawl_max_lookups)
+        lookup_rate = (lookup_rate if lookup_rate is not None
+                       else constants.crawl_lookup_rate)
+        if lookup_rate <= 0:
+            raise ValueError("lookup_rate must be positive, not %r" %
+                             (lookup_rate,))
+        self._lookup_bucket = TokenBucket(max(1, lookup_rate), lookup_rate,
+                                          clock=reactor)
+        self._retry_delay = 1.0 / lookup_rate
+        seen_capacity = seen_capacity or constants.crawl_seen_capacity
+        self.seen = SeenSet(seen_capacity, constants.crawl_seen_error_rate)
+        self.seen_samples = None
+        if sample_sink is not None:
+            self.seen_samples = SeenSet(seen_capacity,
+                                        constants.crawl_seen_error_rate)
+        self.nodes_discovered = 0
+        self.samples_discovered = 0
+        self.lookups_completed = 0
+        self.lookups_failed = 0
+        self.deferred = defer.Deferred()
+        self._next_slice = 0
+        self._active = 0
+        self._running = False
+        self._retry_call = None
+        self._start_time = None
+        self._end_time = None
+
+    def start(self):
+        """
+        Start sweeping the keyspace
+
+        @returns a deferred that fires with this crawler once every
+            slice of the keyspace has been looked up
+
+        """
+        self._running = True
+        self._start_time = self._reactor.seconds()
+        self._fill()
+        return self.deferred
+
+    def stop(self):
+        """Stop starting new lookups (running lookups are not cancelled)"""
+        self._running = False
+        if self._retry_call is not None and self._retry_call.active():
+            self._retry_call.cancel()
+        self._finish()
+
+    def throughput(self):
+        """Returns the number of nodes discovered per second"""
+        if self._start_time is None:
+            return 0
+        end_time = self._end_time
+        if end_time is None:
+            end_time = self._reactor.seconds()
+        elapsed = end_time - self._start_time
+        if elapsed <= 0:
+            return 0
+        return self.nodes_discovered / float(elapsed)
+
+    def _fill(self):
+        """Start lookups until the concurrency or rate limit is reached"""
+        self._retry_call = None
+        num_slices = 2 ** self.sweep_bits
+        while (self._running and self._active < self.max_lookups and
+                self._next_slice < num_slices):
+            if not self._lookup_bucket.consume(1):
+                self._retry_call = self._reactor.callLater(
+                        self._retry_delay, self._fill)
+                return
+            target_id = self._slice_target(self._next_slice)
+            self._next_slice += 1
+            self._active += 1
+            d = self._start_lookup(target_id)
+            d.addErrback(self._lookup_failed_errback)
+            d.addBoth(self._lookup_done_bothback)
+        if self._active == 0:
+            self._finish()
+
+    def _start_lookup(self, target_id):
+        # Crawl targets are never looked up again, so they are kept
+        # out of the protocol's lookup cache
+        if self.sample_sink is None:
+            return self.protocol.find_lookup(target_id,
+                    listener=self._lookup_listener, use_cache=False)
+        return self.protocol.sample_lookup(target_id,
+                listener=self._lookup_listener,
+                sample_listener=self._sample_listener, use_cache=False)
+
+    def _slice_target(self, slice_index):
+        """Returns a random ID within the given (bit-reversed) slice"""
+        bits = self.sweep_bits
+        prefix = 0
+        for i in xrange(bits):
+            if slice_index & (1 << i):
+                prefix |= 1 << (bits - 1 - i)
+        suffix_bits = constants.id_size - bits
+        return (prefix << suffix_bits) | random.getrandbits(suffix_bits)
+
+    def _lookup_listener(self, lookup, new_nodes, new_peers):
+        for node in new_nodes:
+            if self.seen.add(contact.encode_node(node)):
+                self.nodes_discovered += 1
+                self.sink(node)
+
+    def _sample_listener(self, lookup, new_samples):
+        for infohash in new_samples:
+            if self.seen_samples.add(basic_coder.encode_network_id(infohash)):
+                self.samples_discovered += 1
+                self.sample_sink(infohash)
+
+    def _lookup_failed_errback(self, failure):
+        failure.trap(IterationError)
+        self.lookups_failed += 1
+        log.msg("Crawler lookup failed: %s" % failure.value.reason)
+
+    def _lookup_done_bothback(self, result):
+        self._active -= 1
+        self.lookups_completed += 1
+        if self._retry_call is None:
+            self._fill()
+        elif self._active == 0 and not self._running:
+            self._finish()
+        return result
+
+    def _finish(self):
+        if self._active > 0 or self.deferred.called:
+            return
+        self._running = False
+        self._end_time = self._reactor.seconds()
+        self.deferred.callback(self)
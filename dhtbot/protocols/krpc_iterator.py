@@ -8,6 +8,8 @@ from zope.interface import implements
 from twisted.internet import defer
 
 from dhtbot.protocols.krpc_responder import KRPC_Responder, IKRPC_Responder
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.protocols.lookup import IterativeLookup, LookupCache
 from dhtbot.protocols.errors import TimeoutError, KRPCError
 
 class IterationError(Exception):
@@ -82,21 +84,246 @@ class IKRPC_Iterator(IKRPC_Responder):
 
         """
 
+    def find_lookup(self, target_id, nodes=None, timeout=None,
+                    listener=None, use_cache=True):
+        """
+        Iteratively converge on the k nodes closest to target_id
+
+        Unlike find_iterate (which performs exactly one round of
+        queries), find_lookup keeps querying the closest nodes it
+        has heard of (at most constants.alpha at a time) until
+        the k closest nodes have all responded
+
+        @param nodes: the nodes to start the lookup from (if no nodes
+            are provided, the closest nodes found by a recent lookup
+            of the same target are used, or otherwise nodes will be
+            taken from the routing table)
+        @param timeout: the timeout of each individual query
+        @param listener: if given, nodes are streamed to it as they
+            are discovered (@see IterativeLookup for its signature)
+        @param use_cache: if False, the lookup cache is neither
+            consulted nor updated (ie: for one-off targets such as
+            those of a crawl, which would evict useful entries)
+        @returns a deferred that fires its callback with the finished
+            dhtbot.protocols.lookup.IterativeLookup (see its
+            closest_nodes() method and its stats attribute).
+            The errback is fired with an IterationError if there are
+            no nodes to start from or no query succeeded
+
+        @see dhtbot.protocols.lookup.IterativeLookup
+
+        """
+
+    def get_lookup(self, target_id, nodes=None, timeout=None,
+                   listener=None, max_peers=None, use_cache=True):
+        """
+        Iteratively converge on the k nodes closest to an infohash
+
+        This behaves just as find_lookup, but uses get_peers queries.
+        The resulting lookup also holds all the peers that
+        were found along with the tokens of every responding node
+
+        Peers are streamed to the listener as responses arrive (rather
+        than after every query has completed). If max_peers is given,
+        the lookup ends as soon as that many peers have been found
+
+        If no nodes are given and the peers of a recent lookup of the
+        same target are cached (@see lookup.LookupCache), the
+        deferred fires immediately with the cached
+        dhtbot.protocols.lookup.CachedLookup instead
+
+        @see find_lookup
+
+        """
+
+    def sample_lookup(self, target_id, nodes=None, timeout=None,
+                      listener=None, sample_listener=None, use_cache=True):
+        """
+        Iteratively converge on a target ID, collecting infohash samples
+
+        This behaves just as find_lookup, but uses sample_infohashes
+        queries (@see BEP 51): every responding node hands back a random
+        sample of the infohashes it stores, which are collected in the
+        .samples set of the resulting lookup and streamed to the
+        sample_listener as sample_listener(lookup, new_samples). Nodes
+        that do not support sample_infohashes answer with an error and
+        are skipped. Walking many random targets (@see
+        dhtbot.protocols.crawler.Crawler) harvests infohashes far
+        more cheaply than a get_peers per infohash
+
+        @see find_lookup
+
+        """
+
+    def announce(self, infohash, port, timeout=None):
+        """
+        Announce that we are a peer for infohash on the given port
+
+        A get_peers lookup is run towards the infohash (or its result
+        is taken from the lookup cache, which also serves as a short
+        lived cache of the tokens handed out by the k closest nodes,
+        if the cached closest nodes gave us tokens). An announce_peer
+        query is then sent concurrently to every one of the k closest
+        nodes that gave us a token
+
+        @see dhtbot.protocols.announce.AnnounceScheduler for
+            periodically reannouncing many infohashes
+        @returns a deferred that fires its callback with a list of
+            the nodes that accepted the announce. The errback is
+            fired with an IterationError if the lookup failed or
+            no node accepted the announce
+
+        """
+
 class KRPC_Iterator(KRPC_Responder):
 
     implements(IKRPC_Iterator)
 
+    def __init__(self, routing_table_class=TreeRoutingTable, node_id=None):
+        KRPC_Responder.__init__(self, routing_table_class, node_id)
+        # Results of recent lookups (@see _lookup)
+        self.lookup_cache = LookupCache()
+
     def find_iterate(self, target_id, nodes=None, timeout=None):
         # find_iterate returns only nodes
-        d = self._iterate(self.find_node, target_id, nodes)
+        d = self._iterate(self.find_node, target_id, nodes, timeout)
         d.addCallback(lambda (nodes, peers): nodes)
         return d
 
     def get_iterate(self, target_id, nodes=None, timeout=None):
         # Get_iterate returns the full tuple (nodes, peers)
-        d = self._iterate(self.get_peers, target_id, nodes)
+        d = self._iterate(self.get_peers, target_id, nodes, timeout)
+        return d
+
+    def find_lookup(self, target_id, nodes=None, timeout=None,
+                    listener=None, use_cache=True):
+        return self._lookup(self.find_node, target_id, nodes, timeout,
+                            listener=listener, use_cache=use_cache)
+
+    def get_lookup(self, target_id, nodes=None, timeout=None,
+                   listener=None, max_peers=None, use_cache=True):
+        return self._lookup(self.get_peers, target_id, nodes, timeout,
+                            listener=listener, max_peers=max_peers,
+                            use_cached_peers=True, use_cache=use_cache)
+
+    def sample_lookup(self, target_id, nodes=None, timeout=None,
+                      listener=None, sample_listener=None, use_cache=True):
+        return self._lookup(self.sample_infohashes, target_id, nodes,
+                            timeout, listener=listener,
+                            sample_listener=sample_listener,
+                            use_cache=use_cache)
+
+    def _lookup(self, query_func, target_id, nodes=None, timeout=None,
+                listener=None, max_peers=None, use_cached_peers=False,
+                sample_listener=None, use_cached_tokens=False,
+                use_cache=True):
+        """
+        Run an IterativeLookup towards the target_id
+
+        If no nodes are given, the lookup cache is consulted: the cached
+        lookup is returned directly if use_cached_peers is set and it
+        holds enough peers, or if use_cached_tokens is set and its
+        closest nodes gave us tokens. Otherwise the lookup starts from
+        the cached closest nodes. If use_cache is False, the lookup
+        cache is neither consulted nor updated
+
+        @see find_lookup
+
+        """
+        if nodes is None and use_cache:
+            cached = self.lookup_cache.get(target_id)
+            if cached is not None:
+                has_peers = (len(cached.peers) > 0 and
+                             (max_peers is None or
+                              len(cached.peers) >= max_peers))
+                if ((use_cached_peers and has_peers) or
+                        (use_cached_tokens and len(cached.tokens) > 0)):
+                    if listener is not None:
+                        listener(cached, cached.closest_nodes(),
+                                 list(cached.peers))
+                    return defer.succeed(cached)
+                nodes = cached.closest_nodes() or None
+        seed_nodes = self._get_seed_nodes(target_id, nodes)
+        if seed_nodes is None:
+            return defer.fail(
+                IterationError("No nodes were supplied and no nodes "
+                    + "were found in the routing table"))
+        lookup = IterativeLookup(query_func, target_id, seed_nodes,
+                                 own_id=self.node_id, timeout=timeout,
+                                 reactor=self._reactor, listener=listener,
+                                 max_peers=max_peers,
+                                 sample_listener=sample_listener)
+        d = lookup.start()
+        d.addCallback(self._check_lookup_success_callback, use_cache)
         return d
 
+    def announce(self, infohash, port, timeout=None):
+        # Cached lookups without tokens (ie: of find_lookup) can not be
+        # announced to, a fresh get_peers lookup is needed to get tokens
+        d = self._lookup(self.get_peers, infohash, timeout=timeout,
+                         use_cached_tokens=True)
+        d.addCallback(self._announce_to_closest_callback,
+                      infohash, port, timeout)
+        return d
+
+    def _announce_to_closest_callback(self, lookup, infohash, port, timeout):
+        """Send an announce_peer to each of the closest nodes of lookup"""
+        nodes = []
+        deferreds = []
+        for node in lookup.closest_nodes():
+            token = lookup.tokens.get(node.node_id, None)
+            if token is None:
+                continue
+            nodes.append(node)
+            deferreds.append(self.announce_peer(
+                    node.address, infohash, token, port, timeout))
+        dl = defer.DeferredList(deferreds, consumeErrors=True)
+        dl.addCallback(self._collect_announced_nodes_callback, nodes)
+        return dl
+
+    def _collect_announced_nodes_callback(self, results, nodes):
+        """Return the nodes that accepted the announce"""
+        announced_nodes = []
+        for (node, (was_successful, result)) in zip(nodes, results):
+            if was_successful:
+                announced_nodes.append(node)
+            else:
+                self._silence_error(result)
+        if len(announced_nodes) == 0:
+            raise IterationError("No node accepted the announce")
+        return announced_nodes
+
+    def _check_lookup_success_callback(self, lookup, use_cache=True):
+        """
+        Ensure that atleast one query of the lookup succeeded
+
+        Successful lookups are remembered in the lookup cache (unless
+        use_cache is False, or they were ended early,
+        @see LookupCache.put)
+
+        """
+        if lookup.stats.responses == 0:
+            raise IterationError("All outbound queries timed out")
+        if use_cache:
+            self.lookup_cache.put(lookup)
+        return lookup
+
+    def _get_seed_nodes(self, target_id, nodes=None):
+        """
+        Return the nodes an iteration should start from
+
+        @returns the given nodes, or the closest nodes in the
+            routing table if no nodes were given (None if
+            the routing table is empty)
+
+        """
+        if nodes is not None:
+            return nodes
+        seed_nodes = self.routing_table.get_closest_nodes(target_id)
+        if len(seed_nodes) == 0:
+            return None
+        return seed_nodes
+
     def _iterate(self, iterate_func, target_id, nodes=None, timeout=None):
         """
         Perform one iteration towards the target_id
@@ -115,18 +342,14 @@ class KRPC_Iterator(KRPC_Responder):
         @see IterationError
 
         """
-        # Prepare the seed nodes
-        if nodes is None:
-            # If no nodes are supplied, we have to
-            # get some from the routing table
-            seed_nodes = self.routing_table.get_closest_nodes(target_id)
-            if len(seed_nodes) == 0:
-                return defer.fail(
-                    IterationError("No nodes were supplied and no nodes "
-                        + "were found in the routing table"))
-        else:
-            seed_nodes = nodes
-        
+        # Prepare the seed nodes (if no nodes are supplied,
+        # we have to get some from the routing table)
+        seed_nodes = self._get_seed_nodes(target_id, nodes)
+        if seed_nodes is None:
+            return defer.fail(
+                IterationError("No nodes were supplied and no nodes "
+                    + "were found in the routing table"))
+
         # Don't send duplicate queries
         seed_nodes = set(seed_nodes)
 
@@ -138,8 +361,9 @@ class KRPC_Iterator(KRPC_Responder):
             deferreds.append(d)
 
         # Create a meta-object that fires when
-        # all deferred results fire
-        dl = defer.DeferredList(deferreds)
+        # all deferred results fire (failures are passed on in the
+        # results, so they must not be left unhandled in the deferreds)
+        dl = defer.DeferredList(deferreds, consumeErrors=True)
         # Make sure atleast one query succeeds
         # and collect the resulting nodes/peers
         dl.addCallback(self._check_query_success_callback)
@@ -3,8 +3,11 @@ This module encapsulates a twisted protocol encapsulating the core DHT
 node functionality.
 
 """
+import os
 import time
+import hmac
 import random
+import socket
 import hashlib
 
 from collections import deque
@@ -18,6 +21,7 @@ from dhtbot.krpc_types import Query
 from dhtbot.datastore import MemoryDataStore
 from dhtbot.protocols.krpc_sender import KRPC_Sender, IKRPC_Sender
 from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.kademlia.node_cache import ClosestNodesCache
 
 class IKRPC_Responder(IKRPC_Sender):
     """
@@ -88,6 +92,22 @@ class IKRPC_Responder(IKRPC_Sender):
 
         """
 
+    def sample_infohashes_Received(self, query, address):
+        """
+        This method is called when a sample_infohashes Query has been received.
+
+        Override this method if you want to handle incoming
+        sample_infohashes queries. This implementation responds with
+        the closest nodes to the target and a random sample of the
+        infohashes in our datastore
+
+        @param query: the sample_infohashes query that has been received
+                      (this query has a .rpctype of "sample_infohashes")
+        @address: the address from which this query originated
+        @see BEP 51 (DHT Infohash Indexing)
+
+        """
+
     def ping(self, address, timeout=None):
         """
         Send a ping query to the given address
@@ -138,6 +158,19 @@ class IKRPC_Responder(IKRPC_Sender):
 
         """
 
+    def sample_infohashes(self, address, target_id, timeout=None):
+        """
+        Send a sample_infohashes query to the given address
+
+        @param target_id: the ID whose closest nodes should be returned
+            alongside the sample (used to walk the network)
+        @param address, timeout: @see the arguments in
+            dhtbot.protocols.krpc_sender.KRPC_Sender.sendQuery
+        @returns a Deferred firing with a Response carrying
+            .samples, .num, .interval, and .nodes
+
+        """
+
 class KRPC_Responder(KRPC_Sender):
 
     implements(IKRPC_Responder)
@@ -152,6 +185,8 @@ class KRPC_Responder(KRPC_Sender):
         # Datastore is used for storing peers on torrents
         self._datastore = MemoryDataStore(self._reactor)
         self._token_generator = _TokenGenerator()
+        # Closest nodes (already encoded) for responding to queries
+        self.closest_nodes_cache = ClosestNodesCache(self.routing_table)
 
     def ping_Received(self, query, address):
         # The ping response needs no additional protocol
@@ -166,7 +201,8 @@ class KRPC_Responder(KRPC_Sender):
         if target_node is not None:
             nodes = [target_node]
         else:
-            nodes = self.routing_table.get_closest_nodes(query.target_id)
+            nodes = self.closest_nodes_cache.get_closest_nodes(
+                    query.target_id)
         # Include the nodes in the response
         response = query.build_response(nodes=nodes)
         self.sendResponse(response, address)
@@ -178,7 +214,8 @@ class KRPC_Responder(KRPC_Sender):
         # If we don't, return the closest nodes in our routing table instead
         if len(peers) == 0:
             peers = None
-            nodes = self.routing_table.get_closest_nodes(query.target_id)
+            nodes = self.closest_nodes_cache.get_closest_nodes(
+                    query.target_id)
         # Generate a token that we can recalculate
         # later (upon receiving an announce_peer query
         token = self._token_generator.generate(query, address)
@@ -204,6 +241,14 @@ class KRPC_Responder(KRPC_Sender):
             log.msg("Invalid token/query/querier combination in"
                     " announce_peerReceived")
 
+    def sample_infohashes_Received(self, query, address):
+        nodes = self.closest_nodes_cache.get_closest_nodes(query.target_id)
+        (samples, num) = self._datastore.sample(
+                constants.sample_infohashes_max)
+        response = query.build_response(nodes=nodes, samples=samples,
+                num=num, interval=constants.sample_infohashes_interval)
+        self.sendResponse(response, address)
+
     def ping(self, address, timeout=None):
         timeout = timeout or constants.rpctimeout
         query = Query()
@@ -233,42 +278,53 @@ class KRPC_Responder(KRPC_Sender):
         query.port = port
         return self.sendQuery(query, address, timeout)
 
+    def sample_infohashes(self, address, target_id, timeout=None):
+        timeout = timeout or constants.rpctimeout
+        query = Query()
+        query.rpctype = "sample_infohashes"
+        query.target_id = target_id
+        return self.sendQuery(query, address, timeout)
+
 class _TokenGenerator(object):
     """
     Generate unique tokens in response to get_peers requests
 
     This token generator does not keep track of tokens that have
-    been issued. Rather, this generator deterministically hashes
-    the correct token given the get_peers query and address along
-    with a secret that changes every constants._secret_timeout seconds
+    been issued. Rather, this generator deterministically computes
+    the correct token for the querier's IP address (as suggested by
+    BEP 5) keyed with a secret that changes every
+    constants._secret_timeout seconds. A secret is accepted for
+    constants.token_timeout seconds after it was created
+
+    Tokens are HMACs truncated to constants.tokensize bits and are
+    handed out as (fixed width) byte strings. The HMAC state of every
+    secret is keyed once, when the secret is created, so that
+    generating or verifying a token only hashes the address
 
     """
     def __init__(self, hash_constructor=hashlib.sha1):
         """Use the specified hash constructor for hashing"""
         self.hash_constructor = hash_constructor
-        num_secrets = constants.token_timeout / constants._secret_timeout
-        self.secrets = deque(maxlen=num_secrets)
-        # Set the time to 0 so that the first generate() call
-        # will force an update of the secrets
-        self.last_secret_time = 0
+        self.token_length = constants.tokensize / 8
+        num_secrets = -(-constants.token_timeout //
+                        constants._secret_timeout)
+        # (creation time, keyed hmac) pairs, newest first
+        self.secrets = deque(maxlen=num_secrets + 1)
 
     def generate(self, query, address):
         """
-        Create a hash value for the get_peers/announce_peer query and address
-        
-        @param query: The query to hash
+        Create the token for the given get_peers query and address
+
+        @param query: The query the token is generated for
         @param address: The address of the querying node
-        
-        """
-        # Remove timed out secrets
-        self._prune_secrets()
-        time_since_last_secret = time.time() - self.last_secret_time
-        if (time_since_last_secret >= constants._secret_timeout or
-                len(self.secrets) == 0):
-            self.secrets.appendleft(self._new_secret())
+        @returns the token (a byte string)
 
-        self.last_secret_time = time.time()
-        return self._get_hash(query, address, self.secrets[0])
+        """
+        now = time.time()
+        if (len(self.secrets) == 0 or
+                now - self.secrets[0][0] >= constants._secret_timeout):
+            self.secrets.appendleft((now, self._new_secret()))
+        return self._get_hash(address, self.secrets[0][1])
 
     def verify(self, query, address, token):
         """
@@ -278,44 +334,29 @@ class _TokenGenerator(object):
         is valid and should be accepted
 
         """
-        self._prune_secrets()
-        for secret in self.secrets:
-            hashed_token = self._get_hash(query, address, secret)
-            if hashed_token == token:
+        if not isinstance(token, str) or len(token) != self.token_length:
+            return False
+        self._prune_secrets(time.time())
+        for (created, keyed_hmac) in self.secrets:
+            if self._get_hash(address, keyed_hmac) == token:
                 return True
         return False
 
-    def _get_hash(self, query, address, secret):
-        """
-        Create the hash code for the given query/address/secret combination
-        """
-        node_id = query._from
-        infohash = query.target_id
-        hash = self.hash_constructor()
-        # The hash code relies on the querying node's ID,
-        # the target infohash of the query, the address of
-        # the querier, and a secret that changes every
-        # constants._secret_timeout seconds
-        hash.update(basic_coder.encode_network_id(node_id))
-        hash.update(basic_coder.encode_network_id(infohash))
-        hash.update(basic_coder.encode_address(address))
-        hash.update(secret)
-        # Return the hash as a number rather than a string
-        numeric_hash_value = basic_coder.btol(hash.digest())
-        return numeric_hash_value
+    def _get_hash(self, address, keyed_hmac):
+        """Create the token for the given address and (keyed) secret"""
+        (ip, port) = address
+        token_hmac = keyed_hmac.copy()
+        token_hmac.update(socket.inet_aton(ip))
+        return token_hmac.digest()[:self.token_length]
 
     def _new_secret(self):
-        """Generate a random number of size atleast that of the digest"""
+        """Returns an HMAC keyed with a new random secret"""
         hash = self.hash_constructor()
-        secret_size = hash.digest_size
-        # Digest size is in bytes
-        return str(random.getrandbits(secret_size * 8))
+        secret = os.urandom(hash.digest_size)
+        return hmac.new(secret, digestmod=self.hash_constructor)
 
-    def _prune_secrets(self):
+    def _prune_secrets(self, now):
         """Remove all secrets that are older than a token timeout"""
-        time_since_last_secret = time.time() - self.last_secret_time
-        num_stale_secrets = long(round(time_since_last_secret /
-                                       constants.token_timeout))
-        while (num_stale_secrets > 0) and (len(self.secrets) > 0):
-            num_stale_secrets -= 1
+        while (len(self.secrets) > 0 and
+                now - self.secrets[-1][0] >= constants.token_timeout):
             self.secrets.pop()
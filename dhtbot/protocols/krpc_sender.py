@@ -6,11 +6,13 @@ sending and receiving KRPC Queries, Requests, and Errors. This protocol
 is written with the Twisted Network framework
 
 """
+import time
 import random
 from collections import defaultdict
 
 from zope.interface import implements, Interface
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.internet import reactor, defer, protocol
 from twisted.python.components import proxyForInterface
 from twisted.internet.interfaces import IUDPTransport
@@ -20,7 +22,9 @@ from dhtbot.kademlia import routing_table
 from dhtbot.coding import krpc_coder
 from dhtbot.coding.krpc_coder import InvalidKRPCError
 from dhtbot.krpc_types import Query, Response, Error
+from dhtbot.metrics import KRPC_Metrics
 from dhtbot.transaction import Transaction
+from dhtbot.protocols.query_window import QueryWindow
 from dhtbot.protocols.errors import TimeoutError, KRPCError 
 
 class IKRPC_Sender(Interface):
@@ -50,6 +54,20 @@ class IKRPC_Sender(Interface):
 
         """
 
+    def parsedReceived(self, parsed, address):
+        """
+        This method is called with every datagram that could be bdecoded
+
+        Replies that match no outstanding query are dropped, and every
+        other krpc is decoded and passed onto krpcReceived. Patchers
+        that have already parsed a datagram (ie: to prioritize it) should
+        pass it on through this method, so that it is not parsed twice
+
+        @param parsed: the result of dhtbot.coding.krpc_coder.parse
+        @param address: the origin of the datagram
+
+        """
+
     def krpcReceived(self, krpc, address):
         """
         This method is called when a properly decoded krpc needs processing
@@ -77,8 +95,45 @@ class IKRPC_Sender(Interface):
             find_node_Received
             get_peers_Received
             announce_peer_Received
-        for further processing. If these functions cannot be found,
-        nothing is done
+        (or any handler registered through registerQueryHandler)
+        for further processing. If no handler can be found, the
+        query is counted in unknown_query_counts and nothing else is done
+
+        """
+
+    def registerQueryHandler(self, rpctype, handler):
+        """
+        Register a handler for incoming queries of the given rpctype
+
+        This is the extension point for query types that are not
+        part of BEP 5 (for example sample_infohashes, or get/put).
+        A registered handler takes precedence over a
+        "RPCTYPE_Received" method of the same name
+
+        Handlers are looked up in a dispatch table rather than with a
+        getattr per datagram: the "RPCTYPE_Received", responseReceived
+        and errorReceived methods are bound when the protocol starts
+        (or upon the first krpc received). Registering a handler
+        rebuilds the table, but a handler method that is otherwise
+        assigned to (or patched onto) a started protocol is not seen;
+        register it here instead
+
+        @param rpctype: the rpctype (ie: "sample_infohashes") to handle
+        @param handler: a callable taking (query, address)
+
+        """
+
+    def registerKRPCObserver(self, observer):
+        """
+        Register an observer of every krpc that is received
+
+        Observers are called (in the order they were registered) by
+        krpcReceived, before the krpc is dispatched. Patchers that need
+        to look at incoming krpcs should register an observer rather
+        than decode datagrams themselves, so that every datagram is
+        still bdecoded and decoded (at most) once, by the protocol
+
+        @param observer: a callable taking (krpc, address)
 
         """
 
@@ -111,12 +166,42 @@ class IKRPC_Sender(Interface):
         Encode the given krpc and send it to the given address
 
         If the given krpc is invalid, an exception will be thrown
-        in the encoding process
+        in the encoding process. The encoded packet is passed
+        onto sendEncoded
 
         @raises dhtbot.coding.krpc_coder.InvalidKRPCError
 
         """
 
+    def sendEncoded(self, packet, address):
+        """
+        Send an already encoded krpc to the given address
+
+        This is the last step of every send: the packet is passed
+        through every send filter (@see registerSendFilter) and
+        written to the transport, unless a filter drops it
+
+        @param packet: the encoded krpc (a string)
+
+        """
+
+    def registerSendFilter(self, send_filter):
+        """
+        Register a filter of every packet that is sent
+
+        Filters are called (in the order they were registered) by
+        sendEncoded, and so see every krpc the protocol sends itself
+        (queries, responses and errors alike) exactly once encoded.
+        Patchers that need to look at outgoing packets (ie: to measure
+        their size) should register a filter rather than override
+        sendKRPC or sendEncoded, which the protocol does not call
+        through the patcher
+
+        @param send_filter: a callable taking (packet, address) and
+            returning whether the packet may be sent
+
+        """
+
     def sendQuery(self, query, address, timeout=None):
         """
         Sends the given krpc query to the given address with the given timeout
@@ -127,6 +212,18 @@ class IKRPC_Sender(Interface):
             will be accepted to this query. If timeout is None,
             the default value of dhtbot.constants.rpctimeout will be used
 
+        Identical ping/find_node/get_peers queries (same rpctype,
+        target_id and address) that are already in flight are not sent
+        again: the caller shares the result of the outstanding query
+        (the Response object itself is shared between the callers)
+
+        If the query window (@see query_window.QueryWindow) is full,
+        the query waits in a FIFO queue and is sent once enough
+        outstanding transactions complete. The timeout restarts once
+        the query has actually been sent, while a query that waits
+        for longer than the timeout fails with a TimeoutError
+        without ever being sent
+
         @see krpc_types.Response
         @see krpc_types.Error
         @see protocols.errors.KRPCError
@@ -176,11 +273,45 @@ class KRPC_Sender(protocol.DatagramProtocol):
 
     implements(IKRPC_Sender)
 
+    # Queries that have no side effects on the queried node, and
+    # so can be shared between callers while they are in flight
+    _coalescable_rpctypes = frozenset(["ping", "find_node", "get_peers",
+                                       "sample_infohashes"])
+
     def __init__(self, routing_table_class, node_id):
         self._reactor = reactor
         self.node_id = long(node_id)
         self._transactions = dict()
         self.routing_table = routing_table_class(self.node_id)
+        # Limits the number of outstanding queries
+        self.query_window = QueryWindow(reactor=self._reactor)
+        # Maps (rpctype, target_id, address) of an in-flight query
+        # onto the deferreds of the callers sharing its result
+        self._coalesced_queries = dict()
+        self.coalesced_query_count = 0
+        # Dispatch tables used on the receive path. They are
+        # built (@see _build_dispatch_table) when the protocol
+        # starts, or lazily upon receiving the first krpc (after
+        # the protocol was created or a query handler registered)
+        self._query_handlers = None
+        self._reply_handlers = None
+        self._extension_handlers = dict()
+        # @see registerKRPCObserver
+        self._krpc_observers = []
+        # @see registerSendFilter
+        self._send_filters = []
+        # Counters for krpcs that no handler could be found for
+        self.unknown_query_counts = defaultdict(int)
+        self.unknown_krpc_count = 0
+        # Counter for replies dropped for matching no outstanding query
+        self.dropped_reply_count = 0
+        # Counters and round trip time histograms per rpctype
+        # (None when metrics are disabled, @see dhtbot.metrics)
+        self.metrics = (KRPC_Metrics() if constants.metrics_enabled
+                        else None)
+
+    def startProtocol(self):
+        self._build_dispatch_table()
 
     def datagramReceived(self, data, address):
         """
@@ -190,36 +321,88 @@ class KRPC_Sender(protocol.DatagramProtocol):
         it is passed onto self.krpcReceived for further processing, otherwise
         the encoding exception is captured and logged
 
-        @see krpcReceived
+        The datagram is bdecoded once (@see krpc_coder.parse). Replies
+        (responses and errors) that do not match an outstanding query
+        sent to the address they came from (most often replies to
+        queries that already timed out) are then counted in
+        dropped_reply_count and dropped without being decoded any further
+
+        @see parsedReceived
+        @see dhtbot.coding.krpc_coder.decode_parsed
 
         """
         try:
-            krpc = krpc_coder.decode(data)
+            parsed = krpc_coder.parse(data)
+        except InvalidKRPCError:
+            self._malformedPacketReceived(address)
+            return
+        self.parsedReceived(parsed, address)
+
+    def parsedReceived(self, parsed, address):
+        (msgtype, transaction_id, rpc_dict) = parsed
+        if msgtype != 'q':
+            transaction = self._transactions.get(transaction_id, None)
+            if transaction is None or transaction.address != address:
+                self.dropped_reply_count += 1
+                if self.metrics is not None:
+                    self.metrics.orphaned_reply()
+                return
+        try:
+            krpc = krpc_coder.decode_parsed(parsed)
         except InvalidKRPCError:
-            log.msg("Malformed packet received from %s:%d" % address)
+            self._malformedPacketReceived(address)
             return
         self.krpcReceived(krpc, address)
 
+    def _malformedPacketReceived(self, address):
+        if self.metrics is not None:
+            self.metrics.malformed_packet()
+        log.msg("Malformed packet received from %s:%d" % address)
+
     def krpcReceived(self, krpc, address):
-        if isinstance(krpc, Query):
+        for observer in self._krpc_observers:
+            observer(krpc, address)
+        if self._reply_handlers is None:
+            self._build_dispatch_table()
+        krpc_class = krpc.__class__
+        if krpc_class is Query:
             self.queryReceived(krpc, address)
+            return
+        reply_handler = self._reply_handlers.get(krpc_class, None)
+        if reply_handler is None:
+            self.unknown_krpc_count += 1
+            return
+        transaction = self._transactions.get(krpc._transaction_id, None)
+        if transaction is not None and transaction.address == address:
+            reply_handler(krpc, transaction, address)
         else:
-            transaction = self._transactions.get(krpc._transaction_id, None)
-            if transaction is not None:
-                if isinstance(krpc, Response):
-                    self.responseReceived(krpc, transaction, address)
-                elif isinstance(krpc, Error):
-                    self.errorReceived(krpc, transaction, address)
-            else:
-                log.msg("Received a reply not corresponding to an" +
-                        " outstanding query from: %s, reply: %s" % (
-                        contact.address_str(address), str(krpc)))
+            self.dropped_reply_count += 1
+            if self.metrics is not None:
+                self.metrics.orphaned_reply()
+            log.msg("Received a reply not corresponding to an" +
+                    " outstanding query from: %s, reply: %s" % (
+                    contact.address_str(address), str(krpc)))
 
     def queryReceived(self, query, address):
-        method_name = "%s_Received" % query.rpctype
-        dispatcher = getattr(self, method_name, None)
-        if dispatcher is not None:
-            dispatcher(query, address)
+        if self.metrics is not None:
+            self.metrics.query_received(query.rpctype)
+        if self._query_handlers is None:
+            self._build_dispatch_table()
+        handler = self._query_handlers.get(query.rpctype, None)
+        if handler is not None:
+            handler(query, address)
+        else:
+            self.unknown_query_counts[query.rpctype] += 1
+
+    def registerQueryHandler(self, rpctype, handler):
+        self._extension_handlers[rpctype] = handler
+        if self._query_handlers is not None:
+            # Rebind every handler (upon the next krpc received)
+            self._query_handlers = None
+            self._reply_handlers = None
+
+    def registerKRPCObserver(self, observer):
+        self._krpc_observers.append(observer)
 
     def responseReceived(self, response, transaction, address):
         transaction.deferred.callback(response)
@@ -229,9 +412,69 @@ class KRPC_Sender(protocol.DatagramProtocol):
 
     def sendKRPC(self, krpc, address):
         encoded_packet = krpc_coder.encode(krpc)
-        self.transport.write(encoded_packet, address)
+        self.sendEncoded(encoded_packet, address)
+
+    def sendEncoded(self, packet, address):
+        for send_filter in self._send_filters:
+            if not send_filter(packet, address):
+                return
+        self.transport.write(packet, address)
+
+    def registerSendFilter(self, send_filter):
+        self._send_filters.append(send_filter)
 
     def sendQuery(self, query, address, timeout):
+        if query.rpctype not in self._coalescable_rpctypes:
+            return self._admitQuery(query, address, timeout)
+
+        key = (query.rpctype, query.target_id, address)
+        waiting = self._coalesced_queries.get(key, None)
+        if waiting is not None:
+            # An identical query is already in flight, wait on its result
+            self.coalesced_query_count += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        waiting = self._coalesced_queries[key] = []
+        d = self._admitQuery(query, address, timeout)
+        d.addBoth(self._fan_out_bothback, key, waiting)
+        return d
+
+    def _fan_out_bothback(self, result, key, waiting):
+        """Pass the result of a query onto every caller that shared it"""
+        if self._coalesced_queries.get(key, None) is waiting:
+            del self._coalesced_queries[key]
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def _admitQuery(self, query, address, timeout):
+        """Send the query or wait for room in the query window"""
+        if not self.query_window.admit(address):
+            d = defer.Deferred()
+            wait_timeout = (timeout if timeout is not None
+                            else constants.rpctimeout)
+            self.query_window.enqueue(address, wait_timeout,
+                                      self._expire_queued_query,
+                                      self._send_queued_query,
+                                      query, address, timeout, d)
+            return d
+        return self._sendQuery(query, address, timeout)
+
+    def _send_queued_query(self, query, address, timeout, deferred):
+        """Send a query released from the query window"""
+        self._sendQuery(query, address, timeout).chainDeferred(deferred)
+
+    def _expire_queued_query(self, query, address, timeout, deferred):
+        """Fail a query that found no room in the query window in time"""
+        deferred.errback(TimeoutError())
+
+    def _sendQuery(self, query, address, timeout):
+        """@see sendQuery"""
         # Fill in the "from" field of the query
         query._from = self.node_id
         query._transaction_id = self._generate_transaction_id()
@@ -241,6 +484,8 @@ class KRPC_Sender(protocol.DatagramProtocol):
             self.sendKRPC(query, address)
         except InvalidKRPCError as encoding_error:
             return defer.fail(encoding_error)
+        if self.metrics is not None:
+            self.metrics.query_sent(query.rpctype)
 
         # Record this transaction so that later the original
         # query may be referenced when a response/error is received
@@ -254,10 +499,13 @@ class KRPC_Sender(protocol.DatagramProtocol):
         t.deferred.addErrback(self._query_failure_errback, address, t)
         # Set up a timeout during which this transaction
         # has to complete (ie: receive a response or error)
-        t.timeout_call = self._reactor.callLater(constants.rpctimeout,
+        if timeout is None:
+            timeout = constants.rpctimeout
+        t.timeout_call = self._reactor.callLater(timeout,
                                 t.deferred.errback, TimeoutError())
         # Store this transaction
         self._transactions[query._transaction_id] = t
+        self.query_window.acquire(address)
         # Add a callback that removes this transaction
         # after it has been processed
         t.deferred.addBoth(self._remove_transaction_bothback, t)
@@ -280,6 +528,9 @@ class KRPC_Sender(protocol.DatagramProtocol):
         and makes sures it is in the routing table)
 
         """
+        if self.metrics is not None:
+            self.metrics.response_received(transaction.query.rpctype,
+                                           time.time() - transaction.time)
         # Pull the node corresponding to this response out
         # of our routing table, or create it if it doesn't exist
         rt_node = self.routing_table.get_node(response._from)
@@ -303,12 +554,19 @@ class KRPC_Sender(protocol.DatagramProtocol):
         # Only enter this code block if the error
         # is either a TimeoutError or a KRPCError
         f = failure.trap(TimeoutError, KRPCError)
+        if self.metrics is not None:
+            if f == TimeoutError:
+                self.metrics.timed_out(transaction.query.rpctype)
+            else:
+                self.metrics.error_received(transaction.query.rpctype)
 
         errornodes = self.routing_table.get_node_by_address(address)
         if errornodes is None:
             return failure
 
-        for errornode in errornodes:
+        # Iterate over a copy, as removing a node from the routing
+        # table also removes it from the set we were given
+        for errornode in list(errornodes):
             if f == TimeoutError:
                 # TODO multi-factor eviction (freshness is good,
                 # but what about (ie) number of failed queries?)
@@ -334,8 +592,32 @@ class KRPC_Sender(protocol.DatagramProtocol):
         if transaction.timeout_call.active():
             transaction.timeout_call.cancel()
 
+        # Make room for any queries waiting to be sent
+        self.query_window.release(transaction.address)
         return result
 
+    def _build_dispatch_table(self):
+        """
+        Map every rpctype and reply type onto its bound handler
+
+        Every method named "RPCTYPE_Received" found on this protocol
+        (including those defined by subclasses) handles queries of
+        that RPCTYPE. Handlers added through registerQueryHandler
+        are layered on top
+
+        """
+        query_handlers = dict()
+        suffix = "_Received"
+        for name in dir(self):
+            if name.endswith(suffix) and len(name) > len(suffix):
+                handler = getattr(self, name)
+                if callable(handler):
+                    query_handlers[name[:-len(suffix)]] = handler
+        query_handlers.update(self._extension_handlers)
+        self._query_handlers = query_handlers
+        self._reply_handlers = {Response: self.responseReceived,
+                                Error: self.errorReceived}
+
     def _generate_transaction_id(self):
         """
         Generate a transaction_id unique to our transaction table
@@ -0,0 +1,401 @@
+"""
+An iterative, alpha-parallel Kademlia lookup
+
+@see references/kademlia.pdf section 2.3
+@see references/subsecond.pdf
+
+"""
+import time
+import bisect
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.python import log
+
+from dhtbot import constants
+from dhtbot.coding.krpc_coder import InvalidKRPCError
+from dhtbot.protocols.errors import TimeoutError, KRPCError
+
+# States of a node in the lookup shortlist
+_CANDIDATE = 0
+_IN_FLIGHT = 1
+_RESPONDED = 2
+_FAILED = 3
+
+class LookupStats(object):
+    """
+    Statistics collected over the course of a single lookup
+
+    rounds: the number of hops the lookup took (the seed nodes
+        are the first hop, the nodes they return the second, ...)
+    queries: the number of queries that were sent
+    responses: the number of queries that received a response
+    failures: the number of queries that timed out or returned an error
+    start_time: the time the lookup was started
+    end_time: the time the lookup finished (None while it is running)
+
+    """
+    def __init__(self):
+        self.rounds = 0
+        self.queries = 0
+        self.responses = 0
+        self.failures = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def elapsed(self):
+        """Returns the time the lookup took (or has taken so far)"""
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self.start_time
+
+    def __repr__(self):
+        return ("<LookupStats: rounds=%d queries=%d responses=%d "
+                "failures=%d elapsed=%f>" % (self.rounds, self.queries,
+                self.responses, self.failures, self.elapsed()))
+
+class IterativeLookup(object):
+    """
+    Converge on the k nodes closest to a target ID
+
+    The lookup keeps a shortlist of every node it has heard of, ordered
+    by XOR distance to the target. At most `alpha` queries are in flight
+    at a time, and they are always sent to the closest nodes that have
+    not been queried yet. Every response adds its nodes to the shortlist
+    (and its peers and token to the results). The lookup terminates once
+    the k closest nodes that have not failed have all responded, when
+    there is nobody left to query, or after constants.query_timeout
+
+    Results can also be streamed: if a listener is given, it is called
+    as listener(lookup, new_nodes, new_peers) after every response
+    with the nodes and peers that the response added. The listener
+    (or anyone else) can end the lookup early by calling stop(). The
+    lookup also stops by itself once it has collected max_peers peers.
+    Likewise, if a sample_listener is given it is called as
+    sample_listener(lookup, new_samples) with the infohashes
+    that every sample_infohashes response added
+
+    After the lookup finishes, the following attributes are available
+        peers: a set of all the peers that were returned
+        samples: a set of all the infohashes that were returned
+            by sample_infohashes queries
+        tokens: a dictionary mapping the node_id of every node that
+            returned a token onto that token
+        stats: @see LookupStats
+        partial: True if the lookup was ended early by stop() (or by
+            reaching max_peers) rather than by converging or timing out
+
+    @param query_func: find_node, get_peers, or sample_infohashes
+        (as found on KRPC_Responder)
+    @param target_id: the ID the lookup converges on
+    @param seed_nodes: the nodes to start the lookup from
+    @param own_id: the node_id of the local node (it is never queried)
+    @param timeout: the per-query timeout passed onto query_func
+    @param reactor: used to time out the entire lookup (if None,
+        the lookup can only end by converging)
+    @param listener: called with every response's new nodes/peers
+    @param max_peers: stop as soon as this many peers have been found
+    @param sample_listener: called with every response's new samples
+
+    """
+    def __init__(self, query_func, target_id, seed_nodes, own_id=None,
+                 timeout=None, reactor=None, alpha=constants.alpha,
+                 k=constants.k, listener=None, max_peers=None,
+                 sample_listener=None):
+        self.query_func = query_func
+        self.target_id = target_id
+        self.own_id = own_id
+        self.timeout = timeout
+        self.alpha = alpha
+        self.k = k
+        self.listener = listener
+        self.max_peers = max_peers
+        self.sample_listener = sample_listener
+        self.peers = set()
+        self.samples = set()
+        self.tokens = dict()
+        self.stats = LookupStats()
+        self.deferred = defer.Deferred()
+        self.finished = False
+        self.partial = False
+        # node_id -> node, for every node that we have heard of
+        self._nodes = dict()
+        self._states = dict()
+        self._depths = dict()
+        # (distance, node_id) tuples, ordered by distance to the target
+        self._shortlist = []
+        self._in_flight = 0
+        self._reactor = reactor
+        self._timeout_call = None
+        self._seed_nodes = seed_nodes
+
+    def start(self):
+        """
+        Start sending queries
+
+        @returns a deferred that fires with this lookup once it finishes
+
+        """
+        for node in self._seed_nodes:
+            self._add_node(node, 1)
+        if self._reactor is not None:
+            self._timeout_call = self._reactor.callLater(
+                    constants.query_timeout, self._finish)
+        self._advance()
+        return self.deferred
+
+    def stop(self):
+        """
+        End the lookup now
+
+        Queries that are still in flight are ignored when they return,
+        and the deferred returned by start() fires with this lookup
+        (which is then marked as partial)
+
+        """
+        if not self.finished:
+            self.partial = True
+        self._finish()
+
+    def closest_nodes(self):
+        """
+        Returns the k closest nodes that have responded
+
+        The nodes are ordered by their distance to the target ID
+
+        """
+        closest = []
+        for (distance, node_id) in self._shortlist:
+            if self._states[node_id] == _RESPONDED:
+                closest.append(self._nodes[node_id])
+                if len(closest) == self.k:
+                    break
+        return closest
+
+    def nodes(self):
+        """Returns a set of every node that was learned of in the lookup"""
+        return set(self._nodes.itervalues())
+
+    def _add_node(self, node, depth):
+        """Put a node onto the shortlist (if we haven't seen it already)"""
+        node_id = node.node_id
+        if node_id == self.own_id or node_id in self._nodes:
+            return False
+        self._nodes[node_id] = node
+        self._states[node_id] = _CANDIDATE
+        self._depths[node_id] = depth
+        bisect.insort(self._shortlist, (node_id ^ self.target_id, node_id))
+        return True
+
+    def _advance(self):
+        """Keep `alpha` queries in flight until the lookup converges"""
+        if self.finished:
+            return
+        # Walk the k closest nodes that have not failed: query the
+        # candidates among them and check whether every one of them
+        # has already responded
+        converged = True
+        to_query = []
+        free_slots = self.alpha - self._in_flight
+        seen = 0
+        for (distance, node_id) in self._shortlist:
+            if seen == self.k:
+                break
+            state = self._states[node_id]
+            if state == _FAILED:
+                continue
+            seen += 1
+            if state == _RESPONDED:
+                continue
+            converged = False
+            if state == _CANDIDATE and len(to_query) < free_slots:
+                to_query.append(self._nodes[node_id])
+        if converged:
+            self._finish()
+            return
+        # Responses may arrive synchronously (and advance the
+        # lookup themselves), so recheck each node before querying it
+        for node in to_query:
+            if self.finished:
+                return
+            if (self._states[node.node_id] == _CANDIDATE and
+                    self._in_flight < self.alpha):
+                self._query(node)
+        if self._in_flight == 0:
+            self._finish()
+
+    def _query(self, node):
+        self._states[node.node_id] = _IN_FLIGHT
+        self._in_flight += 1
+        self.stats.queries += 1
+        depth = self._depths[node.node_id]
+        self.stats.rounds = max(self.stats.rounds, depth)
+        d = self.query_func(node.address, self.target_id, self.timeout)
+        d.addCallbacks(self._response_callback, self._failure_errback,
+                       callbackArgs=(node,), errbackArgs=(node,))
+
+    def _response_callback(self, response, node):
+        self._in_flight -= 1
+        if self.finished:
+            return
+        self._states[node.node_id] = _RESPONDED
+        self.stats.responses += 1
+        try:
+            self._handle_response(response, node)
+        finally:
+            # Keep the lookup going whatever went wrong with the response
+            self._advance()
+
+    def _handle_response(self, response, node):
+        """Collect (and stream) the nodes, peers, token, and samples"""
+        depth = self._depths[node.node_id] + 1
+        new_nodes = []
+        new_peers = []
+        if response.nodes is not None:
+            for new_node in response.nodes:
+                if self._add_node(new_node, depth):
+                    new_nodes.append(new_node)
+        if response.peers is not None:
+            for peer in response.peers:
+                if peer not in self.peers:
+                    self.peers.add(peer)
+                    new_peers.append(peer)
+        if response.token is not None:
+            self.tokens[node.node_id] = response.token
+        if response.samples is not None:
+            new_samples = [sample for sample in response.samples
+                           if sample not in self.samples]
+            self.samples.update(new_samples)
+            if self.sample_listener is not None and new_samples:
+                self._notify(self.sample_listener, new_samples)
+        if self.listener is not None and (new_nodes or new_peers):
+            self._notify(self.listener, new_nodes, new_peers)
+        if self.max_peers is not None and len(self.peers) >= self.max_peers:
+            self.stop()
+
+    def _notify(self, listener, *args):
+        """Call a listener (its errors are logged, not raised)"""
+        try:
+            listener(self, *args)
+        except Exception:
+            log.err(None, "A lookup listener raised an exception")
+
+    def _failure_errback(self, failure, node):
+        # Any failure frees the slot and fails the node (so that the
+        # lookup moves on), but unexpected ones are passed on
+        self._in_flight -= 1
+        if not self.finished:
+            self._states[node.node_id] = _FAILED
+            self.stats.failures += 1
+            self._advance()
+        failure.trap(TimeoutError, KRPCError, InvalidKRPCError)
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.stats.end_time = time.time()
+        if self._timeout_call is not None and self._timeout_call.active():
+            self._timeout_call.cancel()
+        self.deferred.callback(self)
+
+class CachedLookup(object):
+    """
+    The remembered result of a finished lookup
+
+    A CachedLookup exposes the same results as the IterativeLookup it
+    was made from (peers, tokens, stats, closest_nodes() and nodes()),
+    but only holds onto the k closest nodes that responded
+
+    time: the time at which the original lookup finished
+
+    """
+    def __init__(self, lookup):
+        self.target_id = lookup.target_id
+        self.peers = set(lookup.peers)
+        self._closest_nodes = lookup.closest_nodes()
+        # Only the tokens of the closest nodes are useful later on
+        self.tokens = dict((node.node_id, lookup.tokens[node.node_id])
+                           for node in self._closest_nodes
+                           if node.node_id in lookup.tokens)
+        self.stats = lookup.stats
+        self.finished = True
+        self.time = time.time()
+
+    def closest_nodes(self):
+        return list(self._closest_nodes)
+
+    def nodes(self):
+        return set(self._closest_nodes)
+
+class LookupCache(object):
+    """
+    Remember the results of recent lookups, keyed by target ID
+
+    Entries expire `timeout` seconds after they were stored, and the
+    least recently used entry is evicted once more than `max_size`
+    targets are cached. Hits and misses are counted in the
+    hits and misses attributes
+
+    @see dhtbot.constants.lookup_cache_size
+    @see dhtbot.constants.lookup_cache_timeout
+
+    """
+    def __init__(self, max_size=None, timeout=None):
+        if max_size is None:
+            max_size = constants.lookup_cache_size
+        if timeout is None:
+            timeout = constants.lookup_cache_timeout
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, target_id):
+        """
+        Returns the CachedLookup for the target_id (or None)
+
+        Expired entries are removed rather than returned
+
+        """
+        entry = self._entries.pop(target_id, None)
+        if entry is not None and time.time() - entry.time < self.timeout:
+            # Reinsert the entry to mark it as the most recently used
+            self._entries[target_id] = entry
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, lookup):
+        """
+        Remember the results of the given finished lookup
+
+        The lookup replaces any existing entry for the same target,
+        so that nothing outlives the timeout of the lookup it was
+        found by. Partial lookups (@see IterativeLookup.partial)
+        did not converge on the closest nodes and are not remembered
+
+        @returns the CachedLookup (or None for a partial lookup)
+
+        """
+        if lookup.partial:
+            return None
+        entry = CachedLookup(lookup)
+        self._entries.pop(lookup.target_id, None)
+        self._entries[lookup.target_id] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def hit_rate(self):
+        """Returns the fraction of get() calls that were hits"""
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return float(self.hits) / total
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,207 @@
+"""
+Admission control for outbound queries
+
+A QueryWindow bounds how many queries a KRPC_Sender keeps outstanding,
+both globally and per destination address. Queries that do not fit
+into the window wait in a queue per address and are released (oldest
+first) as outstanding transactions complete. Queries that wait longer
+than their timeout are given up on
+
+"""
+import time
+import heapq
+from collections import deque, defaultdict
+
+from dhtbot import constants
+
+class _WaitingQuery(object):
+    """A query waiting for room in a QueryWindow"""
+    __slots__ = ('sequence', 'enqueue_time', 'address', 'func',
+                 'expired', 'args', 'timeout_call')
+
+    def __init__(self, sequence, enqueue_time, address, func, expired,
+                 args):
+        self.sequence = sequence
+        self.enqueue_time = enqueue_time
+        self.address = address
+        self.func = func
+        self.expired = expired
+        self.args = args
+        self.timeout_call = None
+
+class QueryWindow(object):
+    """
+    Keep track of in-flight queries and the queries waiting to be sent
+
+    @param max_outstanding: the maximum number of queries that can be
+        in flight at once (defaults to constants.max_outstanding_queries)
+    @param max_outstanding_per_host: the maximum number of queries that
+        can be in flight to any single address (defaults to
+        constants.max_outstanding_queries_per_host)
+    @param reactor: the reactor used to time waiting queries out
+
+    Statistics (useful for tuning the limits):
+        outstanding: the number of queries currently in flight
+        max_queue_depth: the largest the wait queue has ever been
+        total_queued: the number of queries that had to wait
+        total_released: the number of waiting queries that were sent
+        total_expired: the number of waiting queries that timed out
+        total_wait_time: the sum of the time every waiting query
+            spent in the queue (seconds)
+        max_wait_time: the longest time a query spent in the queue
+
+    @see dhtbot.constants.max_outstanding_queries
+    @see dhtbot.constants.max_outstanding_queries_per_host
+
+    """
+    def __init__(self, max_outstanding=None, max_outstanding_per_host=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        if max_outstanding is None:
+            max_outstanding = constants.max_outstanding_queries
+        if max_outstanding_per_host is None:
+            max_outstanding_per_host = \
+                    constants.max_outstanding_queries_per_host
+        self.max_outstanding = max_outstanding
+        self.max_outstanding_per_host = max_outstanding_per_host
+        self.outstanding = 0
+        self._outstanding_by_addr = defaultdict(int)
+        # address -> deque of the _WaitingQuery's to that address
+        # (oldest first)
+        self._queues = dict()
+        # (sequence number, address) heap of the addresses whose oldest
+        # waiting query fits into the per host window, so that a
+        # release never has to look at queries that can not be sent
+        self._ready = []
+        self._ready_addresses = set()
+        self._sequence = 0
+        self._depth = 0
+        self.max_queue_depth = 0
+        self.total_queued = 0
+        self.total_released = 0
+        self.total_expired = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def admit(self, address):
+        """
+        Tells whether a query to the address can be sent immediately
+
+        A query is only admitted if there is room in the global and
+        the per host window and no query is already waiting on
+        the same address (so that queries to an address stay in order)
+
+        """
+        if address in self._queues:
+            return False
+        return self._has_global_room() and self._has_host_room(address)
+
+    def acquire(self, address):
+        """Record that a query to the given address is now in flight"""
+        self.outstanding += 1
+        self._outstanding_by_addr[address] += 1
+
+    def release(self, address):
+        """
+        Record that a query to the given address has completed
+
+        Waiting queries that now fit into the window are sent
+        (in the order in which they were queued)
+
+        """
+        if self._outstanding_by_addr.get(address, 0) > 0:
+            self.outstanding -= 1
+            self._outstanding_by_addr[address] -= 1
+            if self._outstanding_by_addr[address] == 0:
+                del self._outstanding_by_addr[address]
+        self._mark_ready(address)
+        self._release_waiting()
+
+    def enqueue(self, address, timeout, expired, func, *args):
+        """
+        Wait for room in the window and then call func(*args)
+
+        func is expected to send the query (and call acquire). If
+        there is still no room for the query after `timeout` seconds,
+        it stops waiting and expired(*args) is called instead
+
+        """
+        self._sequence += 1
+        waiting = _WaitingQuery(self._sequence, time.time(), address,
+                                func, expired, args)
+        waiting.timeout_call = self._reactor.callLater(timeout,
+                self._expire, waiting)
+        queue = self._queues.get(address, None)
+        if queue is None:
+            queue = self._queues[address] = deque()
+        queue.append(waiting)
+        self._depth += 1
+        self.total_queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._depth)
+        self._mark_ready(address)
+
+    def queue_depth(self):
+        """Returns the number of queries waiting to be sent"""
+        return self._depth
+
+    def average_wait_time(self):
+        """Returns the average time a queued query waited (seconds)"""
+        if self.total_released == 0:
+            return 0
+        return float(self.total_wait_time) / self.total_released
+
+    def _has_global_room(self):
+        return (self.max_outstanding is None or
+                self.outstanding < self.max_outstanding)
+
+    def _has_host_room(self, address):
+        return (self.max_outstanding_per_host is None or
+                self._outstanding_by_addr.get(address, 0) <
+                self.max_outstanding_per_host)
+
+    def _mark_ready(self, address):
+        """
+        Make the oldest query waiting on address a candidate for release
+        (if it fits into the per host window)
+        """
+        queue = self._queues.get(address, None)
+        if (queue is not None and address not in self._ready_addresses and
+                self._has_host_room(address)):
+            heapq.heappush(self._ready, (queue[0].sequence, address))
+            self._ready_addresses.add(address)
+
+    def _remove(self, waiting):
+        """Take a waiting query off the queue of its address"""
+        queue = self._queues[waiting.address]
+        queue.remove(waiting)
+        if len(queue) == 0:
+            del self._queues[waiting.address]
+        self._depth -= 1
+
+    def _expire(self, waiting):
+        self._remove(waiting)
+        self.total_expired += 1
+        waiting.expired(*waiting.args)
+
+    def _release_waiting(self):
+        """Send the waiting queries that fit into the window (FIFO)"""
+        while len(self._ready) > 0 and self._has_global_room():
+            (sequence, address) = heapq.heappop(self._ready)
+            self._ready_addresses.discard(address)
+            queue = self._queues.get(address, None)
+            # The queue may have emptied (or filled up its per host
+            # window) since the address was marked as ready, in which
+            # case it is marked again once it has room
+            if queue is None or not self._has_host_room(address):
+                continue
+            waiting = queue[0]
+            self._remove(waiting)
+            waiting.timeout_call.cancel()
+            self.total_released += 1
+            wait_time = time.time() - waiting.enqueue_time
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            waiting.func(*waiting.args)
+            self._mark_ready(address)
@@ -0,0 +1,495 @@
+"""
+Deterministic in-process simulation of a DHT network
+
+Thousands of KRPC_Iterator instances are wired to a shared in-memory
+network (instead of sockets) and driven by a virtual clock (instead of
+the twisted reactor), so that lookups can be measured at scale, fully
+offline, and with the same results on every run with the same seed
+
+    >>> simulator = Simulator(num_nodes=1000, seed=5)
+    >>> simulator.start()
+    >>> simulator.bootstrap()
+    >>> d = simulator.lookup(simulator.random_node(), 2**159)
+    >>> lookup = simulator.run_until(d)
+    >>> simulator.stop()
+
+While a simulator is started, dhtbot.protocols.krpc_sender.reactor and
+time.time are patched to follow the virtual clock, and the global
+random module is seeded (node IDs, transaction IDs, and random refresh
+targets all come from it)
+
+@see dhtbot.benchmarks.lookup_simulation
+
+"""
+import time
+import heapq
+import random
+
+from twisted.internet.base import DelayedCall
+from twisted.python.failure import Failure
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot import constants
+from dhtbot.contact import Node
+from dhtbot.coding import krpc_coder
+from dhtbot.protocols import krpc_sender
+from dhtbot.protocols.krpc_iterator import KRPC_Iterator
+
+class VirtualClock(object):
+    """
+    A reactor replacement (as far as time is concerned) for simulations
+
+    Unlike twisted.internet.task.Clock, delayed calls are kept in a heap
+    (so scheduling stays cheap with many thousands of pending calls), and
+    the time is moved to each call's time as it runs, so that callbacks
+    observe the time at which they were scheduled to run
+
+    Statistics:
+        calls_run: the number of delayed calls that have been run
+
+    """
+    def __init__(self):
+        self._now = 0.0
+        # (time, sequence number, DelayedCall) heap. Cancelled or reset
+        # calls are left in the heap and skipped when they come up
+        self._calls = []
+        self._sequence = 0
+        self.calls_run = 0
+
+    def seconds(self):
+        return self._now
+
+    def callLater(self, delay, func, *args, **kwargs):
+        call = DelayedCall(self._now + delay, func, args, kwargs,
+                           self._cancelled, self._reset, self.seconds)
+        self._push(call)
+        return call
+
+    def getDelayedCalls(self):
+        return [call for (when, sequence, call) in self._calls
+                if self._is_pending(when, call)]
+
+    def advance(self, amount):
+        """Run every call scheduled within the next `amount` seconds"""
+        end_time = self._now + amount
+        while self.step(end_time):
+            pass
+        self._now = max(self._now, end_time)
+
+    def step(self, end_time=None):
+        """
+        Run the next pending delayed call (if it is due by end_time)
+
+        @returns whether a call was run
+
+        """
+        while len(self._calls) > 0:
+            (when, sequence, call) = self._calls[0]
+            if end_time is not None and when > end_time:
+                return False
+            heapq.heappop(self._calls)
+            if not self._is_pending(when, call):
+                continue
+            if call.delayed_time:
+                # The call was reset to a later time
+                call.activate_delay()
+                self._push(call)
+                continue
+            self._now = max(self._now, when)
+            call.called = 1
+            self.calls_run += 1
+            call.func(*call.args, **call.kw)
+            return True
+        return False
+
+    def _push(self, call):
+        self._sequence += 1
+        heapq.heappush(self._calls, (call.time, self._sequence, call))
+
+    def _is_pending(self, when, call):
+        return (not call.cancelled and not call.called and
+                call.time == when)
+
+    def _cancelled(self, call):
+        pass
+
+    def _reset(self, call):
+        self._push(call)
+
+
+class NodeClock(object):
+    """
+    A single node's view of a VirtualClock
+
+    The node's delayed calls are kept track of, so that all of them
+    can be cancelled when the node leaves the network (a departed node
+    must not go on timing out queries or running looping calls)
+
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self._pending = set()
+        # Forget about calls that are done once the set doubles in size
+        self._prune_size = 64
+
+    def seconds(self):
+        return self.clock.seconds()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        def run():
+            self._pending.discard(call)
+            func(*args, **kwargs)
+        call = self.clock.callLater(delay, run)
+        self._pending.add(call)
+        if len(self._pending) >= self._prune_size:
+            self._pending = set(self.getDelayedCalls())
+            self._prune_size = max(64, 2 * len(self._pending))
+        return call
+
+    def getDelayedCalls(self):
+        return [call for call in self._pending if call.active()]
+
+    def cancel_all(self):
+        """Cancel every pending call of the node"""
+        for call in self.getDelayedCalls():
+            call.cancel()
+        self._pending.clear()
+
+
+def constant_latency(seconds):
+    """A latency model where every packet takes the same time"""
+    def latency(rng, source, destination):
+        return seconds
+    return latency
+
+def uniform_latency(low, high):
+    """A latency model drawing each packet's latency from [low, high]"""
+    def latency(rng, source, destination):
+        return rng.uniform(low, high)
+    return latency
+
+
+class SimulatedNetwork(object):
+    """
+    An in-memory network that delivers datagrams between protocols
+
+    @param clock: the VirtualClock used to delay deliveries
+    @param rng: the random.Random instance deciding latency and loss
+    @param latency: a function latency(rng, source, destination)
+        returning the delay (seconds) of a packet
+    @param loss: the probability that any given packet is lost
+
+    Statistics:
+        sent: the number of packets handed to the network
+        delivered: the number of packets delivered to a protocol
+        lost: the number of packets lost (@see loss)
+        unreachable: the number of packets sent to an offline address
+        msgtype_counts: 'q'/'r'/'e' -> the number of such packets sent
+
+    """
+    def __init__(self, clock, rng, latency=None, loss=0.0):
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency or constant_latency(0.05)
+        self.loss = loss
+        # address -> protocol, for every node that is online
+        self.hosts = dict()
+        self.sent = 0
+        self.delivered = 0
+        self.lost = 0
+        self.unreachable = 0
+        self.msgtype_counts = dict.fromkeys(['q', 'r', 'e'], 0)
+
+    def attach(self, protocol, address):
+        """Bring the protocol online at the given address"""
+        self.hosts[address] = protocol
+        protocol.transport = SimulatedTransport(self, address)
+
+    def detach(self, address):
+        """Take the protocol behind the address offline"""
+        protocol = self.hosts.pop(address, None)
+        if protocol is not None:
+            protocol.transport.online = False
+
+    def send(self, packet, source, destination):
+        self.sent += 1
+        try:
+            (msgtype, transaction_id, rpc_dict) = krpc_coder.parse(packet)
+            self.msgtype_counts[msgtype] += 1
+        except krpc_coder.InvalidKRPCError:
+            pass
+        if self.loss > 0 and self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        delay = self.latency(self.rng, source, destination)
+        self.clock.callLater(delay, self._deliver, packet, source,
+                             destination)
+
+    def _deliver(self, packet, source, destination):
+        protocol = self.hosts.get(destination, None)
+        if protocol is None:
+            self.unreachable += 1
+            return
+        self.delivered += 1
+        protocol.datagramReceived(packet, source)
+
+
+class SimulatedTransport(object):
+    """
+    A UDP transport writing into a SimulatedNetwork
+
+    Once its address is detached from the network, the transport
+    drops everything written to it
+
+    """
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.online = True
+
+    def write(self, packet, address):
+        if self.online:
+            self.network.send(packet, self.address, address)
+
+    def getHost(self):
+        return self.address
+
+    def stopListening(self):
+        self.network.detach(self.address)
+
+
+class ChurnModel(object):
+    """
+    Nodes leaving and joining the network at a steady rate
+
+    @param rate: the fraction of the online nodes replaced per second
+        (a leaving node is replaced by a newly joining one, so that
+        the size of the network stays the same)
+    @param interval: how often (seconds) churn is applied
+
+    """
+    def __init__(self, rate, interval=1.0):
+        self.rate = rate
+        self.interval = interval
+
+    def departures(self, rng, num_online):
+        """Returns how many nodes leave during one interval"""
+        expected = self.rate * self.interval * num_online
+        departures = int(expected)
+        if rng.random() < expected - departures:
+            departures += 1
+        return departures
+
+
+class Simulator(object):
+    """
+    A network of simulated DHT nodes driven by a virtual clock
+
+    @param num_nodes: the number of nodes in the network
+    @param seed: the seed that makes a run reproducible
+    @param latency: @see SimulatedNetwork
+    @param loss: @see SimulatedNetwork
+    @param churn: a ChurnModel (None for a network without churn)
+    @param known_nodes: the number of random nodes each node knows about
+        when it joins the network
+    @param protocol_class: the class of the simulated nodes
+
+    Statistics:
+        joined: the number of nodes that joined after the start
+        departed: the number of nodes that left the network
+
+    """
+    def __init__(self, num_nodes=1000, seed=0, latency=None, loss=0.0,
+                 churn=None, known_nodes=2 * constants.k,
+                 protocol_class=KRPC_Iterator):
+        self.num_nodes = num_nodes
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.network = SimulatedNetwork(self.clock, self.rng, latency, loss)
+        self.churn = churn
+        self.known_nodes = known_nodes
+        self.protocol_class = protocol_class
+        # Every online protocol (in the order they joined)
+        self.nodes = []
+        self.joined = 0
+        self.departed = 0
+        self._next_host = 0
+        # address -> the NodeClock of the node online at the address
+        self._node_clocks = dict()
+        self._patcher = MonkeyPatcher(
+                (krpc_sender, "reactor", self.clock),
+                (time, "time", self.clock.seconds))
+        self._random_state = None
+
+    def start(self):
+        """Patch in the virtual clock and create the network"""
+        self._random_state = random.getstate()
+        random.seed(self.seed)
+        self._patcher.patch()
+        for i in xrange(self.num_nodes):
+            self.nodes.append(self._create_node())
+        for node in self.nodes:
+            self._introduce(node)
+        if self.churn is not None:
+            self.clock.callLater(self.churn.interval, self._churn)
+
+    def stop(self):
+        """Restore the real reactor, time function, and random state"""
+        self._patcher.restore()
+        random.setstate(self._random_state)
+
+    def bootstrap(self, spread=10.0):
+        """
+        Have every node look itself up (the lookups are started
+        at random times within `spread` seconds) and wait until
+        all of them are done
+
+        """
+        pending = [0]
+        def done(result):
+            pending[0] -= 1
+        for node in list(self.nodes):
+            pending[0] += 1
+            self.clock.callLater(self.rng.uniform(0, spread),
+                                 self._self_lookup, node, done)
+        while pending[0] > 0 and self.clock.step():
+            pass
+
+    def lookup(self, node, target_id, rpctype="find_node"):
+        """
+        Start a lookup towards target_id from the given node
+
+        @param rpctype: one of "find_node", "get_peers", or
+            "sample_infohashes"
+        @returns a Deferred firing with the finished IterativeLookup
+            (or an IterationError)
+
+        """
+        lookups = {"find_node": node.find_lookup,
+                   "get_peers": node.get_lookup,
+                   "sample_infohashes": node.sample_lookup}
+        return lookups[rpctype](target_id)
+
+    def run_until(self, deferred, timeout=None):
+        """
+        Advance the virtual clock until the deferred has fired
+
+        @returns the deferred's result
+        @raises the deferred's failure (or RuntimeError if the deferred
+            did not fire within `timeout` simulated seconds)
+
+        """
+        results = []
+        deferred.addBoth(results.append)
+        end_time = (self.clock.seconds() + timeout
+                    if timeout is not None else None)
+        while len(results) == 0 and self.clock.step(end_time):
+            pass
+        if len(results) == 0:
+            raise RuntimeError("The deferred did not fire in time")
+        result = results[0]
+        if isinstance(result, Failure):
+            result.raiseException()
+        return result
+
+    def run(self, seconds):
+        """Let the network run for the given number of simulated seconds"""
+        self.clock.advance(seconds)
+
+    def depart(self, node):
+        """
+        Take the node out of the network
+
+        The node is taken offline, its protocol is stopped, and all of
+        its pending calls (query timeouts, lookup timeouts, looping
+        calls) are cancelled, so that it sends nothing ever again
+
+        """
+        address = node.transport.address
+        self.nodes.remove(node)
+        self.network.detach(address)
+        node.stopProtocol()
+        self._node_clocks.pop(address).cancel_all()
+        self.departed += 1
+
+    def is_online(self, node):
+        return self.network.hosts.get(node.transport.address) is node
+
+    def random_node(self):
+        return self.rng.choice(self.nodes)
+
+    def random_id(self):
+        return self.rng.getrandbits(constants.id_size)
+
+    def convergence(self, sample_size=50):
+        """
+        Measure how well the routing tables have converged
+
+        For a sample of nodes, this is the fraction of each node's k
+        closest online nodes that are in its routing table
+
+        @returns a number in [0, 1] (averaged over the sample)
+
+        """
+        sample = self.rng.sample(self.nodes, min(sample_size,
+                                                 len(self.nodes)))
+        total = 0.0
+        for node in sample:
+            others = [other.node_id for other in self.nodes
+                      if other is not node]
+            others.sort(key=lambda node_id: node_id ^ node.node_id)
+            closest = others[:constants.k]
+            known = sum(1 for node_id in closest
+                        if node.routing_table.get_node(node_id) is not None)
+            total += float(known) / max(len(closest), 1)
+        return total / max(len(sample), 1)
+
+    def _create_node(self):
+        node_clock = NodeClock(self.clock)
+        # The node picks up its reactor from krpc_sender when created
+        krpc_sender.reactor = node_clock
+        try:
+            node = self.protocol_class()
+        finally:
+            krpc_sender.reactor = self.clock
+        address = self._new_address()
+        self._node_clocks[address] = node_clock
+        self.network.attach(node, address)
+        node.startProtocol()
+        return node
+
+    def _new_address(self):
+        self._next_host += 1
+        host = self._next_host
+        return ("10.%d.%d.%d" % ((host >> 16) & 255, (host >> 8) & 255,
+                                 host & 255), 6881)
+
+    def _introduce(self, node):
+        """Offer a few random online nodes to the node's routing table"""
+        others = self.rng.sample(self.nodes,
+                                 min(self.known_nodes, len(self.nodes)))
+        for other in others:
+            if other is not node:
+                node.routing_table.offer_node(
+                        Node(other.node_id, other.transport.address))
+
+    def _self_lookup(self, node, done):
+        if not self.is_online(node):
+            done(None)
+            return
+        d = node.find_lookup(node.node_id)
+        d.addErrback(lambda failure: None)
+        d.addBoth(done)
+
+    def _churn(self):
+        departures = self.churn.departures(self.rng, len(self.nodes))
+        for i in xrange(min(departures, len(self.nodes) - 1)):
+            self.depart(self.nodes[self.rng.randrange(len(self.nodes))])
+            newcomer = self._create_node()
+            self._introduce(newcomer)
+            self.nodes.append(newcomer)
+            self.joined += 1
+            d = newcomer.find_lookup(newcomer.node_id)
+            d.addErrback(lambda failure: None)
+        self.clock.callLater(self.churn.interval, self._churn)
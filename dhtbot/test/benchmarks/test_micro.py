@@ -0,0 +1,80 @@
+import json
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot.benchmarks import micro
+from dhtbot.benchmarks.micro import compare, load_results, save_results
+
+baseline = {"bencode_decode": 2e-6, "routing_table_offer_node": 1e-5,
+            "datastore_get": 3e-7}
+
+class CompareTestCase(unittest.TestCase):
+    def _compare(self, current, tolerance=0.1):
+        output = StringIO()
+        regressions = MonkeyPatcher((micro.sys, "stdout", output)
+                ).runWithPatches(compare, baseline, current, tolerance)
+        return (regressions, output.getvalue().splitlines())
+
+    def test_compare_reportsRegression(self):
+        current = dict(baseline, bencode_decode=3e-6)
+        (regressions, lines) = self._compare(current)
+        self.assertEquals(["bencode_decode"], regressions)
+        self.assertTrue(lines[0].startswith("bencode_decode"))
+        self.assertTrue(lines[0].endswith("REGRESSION"))
+
+    def test_compare_improvementIsNotARegression(self):
+        current = dict(baseline, routing_table_offer_node=5e-6)
+        (regressions, lines) = self._compare(current)
+        self.assertEquals([], regressions)
+        self.assertFalse([line for line in lines if "REGRESSION" in line])
+
+    def test_compare_withinTolerance(self):
+        current = dict(baseline, datastore_get=3.2e-7)
+        self.assertEquals([], self._compare(current)[0])
+        self.assertEquals(["datastore_get"],
+                          self._compare(current, tolerance=0.05)[0])
+
+    def test_compare_missingAndNewBenchmarks(self):
+        current = dict(baseline, token_bucket_consume=1e-6)
+        del current["datastore_get"]
+        (regressions, lines) = self._compare(current)
+        self.assertEquals([], regressions)
+        self.assertEquals(["datastore_get", "missing"], lines[1].split())
+        self.assertEquals(["token_bucket_consume", "new"],
+                          lines[3].split()[:2])
+
+class RunTestCase(unittest.TestCase):
+    def _run_benchmarks(self, names):
+        """Run the named benchmarks once each through micro.run"""
+        selected = [(name, prepare, 1)
+                    for (name, prepare, repeat) in micro.benchmarks
+                    if name in names]
+        self.assertEquals(len(names), len(selected))
+        output = StringIO()
+        results = MonkeyPatcher((micro, "benchmarks", selected),
+                                (micro.sys, "stdout", output)
+                ).runWithPatches(micro.run)
+        return (results, output.getvalue().splitlines())
+
+    def test_run_timesBenchmarks(self):
+        # One benchmark timed by run, and one that times itself
+        names = ["token_bucket.consume", "datastore.expiry"]
+        (results, lines) = self._run_benchmarks(names)
+        self.assertEquals(sorted(names), sorted(results))
+        for seconds in results.itervalues():
+            self.assertTrue(seconds > 0)
+        self.assertEquals(sorted(names),
+                          sorted(line.split()[0] for line in lines))
+
+class ResultsFileTestCase(unittest.TestCase):
+    def test_save_and_load_roundtrip(self):
+        path = self.mktemp()
+        save_results(baseline, path)
+        self.assertEquals(baseline, load_results(path))
+
+    def test_load_rejectsUnknownVersion(self):
+        path = self.mktemp()
+        open(path, "w").write(json.dumps({"version": 0, "results": {}}))
+        self.assertRaises(ValueError, load_results, path)
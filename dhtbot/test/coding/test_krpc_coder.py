@@ -1,10 +1,10 @@
 from twisted.trial import unittest
 
 from dhtbot.coding.krpc_coder import (
-        encode, decode, _chunkify, _decode_addresses,
+        encode, decode, parse, decode_parsed, _chunkify, _decode_addresses,
         InvalidKRPCError)
 from dhtbot.coding import basic_coder
-from dhtbot.krpc_types import Query, Response, Error
+from dhtbot.krpc_types import Query, Response, Error, RawField
 from dhtbot.contact import Node
 
 encode_and_decode = lambda krpc: decode(encode(krpc))
@@ -102,6 +102,13 @@ class QueryCodingTestCase(unittest.TestCase):
         processed_query = encode_and_decode(q)
         self.assertEquals(processed_query, q)
 
+    def test_encode_and_decode_validSampleInfohashes(self):
+        q = self.q
+        q.rpctype = "sample_infohashes"
+        q.target_id = 2**140
+        processed_query = encode_and_decode(q)
+        self.assertEquals(processed_query, q)
+
 
     def test_encode_and_decode_invalidRPCType(self):
         q = self.q
@@ -150,7 +157,7 @@ class ResponseCodingTestCase(unittest.TestCase):
         r = Response()
         r._transaction_id = 1903890316316
         r._from = 169031860931900138093217073128059
-        r.token = 90831
+        r.token = "\x01b\xcf"
         r.peers = [("127.0.0.1", 80), ("4.2.2.1", 8905), ("0.0.0.0", 0),
                     ("8.8.8.8", 53), ("255.255.255.255", 65535)]
         processed_response = encode_and_decode(r)
@@ -159,6 +166,14 @@ class ResponseCodingTestCase(unittest.TestCase):
         self.assertEquals(r.token, processed_response.token)
         self.assertEquals(r.peers, processed_response.peers)
 
+    def test_encode_and_decode_tokenKeepsLeadingZeros(self):
+        r = Response()
+        r._transaction_id = 15
+        r._from = 2**120
+        r.token = "\x00\x00\x15\xb3"
+        processed_response = encode_and_decode(r)
+        self.assertEquals(r.token, processed_response.token)
+
     def test_encode_validGetPeersResponseWithNodes(self):
         r = Response()
         r._transaction_id = 1903890316316
@@ -193,6 +208,92 @@ class ResponseCodingTestCase(unittest.TestCase):
         self.assertEquals(r._transaction_id, processed_response._transaction_id)
         self.assertEquals(r._from, processed_response._from)
 
+    def test_encode_and_decode_validSampleInfohashesResponse(self):
+        r = Response()
+        r._transaction_id = 2095
+        r._from = 2**15
+        r.nodes = [Node(2**158, ("127.0.0.1", 890))]
+        r.samples = [2**159, 15, 2**100 + 3]
+        r.num = 310
+        r.interval = 21600
+        processed_response = encode_and_decode(r)
+        self.assertEquals(r.nodes, processed_response.nodes)
+        self.assertEquals(r.samples, processed_response.samples)
+        self.assertEquals(r.num, processed_response.num)
+        self.assertEquals(r.interval, processed_response.interval)
+
+    def test_encode_invalidSampleCount(self):
+        r = Response()
+        r._transaction_id = 2095
+        r._from = 2**15
+        r.samples = []
+        r.num = -1
+        self.assertRaises(InvalidKRPCError, encode, r)
+
+    def test_decode_truncatedSamples(self):
+        r = Response()
+        r._transaction_id = 2095
+        r._from = 2**15
+        r.samples = [15]
+        encoding = encode(r).replace("7:samples20:", "7:samples19:", 1)
+        encoding = encoding.replace("\x0f", "", 1)
+        self.assertRaises(InvalidKRPCError, decode, encoding)
+
+    def test_decode_nodesDecodedLazily(self):
+        r = Response()
+        r._transaction_id = 2095
+        r._from = 2**15
+        r.nodes = [Node(2**150, ("127.0.0.1", 80))]
+        r.peers = [("4.2.2.1", 8905)]
+        processed_response = decode(encode(r))
+        self.assertTrue(isinstance(processed_response._nodes, RawField))
+        self.assertTrue(isinstance(processed_response._peers, RawField))
+        self.assertEquals(r.nodes, processed_response.nodes)
+        self.assertEquals(r.peers, processed_response.peers)
+
+    def test_decode_truncatedNodes(self):
+        r = Response()
+        r._transaction_id = 2095
+        r._from = 2**15
+        r.nodes = [Node(2**150, ("127.0.0.1", 80))]
+        encoding = encode(r).replace("5:nodes26:", "5:nodes25:", 1)
+        encoding = encoding.replace("\x00P", "\x00", 1)
+        self.assertRaises(InvalidKRPCError, decode, encoding)
+
+class ParseTestCase(unittest.TestCase):
+    def test_parse_response(self):
+        r = Response()
+        r._transaction_id = 1903890316316
+        r._from = 2**15
+        r.nodes = [Node(2**150, ("127.0.0.1", 80))]
+        r.token = "1:t1:y"
+        (msgtype, transaction_id, rpc_dict) = parse(encode(r))
+        self.assertEquals(("r", 1903890316316), (msgtype, transaction_id))
+        self.assertEquals(r.nodes,
+                          decode_parsed((msgtype, transaction_id,
+                                         rpc_dict)).nodes)
+
+    def test_parse_query(self):
+        q = Query()
+        q._transaction_id = 15
+        q._from = 2**120
+        q.rpctype = "ping"
+        parsed = parse(encode(q))
+        self.assertEquals(("q", 15), parsed[:2])
+        self.assertEquals(15, decode_parsed(parsed)._transaction_id)
+
+    def test_parse_invalidPackets(self):
+        for packet in ["", "le", "d1:t1:\x0fe", "d1:t1:\x0f1:y1:xe",
+                       "d1:t5:\x0f1:y1:re", "d1:ti5e1:y1:re",
+                       "d1:t1:\x0f1:y1:r", "d1:t1:\x0f1:yl1:qee",
+                       "d" + "l" * 5000, "d1:t" + "l" * 5000]:
+            self.assertRaises(InvalidKRPCError, parse, packet)
+
+    def test_decode_parsed_invalidKRPC(self):
+        # A well formed reply that is not a valid response
+        parsed = parse("d1:rle1:t1:\x0f1:y1:re")
+        self.assertRaises(InvalidKRPCError, decode_parsed, parsed)
+
 class ErrorCodingTestCase(unittest.TestCase):
     def test_encode_and_decode_validError(self):
         e = Error()
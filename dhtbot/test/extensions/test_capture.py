@@ -0,0 +1,73 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from dhtbot.extensions.capture import (CaptureError, Capture_Patcher,
+        read_capture, write_capture)
+
+records = [(1.5, "d1:y1:qe", ("127.0.0.1", 8888)),
+           (2.25, "", ("10.0.0.1", 1)),
+           (3.0, "x" * 1500, ("192.168.1.254", 65535))]
+
+# Helper class for Capture_PatcherTestCase
+class DatagramRecorder(object):
+    def __init__(self):
+        self.received = []
+        self.stopped = False
+
+    def datagramReceived(self, data, address):
+        self.received.append((data, address))
+
+    def startProtocol(self):
+        pass
+
+    def stopProtocol(self):
+        self.stopped = True
+
+class CaptureFileTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        path = self.mktemp()
+        self.assertEquals(3, write_capture(path, records))
+        self.assertEquals(records, read_capture(path))
+
+    def test_read_missingFile(self):
+        self.assertRaises(CaptureError, read_capture, self.mktemp())
+
+    def test_read_notACapture(self):
+        path = self.mktemp()
+        open(path, "wb").write("DHTS" + "\x00" * 40)
+        self.assertRaises(CaptureError, read_capture, path)
+
+    def test_read_truncated(self):
+        path = self.mktemp()
+        write_capture(path, records)
+        contents = open(path, "rb").read()
+        open(path, "wb").write(contents[:-1])
+        self.assertRaises(CaptureError, read_capture, path)
+
+class Capture_PatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+        self.recorder = DatagramRecorder()
+        self.patcher = Capture_Patcher(self.recorder, self.path,
+                                       reactor=self.clock)
+
+    def test_datagramReceived_recordsAndForwards(self):
+        self.clock.advance(5)
+        self.patcher.datagramReceived("ping", ("127.0.0.1", 1234))
+        self.clock.advance(1)
+        self.patcher.datagramReceived("pong", ("127.0.0.2", 4321))
+        self.patcher.stopProtocol()
+        self.assertTrue(self.recorder.stopped)
+        self.assertEquals([("ping", ("127.0.0.1", 1234)),
+                           ("pong", ("127.0.0.2", 4321))],
+                          self.recorder.received)
+        self.assertEquals([(5, "ping", ("127.0.0.1", 1234)),
+                           (6, "pong", ("127.0.0.2", 4321))],
+                          read_capture(self.path))
+
+    def test_datagramReceived_uncapturableAddressIsForwarded(self):
+        self.patcher.datagramReceived("ping", ("::1", 1234))
+        self.patcher.stopProtocol()
+        self.assertEquals(1, len(self.recorder.received))
+        self.assertEquals([], read_capture(self.path))
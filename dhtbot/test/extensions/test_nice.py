@@ -1 +1,130 @@
-from dhtbot.extensions import nice
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from dhtbot import constants
+from dhtbot.coding.krpc_coder import InvalidKRPCError
+from dhtbot.contact import Node
+from dhtbot.extensions.nice import NICE, NICE_Patcher
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.krpc_types import Response
+from dhtbot.protocols.errors import TimeoutError
+from dhtbot.protocols.krpc_responder import KRPC_Responder
+
+make_node = lambda num: Node(num, ("127.0.0.1", num % 65536))
+
+class DeferredNetwork(object):
+    """Remember every ping/find_node so that the test can answer it"""
+    def __init__(self):
+        self.pings = []
+        self.find_nodes = []
+
+    def ping(self, address, timeout=None):
+        d = defer.Deferred()
+        self.pings.append((address, d))
+        return d
+
+    def find_node(self, address, node_id, timeout=None):
+        d = defer.Deferred()
+        self.find_nodes.append((address, node_id, d))
+        return d
+
+class NICETestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.network = DeferredNetwork()
+        self.rt = TreeRoutingTable(2**159)
+
+    def _nice(self, budget=4):
+        return NICE(self.network.ping, self.network.find_node, self.rt,
+                    self.reactor, interval=1, budget=budget)
+
+    def test_tick_pingsStalestNode(self):
+        nodes = [make_node(num) for num in range(1, 4)]
+        for (age, node) in zip([5, 2, 9], nodes):
+            node.last_updated = age
+            self.rt.offer_node(node)
+        nice_algorithm = self._nice()
+        nice_algorithm.tick()
+        self.assertEquals([nodes[1].address],
+                          [address for (address, d) in self.network.pings])
+
+    def test_tick_refreshesUnderPopulatedKBucket(self):
+        node = make_node(1)
+        self.rt.offer_node(node)
+        nice_algorithm = self._nice()
+        nice_algorithm.tick()
+        self.assertEquals(1, len(self.network.find_nodes))
+        (address, target_id, d) = self.network.find_nodes[0]
+        self.assertEquals(node.address, address)
+        response = Response()
+        response.nodes = [make_node(2**150)]
+        d.callback(response)
+        # The returned node is only offered once it answers a ping
+        self.assertEquals(None, self.rt.get_node(2**150))
+        self.reactor.advance(constants.quarantine_interval)
+        (address, d) = self.network.pings[-1]
+        self.assertEquals(make_node(2**150).address, address)
+        d.callback(Response())
+        self.assertEquals(make_node(2**150), self.rt.get_node(2**150))
+
+    def test_tick_respectsBudget(self):
+        # Force a few kbucket splits so that there
+        # are more refreshable kbuckets than budget
+        for num in range(1, 60):
+            self.rt.offer_node(make_node(2**159 + num * 2**150))
+            self.rt.offer_node(make_node(num * 2**100))
+        self.assertTrue(len(self.rt.get_kbuckets()) > 2)
+        nice_algorithm = self._nice(budget=2)
+        nice_algorithm.tick()
+        sent = len(self.network.pings) + len(self.network.find_nodes)
+        self.assertEquals(2, sent)
+        # No new work is started while the budget is in flight
+        nice_algorithm.tick()
+        self.assertEquals(2, nice_algorithm.outstanding)
+        self.assertEquals(sent, len(self.network.pings) +
+                                len(self.network.find_nodes))
+        (address, d) = self.network.pings[0]
+        d.errback(TimeoutError())
+        self.assertEquals(1, nice_algorithm.failures)
+        self.assertEquals(1, nice_algorithm.outstanding)
+
+    def test_tick_countsInvalidResponsesAsFailures(self):
+        self.rt.offer_node(make_node(1))
+        nice_algorithm = self._nice()
+        nice_algorithm.tick()
+        (address, d) = self.network.pings[0]
+        d.errback(InvalidKRPCError("garbage"))
+        self.assertEquals(1, nice_algorithm.failures)
+        self.assertEquals(0, len(self.flushLoggedErrors()))
+
+    def test_tick_listsKBucketsOnce(self):
+        self.rt.offer_node(make_node(1))
+        listed = []
+        get_kbuckets = self.rt.get_kbuckets
+        def counting_get_kbuckets():
+            listed.append(None)
+            return get_kbuckets()
+        self.rt.get_kbuckets = counting_get_kbuckets
+        self._nice().tick()
+        self.assertEquals(1, len(listed))
+
+    def test_start_ticksEveryInterval(self):
+        self.rt.offer_node(make_node(1))
+        nice_algorithm = self._nice()
+        nice_algorithm.start()
+        self.assertEquals(0, nice_algorithm.pings)
+        self.reactor.advance(1)
+        self.assertEquals(1, nice_algorithm.pings)
+        nice_algorithm.stop()
+        self.reactor.advance(1)
+        self.assertEquals(1, nice_algorithm.pings)
+
+class NICE_PatcherTestCase(unittest.TestCase):
+    def test_stopProtocol_stopsOriginal(self):
+        kresponder = KRPC_Responder(node_id=2**159)
+        stopped = []
+        kresponder.stopProtocol = lambda: stopped.append(True)
+        patcher = NICE_Patcher(kresponder, reactor=task.Clock())
+        patcher.startProtocol()
+        patcher.stopProtocol()
+        self.assertEquals([True], stopped)
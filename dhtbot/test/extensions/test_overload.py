@@ -0,0 +1,179 @@
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot import constants
+from dhtbot.coding import krpc_coder
+from dhtbot.extensions.overload import OverloadController, Overload_Patcher
+from dhtbot.krpc_types import Query, Response
+from dhtbot.protocols.krpc_responder import KRPC_Responder
+from dhtbot.test.utils import Counter, HollowTransport
+
+def make_query(rpctype, transaction_id=15):
+    query = Query()
+    query.rpctype = rpctype
+    query._from = 2**150
+    query._transaction_id = transaction_id
+    if rpctype in ("find_node", "get_peers", "sample_infohashes"):
+        query.target_id = 2**140
+    return query
+
+# Helper class for Overload_PatcherTestCase
+class DatagramRecorder(object):
+    def __init__(self):
+        self.received = []
+
+    def datagramReceived(self, data, address):
+        self.parsedReceived(krpc_coder.parse(data), address)
+
+    def parsedReceived(self, parsed, address):
+        self.received.append(krpc_coder.decode_parsed(parsed))
+
+    def startProtocol(self):
+        pass
+
+    def stopProtocol(self):
+        pass
+
+class OverloadControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = OverloadController(self.clock, max_lag=1.0,
+                max_queue=100, heartbeat_interval=0.1)
+
+    def test_admit_everythingWhenIdle(self):
+        for rpctype in ["ping", "find_node", "get_peers", "announce_peer"]:
+            self.assertTrue(self.controller.admit(rpctype))
+        self.assertEquals(0, self.controller.shed_count())
+
+    def test_heartbeat_measuresLag(self):
+        self.controller.start()
+        self.clock.advance(0.1)
+        self.assertEquals(0, self.controller.lag)
+        # A reactor iteration that blocked for a second
+        self.clock.advance(1.1)
+        self.assertAlmostEqual(0.5, self.controller.lag)
+        self.controller.stop()
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+    def test_admit_shedsExpensiveQueriesFirst(self):
+        self.controller.queue_depth = 60
+        self.assertFalse(self.controller.admit("announce_peer"))
+        self.assertTrue(self.controller.admit("get_peers"))
+        self.controller.queue_depth = 95
+        self.assertFalse(self.controller.admit("get_peers"))
+        self.assertFalse(self.controller.admit("find_node"))
+        self.assertTrue(self.controller.admit("ping"))
+        self.controller.queue_depth = 100
+        self.assertFalse(self.controller.admit("ping"))
+        self.assertEquals({"announce_peer": 1, "get_peers": 1,
+                           "find_node": 1, "ping": 1},
+                          dict(self.controller.shed_counts))
+        self.assertEquals(4, self.controller.shed_count())
+
+    def test_admit_shedsOnReactorLag(self):
+        self.controller.lag = 0.8
+        self.assertFalse(self.controller.admit("get_peers"))
+        self.assertTrue(self.controller.admit("ping"))
+
+class Overload_PatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.recorder = DatagramRecorder()
+        self.patcher = Overload_Patcher(self.recorder, self.clock)
+        self.address = ("127.0.0.1", 5555)
+
+    def _receive(self, krpc):
+        self.patcher.datagramReceived(krpc_coder.encode(krpc), self.address)
+
+    def test_datagramReceived_responsesAheadOfQueries(self):
+        self._receive(make_query("ping"))
+        response = Response()
+        response._from = 2**150
+        response._transaction_id = 20
+        self._receive(response)
+        self.assertEquals(["response"],
+                          [krpc.__class__.__name__.lower()
+                           for krpc in self.recorder.received])
+        self.clock.advance(0)
+        self.assertEquals(2, len(self.recorder.received))
+        self.assertEquals("ping", self.recorder.received[1].rpctype)
+
+    def test_drain_mostImportantQueriesFirst(self):
+        for rpctype in ["announce_peer", "get_peers", "find_node", "ping"]:
+            query = make_query(rpctype)
+            if rpctype == "announce_peer":
+                query.target_id = 2**140
+                query.port = 6881
+                query.token = 5
+            self._receive(query)
+        self.clock.advance(0)
+        self.assertEquals(["ping", "find_node", "get_peers", "announce_peer"],
+                          [query.rpctype for query in self.recorder.received])
+
+    def test_drain_processesBatchesPerIteration(self):
+        for num in range(constants.overload_batch_size + 1):
+            self._receive(make_query("ping", num))
+        self.assertEquals(constants.overload_batch_size + 1,
+                          self.patcher.overload.queue_depth)
+        # Run a single reactor iteration's worth of processing
+        # (task.Clock would also run the rescheduled drain)
+        self.clock.getDelayedCalls()[0].cancel()
+        self.patcher._drain()
+        self.assertEquals(constants.overload_batch_size,
+                          len(self.recorder.received))
+        self.assertEquals(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(0)
+        self.assertEquals(constants.overload_batch_size + 1,
+                          len(self.recorder.received))
+        self.assertEquals(0, self.patcher.overload.queue_depth)
+
+    def test_datagramReceived_shedsUnderLag(self):
+        self.patcher.overload.lag = constants.overload_max_lag
+        self._receive(make_query("ping"))
+        response = Response()
+        response._from = 2**150
+        response._transaction_id = 20
+        self._receive(response)
+        self.clock.advance(0)
+        # The response is still processed
+        self.assertEquals(1, len(self.recorder.received))
+        self.assertEquals(1, self.patcher.overload.shed_counts["ping"])
+
+    def test_datagramReceived_shedQueriesAreNotDecoded(self):
+        self.patcher.overload.lag = constants.overload_max_lag
+        packet = krpc_coder.encode(make_query("ping"))
+        counter = Counter(krpc_coder.decode_parsed)
+        MonkeyPatcher((krpc_coder, "decode_parsed", counter)).runWithPatches(
+                self.patcher.datagramReceived, packet, self.address)
+        self.assertEquals(0, counter.count)
+        self.assertEquals(1, self.patcher.overload.shed_counts["ping"])
+
+    def test_datagramReceived_admittedQueriesAreParsedOnce(self):
+        kresponder = KRPC_Responder(node_id=2**159)
+        kresponder.transport = HollowTransport()
+        patcher = Overload_Patcher(kresponder, self.clock)
+        packet = krpc_coder.encode(make_query("ping"))
+        counter = Counter(krpc_coder.parse)
+        monkey_patcher = MonkeyPatcher((krpc_coder, "parse", counter))
+        monkey_patcher.runWithPatches(patcher.datagramReceived, packet,
+                                      self.address)
+        monkey_patcher.runWithPatches(self.clock.advance, 0)
+        self.assertEquals(1, counter.count)
+        # The query was answered
+        self.assertTrue(kresponder.transport._packet_was_sent())
+
+    def test_datagramReceived_malformedLeftToTheOriginal(self):
+        kresponder = KRPC_Responder(node_id=2**159)
+        patcher = Overload_Patcher(kresponder, self.clock)
+        patcher.datagramReceived("not a krpc", self.address)
+        self.assertEquals(1, kresponder.metrics.malformed_packets)
+
+    def test_datagramReceived_unknownRPCTypesShareAShedCount(self):
+        self.patcher.overload.lag = constants.overload_max_lag
+        for rpctype in ["get", "put"]:
+            packet = krpc_coder.encode(make_query("ping"))
+            self.patcher.datagramReceived(
+                    packet.replace("4:ping", "3:" + rpctype), self.address)
+        self.assertEquals({"other": 2},
+                          dict(self.patcher.overload.shed_counts))
@@ -1,11 +1,15 @@
-from dhtbot.extensions import quarantine
-
+from twisted.internet import task
 from twisted.internet.defer import Deferred
 from twisted.trial import unittest
 
-from dhtbot.extensions.quarantine import Quarantine
+from dhtbot import constants
+from dhtbot.coding import krpc_coder
+from dhtbot.extensions.quarantine import Quarantine, Quarantine_Patcher
 from dhtbot.contact import Node
+from dhtbot.krpc_types import Query
 from dhtbot.protocols.errors import TimeoutError
+from dhtbot.protocols.krpc_responder import KRPC_Responder
+from dhtbot.test.utils import HollowTransport
 
 # Helper class for QuarantineTestCase
 class HollowRoutingTable(object):
@@ -15,7 +19,7 @@ class HollowRoutingTable(object):
     def get_node(self, node_id):
         return None
 
-    def add_node(self, node):
+    def offer_node(self, node):
         self.nodes.add(node)
         return True
 
@@ -24,9 +28,11 @@ class PingCounter(object):
     def __init__(self):
         self.ping_count = 0
         self.current_deferred = None
+        self.timeouts = []
 
-    def ping(self, address):
+    def ping(self, address, timeout=None):
         self.ping_count += 1
+        self.timeouts.append(timeout)
         self.current_deferred = Deferred()
         return self.current_deferred
 
@@ -37,19 +43,27 @@ class QuarantineTestCase(unittest.TestCase):
     def refresh(self):
         self.pc = PingCounter()
         self.rt = HollowRoutingTable()
+        self.clock = task.Clock()
+
+    def _quarantine(self, **kwargs):
+        return Quarantine(self.pc.ping, self.rt, self.clock, **kwargs)
 
     def test_jail_singlePrisoner(self):
-        self.refresh()
-        q = Quarantine(self.pc.ping, self.rt)
+        q = self._quarantine()
         n = Node(2**150, ("127.0.0.1", 58))
         q.jail(n)
+        # Prisoners are pinged in the next batch
+        self.assertEquals(0, self.pc.ping_count)
+        self.clock.advance(constants.quarantine_interval)
         self.assertEquals(1, self.pc.ping_count)
+        self.assertEquals([constants.quarantine_ping_timeout],
+                          self.pc.timeouts)
 
     def test_jail_singlePrisonerCallBack(self):
-        self.refresh()
-        q = Quarantine(self.pc.ping, self.rt)
+        q = self._quarantine()
         n = Node(2**30, ("127.0.0.1", 555))
         q.jail(n)
+        q.verify_batch()
         # The node should be inserted into the routing
         # table after it 'responds' to a query
         self.assertFalse(n in self.rt.nodes)
@@ -58,43 +72,144 @@ class QuarantineTestCase(unittest.TestCase):
         self.assertTrue(n in self.rt.nodes)
         self.assertFalse(n in q.prison)
 
-    def test_jail_singlePrisonerErrback(self):
-        self.refresh()
-        q = Quarantine(self.pc.ping, self.rt)
-        n = Node(2**35, ("127.0.0.1", 255))
-        q.jail(n)
-        self.assertFalse(n in self.rt.nodes)
-        self.assertTrue(n in q.prison)
-        self.pc.current_deferred.errback(TimeoutError(""))
-        self.assertTrue(n in q.prison)
-        self.assertFalse(n in self.rt.nodes)
-
     def test_jail_singlePrisonerErrbackThenCallback(self):
-        self.refresh()
-        q = Quarantine(self.pc.ping, self.rt)
+        q = self._quarantine()
         n = Node(2**51, ("127.0.0.1", 9555))
         q.jail(n)
-        self.assertFalse(n in self.rt.nodes)
-        self.assertTrue(n in q.prison)
+        q.verify_batch()
         self.pc.current_deferred.errback(TimeoutError(""))
         # After the errback, the quarantine should try to
-        # ping the node one last time
+        # ping the node one last time (in a later batch)
         self.assertFalse(n in self.rt.nodes)
         self.assertTrue(n in q.prison)
+        q.verify_batch()
+        self.assertEquals(2, self.pc.ping_count)
         self.pc.current_deferred.callback("")
         self.assertTrue(n in self.rt.nodes)
         self.assertFalse(n in q.prison)
 
     def test_jail_singlePrisonerErrbackTwice(self):
-        self.refresh()
-        q = Quarantine(self.pc.ping, self.rt)
+        q = self._quarantine()
         n = Node(2**35, ("127.0.0.1", 255))
         q.jail(n)
-        self.assertFalse(n in self.rt.nodes)
-        self.assertTrue(n in q.prison)
+        q.verify_batch()
         self.pc.current_deferred.errback(TimeoutError(""))
-        self.assertFalse(n in self.rt.nodes)
-        self.assertTrue(n in q.prison)
+        q.verify_batch()
         self.pc.current_deferred.errback(TimeoutError(""))
         self.assertFalse(n in q.prison)
         self.assertFalse(n in self.rt.nodes)
+        self.assertEquals(1, q.executed)
+
+    def test_jail_evictsLeastRecentlySeen(self):
+        q = self._quarantine(max_prisoners=2)
+        nodes = [Node(2**40 + num, ("127.0.0.1", num)) for num in range(3)]
+        q.jail(nodes[0])
+        q.jail(nodes[1])
+        # Seeing nodes[0] again makes nodes[1] the least recently seen
+        q.jail(nodes[0])
+        q.jail(nodes[2])
+        self.assertEquals([nodes[0], nodes[2]], list(q.prison))
+        self.assertEquals(1, q.evicted)
+        # The evicted prisoner is never pinged
+        q.verify_batch()
+        self.assertEquals(2, self.pc.ping_count)
+
+    def test_verify_batch_pingsAtMostBatchSize(self):
+        q = self._quarantine(batch_size=3)
+        for num in range(7):
+            q.jail(Node(2**40 + num, ("127.0.0.1", num)))
+        self.clock.advance(constants.quarantine_interval)
+        self.assertEquals(3, self.pc.ping_count)
+        self.clock.advance(constants.quarantine_interval)
+        self.assertEquals(6, self.pc.ping_count)
+        self.clock.advance(constants.quarantine_interval)
+        self.assertEquals(7, self.pc.ping_count)
+        # Nothing is left to ping, so the quarantine stops ticking
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+    def test_observe_freesPrisonerWithoutPing(self):
+        q = self._quarantine()
+        n = Node(2**35, ("127.0.0.1", 255))
+        q.jail(n)
+        self.assertTrue(q.observe(n))
+        self.assertTrue(n in self.rt.nodes)
+        q.verify_batch()
+        self.assertEquals(0, self.pc.ping_count)
+        self.assertFalse(q.observe(Node(2**36, ("127.0.0.1", 256))))
+        self.assertEquals(1, q.observed)
+        self.assertEquals(1, q.freed)
+
+    def test_observe_leavesPingedPrisonerToThePing(self):
+        q = self._quarantine()
+        n = Node(2**35, ("127.0.0.1", 255))
+        q.jail(n)
+        q.verify_batch()
+        # The response to the ping is observed before the ping fires
+        self.assertTrue(q.observe(n))
+        self.assertTrue(n in q.prison)
+        self.pc.current_deferred.callback(None)
+        self.assertTrue(n in self.rt.nodes)
+        self.assertEquals(0, q.observed)
+        self.assertEquals(1, q.freed)
+
+class Quarantine_PatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.kresponder = KRPC_Responder(node_id=2**159)
+        self.kresponder.transport = HollowTransport()
+        self.kresponder._reactor = self.clock
+        self.patcher = Quarantine_Patcher(self.kresponder, self.clock)
+        self.query = Query()
+        self.query.rpctype = "ping"
+        self.query._from = 2**150
+        self.query._transaction_id = 15
+        self.address = ("127.0.0.1", 5555)
+        self.node = Node(2**150, self.address)
+
+    def tearDown(self):
+        self.patcher.stopProtocol()
+
+    def test_queryReceived_secondQueryKeepsPrisonerJailed(self):
+        packet = krpc_coder.encode(self.query)
+        self.patcher.datagramReceived(packet, self.address)
+        quarantine = self.patcher._quarantine
+        self.assertTrue(self.node in quarantine.prison)
+        # The query was still answered
+        self.assertTrue(self.kresponder.transport._packet_was_sent())
+        # A (possibly spoofed) query proves nothing
+        self.patcher.datagramReceived(packet, self.address)
+        self.assertTrue(self.node in quarantine.prison)
+        self.assertEquals(None,
+                          self.kresponder.routing_table.get_node(2**150))
+
+    def test_responseToPingFreesPrisoner(self):
+        self.patcher.datagramReceived(krpc_coder.encode(self.query),
+                                      self.address)
+        self.kresponder.transport._packet_was_sent()
+        self.clock.advance(constants.quarantine_interval)
+        ping = krpc_coder.decode(self.kresponder.transport.packet)
+        response = ping.build_response()
+        response._from = 2**150
+        self.patcher.datagramReceived(krpc_coder.encode(response),
+                                      self.address)
+        quarantine = self.patcher._quarantine
+        self.assertFalse(self.node in quarantine.prison)
+        self.assertEquals(self.node,
+                          self.kresponder.routing_table.get_node(2**150))
+        self.assertEquals(1, quarantine.freed)
+        self.assertEquals(0, quarantine.observed)
+
+    def test_datagramReceived_leftToTheOriginal(self):
+        kresponder = KRPC_Responder(node_id=2**159)
+        kresponder.transport = HollowTransport()
+        patcher = Quarantine_Patcher(kresponder, task.Clock())
+        address = ("127.0.0.1", 5555)
+        patcher.datagramReceived("not a krpc", address)
+        self.assertEquals(1, kresponder.metrics.malformed_packets)
+        # A reply to no outstanding query is dropped undecoded
+        response = Query().build_response()
+        response._from = 2**150
+        response._transaction_id = 15
+        patcher.datagramReceived(krpc_coder.encode(response), address)
+        self.assertEquals(1, kresponder.dropped_reply_count)
+        self.assertEquals(0, len(patcher._quarantine.prison))
@@ -1,14 +1,17 @@
 from twisted.trial import unittest
+from twisted.internet import task
 from twisted.python.monkey import MonkeyPatcher
 
 from dhtbot.extensions import rate_limiter
 from dhtbot.extensions.rate_limiter import \
-        RateLimiter, RateLimiter_Patcher, TokenBucket
+        RateLimiter, RateLimiter_Patcher, TokenBucket, HostBuckets, \
+        CountMinSketch
 from dhtbot.coding import krpc_coder
 from dhtbot.kademlia.routing_table import TreeRoutingTable
 from dhtbot.krpc_types import Query
 from dhtbot.protocols.krpc_sender import KRPC_Sender
-from dhtbot.test.utils import Clock, Counter, HollowTransport
+from dhtbot.test.utils import (Clock, Counter, HollowReactor,
+        HollowTransport)
 
 class TestingBase(object):
     def setUp(self):
@@ -86,6 +89,116 @@ class RateLimiterTestCase(TestingBase, unittest.TestCase):
         self.assertTrue(consumed)
 
 
+class HierarchicalRateLimiterTestCase(TestingBase, unittest.TestCase):
+    def setUp(self):
+        TestingBase.setUp(self)
+        self.packet = "x" * 100
+        # Every level allows one more packet than the level below it
+        # (the global limit is out of the way)
+        for (name, packets) in [("host_bandwidth_rate", 1),
+                                ("ip_bandwidth_rate", 2),
+                                ("subnet24_bandwidth_rate", 3),
+                                ("subnet16_bandwidth_rate", 4),
+                                ("global_bandwidth_rate", 100)]:
+            self.monkey_patcher.addPatch(rate_limiter.constants, name,
+                                         packets * len(self.packet))
+        self.monkey_patcher.patch()
+
+    def test_consume_rotatingPortsShareIPBudget(self):
+        rl = RateLimiter()
+        self.assertTrue(rl.consume(self.packet, ("10.0.0.1", 1)))
+        self.assertTrue(rl.consume(self.packet, ("10.0.0.1", 2)))
+        self.assertFalse(rl.consume(self.packet, ("10.0.0.1", 3)))
+
+    def test_consume_subnetsShareBudget(self):
+        rl = RateLimiter()
+        for i in range(1, 4):
+            self.assertTrue(rl.consume(self.packet, ("10.0.0.%d" % i, 1)))
+        # The /24 is exhausted, but the rest of the /16 is not
+        self.assertFalse(rl.consume(self.packet, ("10.0.0.9", 1)))
+        self.assertTrue(rl.consume(self.packet, ("10.0.1.1", 1)))
+        # Now the /16 is exhausted too
+        self.assertFalse(rl.consume(self.packet, ("10.0.2.1", 1)))
+        self.assertTrue(rl.consume(self.packet, ("10.1.0.1", 1)))
+
+    def test_consume_penalizesHeavyHitters(self):
+        # A threshold of 10 packets
+        self.monkey_patcher.addPatch(rate_limiter.constants,
+                "heavy_hitter_rate", len(self.packet) / 2.0)
+        self.monkey_patcher.addPatch(rate_limiter.constants,
+                "heavy_hitter_window", 10)
+        self.monkey_patcher.patch()
+        rl = RateLimiter()
+        for i in range(10):
+            rl.consume(self.packet, ("10.0.0.1", i))
+        self.assertEquals(0, rl.penalties)
+        self.assertFalse(rl.consume(self.packet, ("10.0.0.1", 99)))
+        self.assertEquals(1, rl.penalties)
+        # Even with a refilled budget, the IP stays penalized
+        self.clock.set(rate_limiter.constants.heavy_hitter_penalty - 1)
+        self.assertFalse(rl.consume(self.packet, ("10.0.0.1", 99)))
+        self.assertEquals(1, rl.penalized_drops)
+        self.assertTrue(rl.consume(self.packet, ("10.0.0.2", 99)))
+
+    def test_consume_doesNotPenalizeWhenToldNotTo(self):
+        rl = RateLimiter(penalize=False)
+        for i in range(1000):
+            rl.consume(self.packet, ("10.0.0.1", i))
+        self.assertEquals(0, rl.penalties)
+        self.clock.set(1)
+        self.assertTrue(rl.consume(self.packet, ("10.0.0.1", 1)))
+
+class HeavyHitterTestCase(TestingBase, unittest.TestCase):
+    def _send_steadily(self, rl, rate, seconds):
+        """Send rate bytes every second, in 1 KB packets"""
+        packet = "x" * 1024
+        consumed = 0
+        for second in xrange(seconds):
+            self.clock.set(second)
+            for i in xrange(rate // len(packet)):
+                consumed += rl.consume(packet, ("10.0.0.1", 1))
+        return consumed
+
+    def test_consume_allowedRateIsNotPenalized(self):
+        rl = RateLimiter()
+        rate = rate_limiter.constants.host_bandwidth_rate
+        consumed = self._send_steadily(rl, rate, 100)
+        self.assertEquals(0, rl.penalties)
+        self.assertEquals(100 * rate // 1024, consumed)
+
+    def test_consume_floodIsPenalized(self):
+        rl = RateLimiter()
+        rate = 2 * rate_limiter.constants.heavy_hitter_rate
+        self._send_steadily(rl, rate, 20)
+        self.assertEquals(1, rl.penalties)
+        self.assertTrue(rl.penalized_drops > 0)
+
+class CountMinSketchTestCase(TestingBase, unittest.TestCase):
+    def test_add_neverUnderestimates(self):
+        sketch = CountMinSketch(10, width=64, depth=4)
+        for i in range(500):
+            sketch.add(str(i % 50), 1)
+        for i in range(50):
+            self.assertTrue(sketch.estimate(str(i)) >= 10)
+
+    def test_add_decaysEveryWindow(self):
+        sketch = CountMinSketch(10)
+        sketch.add("a", 100)
+        self.clock.set(10)
+        self.assertEquals(50, sketch.estimate("a"))
+        # Windows without any additions still count
+        self.clock.set(30)
+        self.assertEquals(12.5, sketch.estimate("a"))
+
+    def test_steady_estimate_boundsSteadyRate(self):
+        sketch = CountMinSketch(10)
+        highest = 0
+        for second in range(200):
+            self.clock.set(second)
+            highest = max(highest, sketch.add("a", 100))
+        self.assertTrue(highest <= sketch.steady_estimate(100))
+        self.assertTrue(highest > 0.9 * sketch.steady_estimate(100))
+
 class TokenBucketTestCase(TestingBase, unittest.TestCase):
     def test_can_consume_enoughTokens(self):
         tb = TokenBucket(10, 1)
@@ -111,6 +224,46 @@ class TokenBucketTestCase(TestingBase, unittest.TestCase):
         self.assertFalse(tb.consume(100))
         self.assertEquals(10, tb.tokens)
 
+    def test_tokens_followsTheGivenClock(self):
+        reactor = task.Clock()
+        tb = TokenBucket(10, 10, clock=reactor)
+        tb.consume(10)
+        self.clock.set(10)
+        self.assertEquals(0, tb.tokens)
+        reactor.advance(0.5)
+        self.assertEquals(5, tb.tokens)
+
+class HostBucketsTestCase(TestingBase, unittest.TestCase):
+    def test_consume_perHostBudget(self):
+        hb = HostBuckets(10, 10)
+        self.assertTrue(hb.consume(("127.0.0.1", 1), 10))
+        self.assertFalse(hb.consume(("127.0.0.1", 1), 1))
+        self.assertTrue(hb.consume(("127.0.0.1", 2), 10))
+        self.clock.set(0.5)
+        self.assertEquals(5, hb.tokens(("127.0.0.1", 1)))
+
+    def test_consume_expiresIdleHosts(self):
+        hb = HostBuckets(10, 10, max_hosts=100)
+        for port in range(1, 11):
+            hb.consume(("127.0.0.1", port), 1)
+        self.assertEquals(10, len(hb))
+        # After a second every bucket has refilled, so the
+        # idle hosts are forgotten as the table is used
+        self.clock.set(1)
+        for i in range(10):
+            hb.consume(("127.0.0.2", 1), 1)
+        self.assertEquals(1, len(hb))
+        self.assertEquals(10, hb.expirations)
+
+    def test_consume_boundedUnderFlood(self):
+        hb = HostBuckets(10, 10, max_hosts=50)
+        for port in range(1, 1001):
+            self.assertTrue(hb.consume(("127.0.0.1", port), 10))
+        self.assertEquals(50, len(hb))
+        self.assertEquals(950, hb.evictions)
+        # A recently seen host is still being limited
+        self.assertFalse(hb.consume(("127.0.0.1", 1000), 1))
+
 class RateLimiterPatcherTestCase(unittest.TestCase):
     def setUp(self):
         self.clock = Clock()
@@ -232,6 +385,38 @@ class RateLimiterPatcherTestCase(unittest.TestCase):
         self.assertTrue(
                 rate_limited_proto._original.transport._packet_was_sent())
 
+    def test_outbound_encodesOnce(self):
+        # Leave room for the larger transaction IDs of sendQuery
+        self.monkey_patcher.addPatch(rate_limiter.constants,
+                "host_bandwidth_rate", 2 * len(self.packet))
+        self.monkey_patcher.patch()
+        rate_limited_proto = self._patched_sender()
+        rate_limited_proto._original._reactor = HollowReactor()
+        counter = Counter(krpc_coder.encode)
+        self.monkey_patcher.addPatch(krpc_coder, "encode", counter)
+        self.monkey_patcher.patch()
+        rate_limited_proto.sendQuery(self.query, self.address, 10)
+        self.assertEquals(1, counter.count)
+        self.assertTrue(
+                rate_limited_proto._original.transport._packet_was_sent())
+
+    def test_outbound_limitsTheProtocolsOwnTraffic(self):
+        rate_limited_proto = self._patched_sender()
+        rate_limited_proto._original._reactor = HollowReactor()
+        transport = rate_limited_proto._original.transport
+        # The original sends responses and queries itself (without
+        # going through the patcher's sendKRPC), and both are limited
+        response = self.query.build_response()
+        response._from = 15
+        rate_limited_proto.sendResponse(response, self.address)
+        self.assertEquals(krpc_coder.encode(response), transport.packet)
+        self.assertTrue(transport._packet_was_sent())
+        rate_limited_proto.sendQuery(self.query, self.address, 10)
+        self.assertFalse(transport._packet_was_sent())
+        self.clock.set(1)
+        rate_limited_proto.sendResponse(response, self.address)
+        self.assertTrue(transport._packet_was_sent())
+
     def test_outbound_overflowGlobalAndReset(self):
         """
         Make sure that we cannot overflow our outbound global bandwidth limit
@@ -0,0 +1,165 @@
+import os
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from dhtbot import constants
+from dhtbot.contact import Node
+from dhtbot.extensions.snapshot import (
+        save_snapshot, load_snapshot, SnapshotError, Revalidator,
+        Snapshot_Patcher)
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.protocols.errors import TimeoutError
+from dhtbot.protocols.krpc_responder import KRPC_Responder
+
+make_node = lambda num: Node(2**150 + num, ("127.0.0.1", num))
+
+class DeferredPinger(object):
+    """Remember every ping so that the test can answer it"""
+    def __init__(self):
+        self.pending = []
+
+    def __call__(self, address, timeout=None):
+        d = defer.Deferred()
+        self.pending.append((address, d))
+        return d
+
+class SnapshotTestingBase(object):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(self._remove, self.path)
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+class SnapshotTestCase(SnapshotTestingBase, unittest.TestCase):
+    def test_save_and_load_restoresNodesAndStats(self):
+        rt = TreeRoutingTable(2**159)
+        nodes = [make_node(num) for num in range(1, 6)]
+        for node in nodes:
+            node.successcount = node.address[1]
+            node.failcount = 1
+            node.totalrtt = 0.5
+            rt.offer_node(node)
+        self.assertEquals(5, save_snapshot(rt, self.path))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        snapshot = load_snapshot(self.path)
+        self.assertEquals(2**159, snapshot.node_id)
+        restored = sorted(snapshot.nodes, key=lambda node: node.node_id)
+        self.assertEquals(nodes, restored)
+        for (node, restored_node) in zip(nodes, restored):
+            self.assertEquals(node.last_updated, restored_node.last_updated)
+            self.assertEquals(node.successcount, restored_node.successcount)
+            self.assertEquals(1, restored_node.failcount)
+            self.assertEquals(0.5, restored_node.totalrtt)
+
+    def test_load_truncatedSnapshot(self):
+        rt = TreeRoutingTable(2**159)
+        rt.offer_node(make_node(1))
+        save_snapshot(rt, self.path)
+        data = open(self.path, "rb").read()
+        open(self.path, "wb").write(data[:-1])
+        self.assertRaises(SnapshotError, load_snapshot, self.path)
+
+    def test_load_missingSnapshot(self):
+        os.remove(self.path)
+        self.assertRaises(SnapshotError, load_snapshot, self.path)
+
+class RevalidatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.ping = DeferredPinger()
+        self.rt = TreeRoutingTable(2**159)
+        self.nodes = [make_node(num) for num in range(1, 6)]
+        for node in self.nodes:
+            self.rt.offer_node(node)
+
+    def test_revalidate_pingsInBatches(self):
+        revalidator = Revalidator(self.ping, self.rt, self.reactor,
+                                  batch_size=2, interval=1)
+        revalidator.revalidate(self.nodes)
+        self.assertEquals(2, len(self.ping.pending))
+        self.reactor.advance(1)
+        self.assertEquals(4, len(self.ping.pending))
+        self.reactor.advance(1)
+        self.assertEquals(5, len(self.ping.pending))
+        self.assertEquals(0, revalidator.pending())
+        self.assertEquals([], self.reactor.getDelayedCalls())
+
+    def test_revalidate_evictsUnresponsiveNodes(self):
+        revalidator = Revalidator(self.ping, self.rt, self.reactor,
+                                  batch_size=5, interval=1)
+        revalidator.revalidate(self.nodes)
+        (address, d) = self.ping.pending.pop(0)
+        d.errback(TimeoutError())
+        for (address, d) in self.ping.pending:
+            d.callback(None)
+        self.assertEquals(1, revalidator.evicted)
+        self.assertEquals(4, revalidator.revalidated)
+        self.assertEquals(None, self.rt.get_node(self.nodes[0].node_id))
+
+class SnapshotPatcherTestCase(SnapshotTestingBase, unittest.TestCase):
+    def test_startProtocol_restoresAndRevalidates(self):
+        rt = TreeRoutingTable(2**159)
+        nodes = [make_node(num) for num in range(1, 4)]
+        for node in nodes:
+            rt.offer_node(node)
+        save_snapshot(rt, self.path)
+
+        reactor = task.Clock()
+        patcher = Snapshot_Patcher(KRPC_Responder(node_id=2**159),
+                                   self.path, reactor)
+        pinger = DeferredPinger()
+        patcher.revalidator.ping = pinger
+        patcher.startProtocol()
+        for node in nodes:
+            self.assertEquals(node,
+                    patcher.original.routing_table.get_node(node.node_id))
+        self.assertEquals(3, len(pinger.pending))
+        patcher.stopProtocol()
+
+    def test_startProtocol_savesEveryInterval(self):
+        os.remove(self.path)
+        reactor = task.Clock()
+        kresponder = KRPC_Responder(node_id=2**159)
+        patcher = Snapshot_Patcher(kresponder, self.path, reactor)
+        patcher.startProtocol()
+        self.assertFalse(os.path.exists(self.path))
+        kresponder.routing_table.offer_node(make_node(1))
+        reactor.advance(constants.DUMPinterval)
+        self.assertEquals([make_node(1)], load_snapshot(self.path).nodes)
+        kresponder.routing_table.offer_node(make_node(2))
+        patcher.stopProtocol()
+        self.assertEquals(2, len(load_snapshot(self.path).nodes))
+
+    def test_stopProtocol_stopsOriginal(self):
+        os.remove(self.path)
+        kresponder = KRPC_Responder(node_id=2**159)
+        stopped = []
+        kresponder.stopProtocol = lambda: stopped.append(True)
+        patcher = Snapshot_Patcher(kresponder, self.path, task.Clock())
+        patcher.startProtocol()
+        patcher.stopProtocol()
+        self.assertEquals([True], stopped)
+
+    def test_startProtocol_rebucketsForeignSnapshot(self):
+        rt = TreeRoutingTable(2**159)
+        nodes = [make_node(num) for num in range(1, 4)]
+        for node in nodes:
+            rt.offer_node(node)
+        save_snapshot(rt, self.path)
+
+        # Our node_id is that of one of the snapshot's nodes
+        kresponder = KRPC_Responder(node_id=nodes[0].node_id)
+        patcher = Snapshot_Patcher(kresponder, self.path, task.Clock())
+        patcher.revalidator.ping = DeferredPinger()
+        patcher.startProtocol()
+        self.assertEquals(None,
+                kresponder.routing_table.get_node(nodes[0].node_id))
+        for node in nodes[1:]:
+            self.assertEquals(node,
+                    kresponder.routing_table.get_node(node.node_id))
+        patcher.stopProtocol()
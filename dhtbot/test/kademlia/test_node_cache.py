@@ -0,0 +1,78 @@
+from twisted.trial import unittest
+
+from dhtbot import contact
+from dhtbot.contact import Node
+from dhtbot.kademlia.node_cache import ClosestNodesCache, EncodedNodes
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+
+make_node = lambda num: Node(num, ("127.0.0.1", num % 65536))
+
+# Helper class for ClosestNodesCacheTestCase
+class UnversionedRoutingTable(object):
+    """A routing table without a version (@see IRoutingTable.version)"""
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def get_closest_nodes(self, node_id, num_nodes=8):
+        return self.nodes[:num_nodes]
+
+class EncodedNodesTestCase(unittest.TestCase):
+    def test_encoded_isNodeConcatenation(self):
+        nodes = [make_node(2**150), make_node(2**140)]
+        encoded_nodes = EncodedNodes(nodes)
+        self.assertEquals(nodes, encoded_nodes)
+        self.assertEquals("".join(map(contact.encode_node, nodes)),
+                          encoded_nodes.encoded)
+
+class ClosestNodesCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rt = TreeRoutingTable(2**159)
+        for num in range(1, 6):
+            self.rt.offer_node(make_node(num * 2**150))
+        self.cache = ClosestNodesCache(self.rt, prefix_bits=8)
+
+    def test_get_closest_nodes_sharedPrefixHits(self):
+        nodes = self.cache.get_closest_nodes(2**150)
+        self.assertEquals(self.rt.get_closest_nodes(2**150), nodes)
+        # Same 8 bit prefix
+        self.assertTrue(nodes is self.cache.get_closest_nodes(2**150 + 1))
+        self.assertEquals(1, self.cache.hits)
+        self.assertEquals(1, self.cache.misses)
+        self.assertEquals(0.5, self.cache.hit_rate())
+        # Different prefix
+        self.cache.get_closest_nodes(2**158)
+        self.assertEquals(2, self.cache.misses)
+
+    def test_get_closest_nodes_invalidatedByRoutingTable(self):
+        self.cache.get_closest_nodes(2**150)
+        new_node = make_node(2**150 + 7)
+        self.rt.offer_node(new_node)
+        self.assertTrue(new_node in self.cache.get_closest_nodes(2**150))
+        self.rt.remove_node(new_node)
+        self.assertFalse(new_node in self.cache.get_closest_nodes(2**150))
+        self.assertEquals(0, self.cache.hits)
+
+    def test_get_closest_nodes_evictsLeastRecentlyUsed(self):
+        cache = ClosestNodesCache(self.rt, prefix_bits=8, max_entries=2)
+        cache.get_closest_nodes(1 * 2**152)
+        cache.get_closest_nodes(2 * 2**152)
+        cache.get_closest_nodes(1 * 2**152)
+        cache.get_closest_nodes(3 * 2**152)
+        cache.get_closest_nodes(1 * 2**152)
+        self.assertEquals(2, cache.hits)
+        cache.get_closest_nodes(2 * 2**152)
+        self.assertEquals(2, cache.hits)
+
+    def test_hit_rate_noLookups(self):
+        self.assertEquals(0.0, self.cache.hit_rate())
+
+    def test_get_closest_nodes_unversionedRoutingTableIsNotCached(self):
+        rt = UnversionedRoutingTable([make_node(2**150)])
+        cache = ClosestNodesCache(rt, prefix_bits=8)
+        self.assertEquals([make_node(2**150)],
+                          cache.get_closest_nodes(2**150))
+        rt.nodes = [make_node(2**151)]
+        self.assertEquals([make_node(2**151)],
+                          cache.get_closest_nodes(2**150))
+        self.assertEquals(0, cache.hits)
+        self.assertEquals(2, cache.misses)
@@ -67,6 +67,19 @@ class TreeRoutingTableTestCase(unittest.TestCase):
             self.assertTrue(node_removed)
         self.assertEquals(0, len(nodes_in_rt(rt)))
 
+    def test_version_changesWithContents(self):
+        rt = TreeRoutingTable(node_id=2**16)
+        node = generate_node(15)
+        version = rt.version
+        rt.offer_node(node)
+        self.assertTrue(rt.version > version)
+        version = rt.version
+        # Offering a known node does not change the table
+        rt.offer_node(node)
+        self.assertEquals(version, rt.version)
+        rt.remove_node(node)
+        self.assertTrue(rt.version > version)
+
     def test_offer_node_properNumKBuckets(self):
         rt = TreeRoutingTable(node_id=1)
         # range(2, 9) generates 7 numbers
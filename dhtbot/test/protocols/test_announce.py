@@ -0,0 +1,78 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from dhtbot.protocols.announce import AnnounceScheduler
+from dhtbot.protocols.krpc_iterator import IterationError
+
+class AnnounceRecorder(object):
+    def __init__(self):
+        self.announces = []
+        self.result = None
+
+    def __call__(self, infohash, port):
+        self.announces.append((infohash, port))
+        if self.result is not None:
+            return defer.fail(self.result)
+        return defer.succeed([])
+
+class AnnounceSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.announce = AnnounceRecorder()
+        self.scheduler = AnnounceScheduler(self.announce, self.clock,
+                interval=100, tick=1, max_per_tick=2)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_tick_announcesDueInfohashes(self):
+        self.scheduler.add(15, 5555, delay=0)
+        self.scheduler.add(16, 5556, delay=10)
+        self.clock.advance(1)
+        self.assertEquals([(15, 5555)], self.announce.announces)
+        self.clock.pump([1] * 10)
+        self.assertEquals([(15, 5555), (16, 5556)], self.announce.announces)
+
+    def test_tick_reannouncesEveryInterval(self):
+        self.scheduler.add(15, 5555, delay=0)
+        self.clock.pump([1] * 201)
+        self.assertEquals(3, len(self.announce.announces))
+
+    def test_tick_spreadsLoad(self):
+        for infohash in range(5):
+            self.scheduler.add(infohash, 5555, delay=0)
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.announce.announces))
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEquals(5, len(self.announce.announces))
+
+    def test_add_spreadsOverInterval(self):
+        for infohash in range(50):
+            self.scheduler.add(infohash, 5555)
+        self.clock.advance(1)
+        self.assertTrue(len(self.announce.announces) < 50)
+
+    def test_remove(self):
+        self.scheduler.add(15, 5555, delay=0)
+        self.scheduler.remove(15)
+        self.clock.advance(1)
+        self.assertEquals([], self.announce.announces)
+        self.assertEquals(0, self.scheduler.pending())
+
+    def test_remove_keepsScheduleBounded(self):
+        self.scheduler.add(1, 5555, delay=50)
+        for i in range(1000):
+            self.scheduler.add(15, 5555, delay=10)
+            self.scheduler.remove(15)
+        self.assertTrue(len(self.scheduler._schedule) <= 2)
+        # The live infohash is still announced
+        self.clock.pump([1] * 50)
+        self.assertEquals([(1, 5555)], self.announce.announces)
+
+    def test_tick_countsFailures(self):
+        self.announce.result = IterationError("no nodes")
+        self.scheduler.add(15, 5555, delay=0)
+        self.clock.advance(1)
+        self.assertEquals(1, self.scheduler.announce_failures)
@@ -0,0 +1,147 @@
+import os
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot import constants
+from dhtbot.contact import Node
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.krpc_types import Response
+from dhtbot.protocols import bootstrap
+from dhtbot.protocols.bootstrap import (
+        Bootstrapper, ResolverCache, StaticResolver, resolve_addresses)
+from dhtbot.protocols.errors import TimeoutError
+from dhtbot.protocols.krpc_iterator import IterationError
+from dhtbot.test.utils import Clock
+
+make_node = lambda num: Node(num, ("127.0.0.%d" % (num % 250), num))
+
+bootstrap_nodes = [("1.2.3.4", 6881), ("router.example.com", 6881),
+                   ("dht.example.com", 1337)]
+names = {"router.example.com": "5.6.7.8", "dht.example.com": "9.9.9.9"}
+
+class HollowIterator(object):
+    """Answer find_node probes with fixed nodes and record lookups"""
+    def __init__(self, dead_addresses=()):
+        self.node_id = 2**159
+        self.routing_table = TreeRoutingTable(self.node_id)
+        self.dead_addresses = set(dead_addresses)
+        self.probed = []
+        self.lookups = []
+
+    def find_node(self, address, node_id, timeout=None):
+        self.probed.append(address)
+        if address in self.dead_addresses:
+            return defer.fail(TimeoutError())
+        response = Response()
+        response.nodes = [make_node(address[1])]
+        return defer.succeed(response)
+
+    def find_lookup(self, target_id, nodes=None, timeout=None):
+        self.lookups.append((target_id, nodes))
+        for node in nodes or ():
+            self.routing_table.offer_node(node)
+        return defer.succeed(None)
+
+class TimingOutResolver(object):
+    """A resolver whose every lookup times out"""
+    def getHostByName(self, name, timeout=None):
+        return defer.fail(defer.TimeoutError(name))
+
+class TempFileTestingBase(object):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+        self.addCleanup(self._remove, self.path)
+        self.clock = Clock()
+        self.monkey_patcher = MonkeyPatcher()
+        self.monkey_patcher.addPatch(bootstrap.time, "time", self.clock)
+        self.monkey_patcher.patch()
+
+    def tearDown(self):
+        self.monkey_patcher.restore()
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+class ResolveAddressesTestCase(TempFileTestingBase, unittest.TestCase):
+    def test_resolve_addresses_resolvesOnlyHostnames(self):
+        resolver = StaticResolver(names)
+        results = []
+        resolve_addresses(bootstrap_nodes, resolver).addCallback(
+                results.append)
+        self.assertEquals([[("1.2.3.4", 6881), ("5.6.7.8", 6881),
+                            ("9.9.9.9", 1337)]], results)
+        self.assertEquals(["router.example.com", "dht.example.com"],
+                          resolver.lookups)
+
+    def test_resolve_addresses_dropsUnresolvableHosts(self):
+        resolver = StaticResolver({"dht.example.com": "9.9.9.9"})
+        results = []
+        resolve_addresses(bootstrap_nodes, resolver).addCallback(
+                results.append)
+        self.assertEquals([[("1.2.3.4", 6881), ("9.9.9.9", 1337)]], results)
+
+    def test_resolve_addresses_usesCache(self):
+        cache = ResolverCache(self.path)
+        resolve_addresses(bootstrap_nodes, StaticResolver(names), cache)
+        cache.save()
+        # A fresh entry is used without resolving again
+        resolver = StaticResolver({})
+        cache = ResolverCache(self.path)
+        results = []
+        resolve_addresses(bootstrap_nodes, resolver, cache).addCallback(
+                results.append)
+        self.assertEquals([], resolver.lookups)
+        self.assertEquals(3, len(results[0]))
+        # A stale entry is only used when resolving fails
+        self.clock.set(constants.bootstrap_cache_timeout)
+        results = []
+        resolve_addresses(bootstrap_nodes, resolver, cache).addCallback(
+                results.append)
+        self.assertEquals(2, len(resolver.lookups))
+        self.assertEquals(3, len(results[0]))
+
+    def test_resolve_addresses_resolverTimeoutFallsBackOntoCache(self):
+        cache = ResolverCache(self.path)
+        cache.put("router.example.com", "5.6.7.8")
+        self.clock.set(constants.bootstrap_cache_timeout)
+        results = []
+        resolve_addresses(bootstrap_nodes, TimingOutResolver(),
+                          cache).addCallback(results.append)
+        self.assertEquals([[("1.2.3.4", 6881), ("5.6.7.8", 6881)]], results)
+
+class BootstrapperTestCase(TempFileTestingBase, unittest.TestCase):
+    def test_bootstrap_probesEveryAddressAndRefreshesKBuckets(self):
+        protocol = HollowIterator()
+        bootstrapper = Bootstrapper(protocol, StaticResolver(names),
+                                    cache_path=self.path,
+                                    bootstrap_nodes=bootstrap_nodes)
+        results = []
+        bootstrapper.bootstrap().addCallback(results.append)
+        self.assertEquals([("1.2.3.4", 6881), ("5.6.7.8", 6881),
+                           ("9.9.9.9", 1337)], protocol.probed)
+        self.assertEquals(3, bootstrapper.probes_answered)
+        (target_id, seeds) = protocol.lookups[0]
+        self.assertEquals(protocol.node_id, target_id)
+        self.assertEquals(set([make_node(6881), make_node(1337)]),
+                          set(seeds))
+        num_kbuckets = len(protocol.routing_table.get_kbuckets())
+        self.assertEquals(num_kbuckets, bootstrapper.refreshes)
+        self.assertEquals(1 + num_kbuckets, len(protocol.lookups))
+        self.assertEquals([2], results)
+        self.assertEquals("5.6.7.8",
+                          ResolverCache(self.path).get("router.example.com"))
+
+    def test_bootstrap_noReachableNodes(self):
+        addresses = [("1.2.3.4", 6881)]
+        protocol = HollowIterator(addresses)
+        bootstrapper = Bootstrapper(protocol, StaticResolver({}),
+                                    bootstrap_nodes=addresses)
+        d = bootstrapper.bootstrap()
+        self.assertFailure(d, IterationError)
+        return d
@@ -0,0 +1,154 @@
+import os
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from dhtbot import constants, contact
+from dhtbot.contact import Node
+from dhtbot.protocols.crawler import Crawler, SeenSet, FileSink
+from dhtbot.protocols.krpc_iterator import IterationError
+
+make_node = lambda num: Node(num, ("127.0.0.1", num))
+
+class HollowIterator(object):
+    """Answer every find_lookup by streaming a fixed set of nodes"""
+    def __init__(self, nodes, synchronous=True):
+        self.nodes = nodes
+        self.targets = []
+        self.pending = []
+        self.synchronous = synchronous
+
+    def find_lookup(self, target_id, listener=None, use_cache=True):
+        self.targets.append(target_id)
+        self.used_cache = use_cache
+        listener(None, self.nodes, [])
+        if self.synchronous:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+class HollowSampleIterator(HollowIterator):
+    """Answer every sample_lookup with a fixed set of samples"""
+    def __init__(self, nodes, samples):
+        HollowIterator.__init__(self, nodes)
+        self.samples = samples
+
+    def sample_lookup(self, target_id, listener=None, sample_listener=None,
+                      use_cache=True):
+        sample_listener(None, self.samples)
+        return self.find_lookup(target_id, listener=listener,
+                                use_cache=use_cache)
+
+class SeenSetTestCase(unittest.TestCase):
+    def test_add_reportsNewKeys(self):
+        seen = SeenSet(1000, 0.001)
+        self.assertTrue(seen.add("a"))
+        self.assertFalse(seen.add("a"))
+        self.assertTrue("a" in seen)
+        self.assertFalse("b" in seen)
+        self.assertEquals(1, seen.count)
+
+    def test_add_fewFalsePositives(self):
+        seen = SeenSet(1000, 0.01)
+        new_keys = sum(seen.add(str(i)) for i in range(1000))
+        self.assertTrue(new_keys > 980)
+
+class CrawlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.discovered = []
+
+    def test_start_sweepsEverySlice(self):
+        protocol = HollowIterator([make_node(1)])
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=2, max_lookups=8, lookup_rate=100)
+        results = []
+        crawler.start().addCallback(results.append)
+        self.assertEquals([crawler], results)
+        # Slices are visited in bit reversed order
+        prefixes = [target >> (constants.id_size - 2)
+                    for target in protocol.targets]
+        self.assertEquals([0, 2, 1, 3], prefixes)
+        # One-off crawl targets are kept out of the lookup cache
+        self.assertFalse(protocol.used_cache)
+
+    def test_start_deduplicatesNodes(self):
+        nodes = [make_node(num) for num in range(1, 6)]
+        protocol = HollowIterator(nodes)
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=3, lookup_rate=100)
+        crawler.start()
+        self.assertEquals(nodes, self.discovered)
+        self.assertEquals(5, crawler.nodes_discovered)
+
+    def test_start_concurrencyLimit(self):
+        protocol = HollowIterator([], synchronous=False)
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=3, max_lookups=2, lookup_rate=100)
+        crawler.start()
+        self.assertEquals(2, len(protocol.pending))
+        protocol.pending.pop(0).callback(None)
+        self.assertEquals(3, len(protocol.targets))
+
+    def test_start_rateLimit(self):
+        protocol = HollowIterator([])
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=3, lookup_rate=2)
+        crawler.start()
+        self.assertEquals(2, len(protocol.targets))
+        # The bucket follows the reactor's clock
+        self.reactor.advance(0.5)
+        self.assertEquals(3, len(protocol.targets))
+        self.reactor.advance(0.5)
+        self.assertEquals(4, len(protocol.targets))
+
+    def test_init_rejectsZeroRate(self):
+        protocol = HollowIterator([])
+        self.assertRaises(ValueError, Crawler, protocol, self.reactor,
+                          self.discovered.append, lookup_rate=0)
+
+    def test_start_countsFailedLookups(self):
+        protocol = HollowIterator([], synchronous=False)
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=0, lookup_rate=100)
+        crawler.start()
+        protocol.pending.pop().errback(IterationError("timed out"))
+        self.assertEquals(1, crawler.lookups_failed)
+        self.assertTrue(crawler.deferred.called)
+
+    def test_start_harvestsSamples(self):
+        protocol = HollowSampleIterator([make_node(1)], [2**150, 7])
+        harvested = []
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=2, lookup_rate=100,
+                          sample_sink=harvested.append)
+        crawler.start()
+        self.assertEquals([2**150, 7], harvested)
+        self.assertEquals(2, crawler.samples_discovered)
+        self.assertEquals([make_node(1)], self.discovered)
+        self.assertFalse(protocol.used_cache)
+
+    def test_throughput(self):
+        protocol = HollowIterator([make_node(1), make_node(2)],
+                                  synchronous=False)
+        crawler = Crawler(protocol, self.reactor, self.discovered.append,
+                          sweep_bits=0, lookup_rate=100)
+        crawler.start()
+        self.reactor.advance(4)
+        protocol.pending.pop().callback(None)
+        self.assertEquals(0.5, crawler.throughput())
+
+class FileSinkTestCase(unittest.TestCase):
+    def test_call_writesCompactNodes(self):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        sink = FileSink(path)
+        sink(make_node(1))
+        sink(make_node(2))
+        sink.close()
+        data = open(path, "rb").read()
+        self.assertEquals(52, len(data))
+        self.assertEquals(make_node(2), contact.decode_node(data[26:]))
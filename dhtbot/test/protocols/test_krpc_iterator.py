@@ -170,6 +170,164 @@ class KRPC_Iterator_TestCase(unittest.TestCase):
         # uncalled deferred
         self.assertTrue(d.called)
 
+    #
+    # Lookup test cases
+    #
+    def test_find_lookup_noNodesRaisesIterationError(self):
+        self._check_k_iter_raisesIterationErrorOnNoSeedNodes(
+                self.k_iter.find_lookup)
+
+    def test_get_lookup_allQueriesTimeoutRaisesIterationError(self):
+        self._check_k_iter_failsWhenAllQueriesTimeOut(
+                self.k_iter.get_lookup)
+
+    def test_find_lookup_queriesReturnedNodes(self):
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        d = self.k_iter.find_lookup(self.target_id, test_nodes[100:101])
+        (query, deferred) = self.k_iter.sendQuery.deferreds[0]
+        # The seed node knows of a node closer to the target
+        response = query.build_response(nodes=[test_nodes[0]])
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        self.assertEquals(2, len(self.k_iter.sendQuery.deferreds))
+        (query, deferred) = self.k_iter.sendQuery.deferreds[1]
+        response = query.build_response(nodes=[])
+        response._from = test_nodes[0].node_id
+        deferred.callback(response)
+        lookups = []
+        d.addCallback(lookups.append)
+        (lookup,) = lookups
+        self.assertEquals([test_nodes[0], test_nodes[100]],
+                          lookup.closest_nodes())
+        self.assertEquals(2, lookup.stats.rounds)
+
+    def test_get_lookup_returnsCachedPeers(self):
+        self.k_iter.routing_table.offer_node(test_nodes[100])
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        self.k_iter.get_lookup(self.target_id)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[0]
+        response = query.build_response(peers=[test_peers[0]], token=5)
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        # The second lookup is answered from the cache
+        lookups = []
+        self.k_iter.get_lookup(self.target_id).addCallback(lookups.append)
+        self.assertEquals(1, len(self.k_iter.sendQuery.deferreds))
+        self.assertEquals(set([test_peers[0]]), lookups[0].peers)
+        self.assertEquals(1, self.k_iter.lookup_cache.hits)
+
+    def test_find_lookup_startsFromCachedNodes(self):
+        self.k_iter.routing_table.offer_node(test_nodes[100])
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        self.k_iter.find_lookup(self.target_id)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[0]
+        response = query.build_response(nodes=[])
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        # The routing table no longer knows of any nodes, but
+        # the cached lookup does
+        self.k_iter.routing_table.remove_node(test_nodes[100])
+        self.k_iter.find_lookup(self.target_id)
+        self.assertEquals(2, len(self.k_iter.sendQuery.deferreds))
+
+    def test_find_lookup_withoutCacheBypassesCache(self):
+        self.k_iter.routing_table.offer_node(test_nodes[100])
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        lookups = []
+        d = self.k_iter.find_lookup(self.target_id, use_cache=False)
+        d.addCallback(lookups.append)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[0]
+        response = query.build_response(nodes=[])
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        self.assertEquals(1, len(lookups))
+        self.assertEquals(None, self.k_iter.lookup_cache.get(self.target_id))
+
+    def test_announce_sendsAnnouncePeerWithTokens(self):
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        for node in test_nodes[:2]:
+            self.k_iter.routing_table.offer_node(node)
+        d = self.k_iter.announce(self.target_id, 5555)
+        # Answer the get_peers queries (only the first
+        # queried node hands out a token)
+        get_peers = list(self.k_iter.sendQuery.deferreds)
+        self.assertEquals(2, len(get_peers))
+        token_address = self.k_iter._transactions[
+                get_peers[0][0]._transaction_id].address
+        for (i, (query, deferred)) in enumerate(get_peers):
+            response = query.build_response(nodes=[])
+            response._from = test_nodes[i].node_id
+            if i == 0:
+                response.token = 77
+            deferred.callback(response)
+        announces = self.k_iter.sendQuery.deferreds[2:]
+        self.assertEquals(1, len(announces))
+        (query, deferred) = announces[0]
+        self.assertEquals("announce_peer", query.rpctype)
+        self.assertEquals(77, query.token)
+        self.assertEquals(5555, query.port)
+        self.assertEquals(token_address, self.k_iter._transactions[
+                query._transaction_id].address)
+        results = []
+        d.addCallback(results.append)
+        response = query.build_response()
+        response._from = 1
+        deferred.callback(response)
+        self.assertEquals(1, len(results))
+        self.assertEquals([token_address],
+                          [node.address for node in results[0]])
+
+    def test_announce_afterFindLookupQueriesForTokens(self):
+        self.k_iter.routing_table.offer_node(test_nodes[100])
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        self.k_iter.find_lookup(self.target_id)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[0]
+        response = query.build_response(nodes=[])
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        # The cached find_node lookup holds no tokens, so
+        # announcing has to ask for them with get_peers
+        d = self.k_iter.announce(self.target_id, 5555)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[1]
+        self.assertEquals("get_peers", query.rpctype)
+        response = query.build_response(nodes=[], token=77)
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[2]
+        self.assertEquals("announce_peer", query.rpctype)
+        self.assertEquals(77, query.token)
+        results = []
+        d.addCallback(results.append)
+        response = query.build_response()
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        self.assertEquals([[test_nodes[100]]], results)
+
+    def test_announce_reusesCachedTokens(self):
+        self.k_iter.routing_table.offer_node(test_nodes[100])
+        sendQuery = self.k_iter.sendQuery
+        self.k_iter.sendQuery = DeferredGrabber(sendQuery)
+        self.k_iter.get_lookup(self.target_id)
+        (query, deferred) = self.k_iter.sendQuery.deferreds[0]
+        response = query.build_response(nodes=[], token=77)
+        response._from = test_nodes[100].node_id
+        deferred.callback(response)
+        # No peers were found, but the cached token can be used
+        self.k_iter.announce(self.target_id, 5555)
+        self.assertEquals(2, len(self.k_iter.sendQuery.deferreds))
+        (query, deferred) = self.k_iter.sendQuery.deferreds[1]
+        self.assertEquals("announce_peer", query.rpctype)
+
+    def test_announce_noNodesRaisesIterationError(self):
+        self._check_k_iter_raisesIterationErrorOnNoSeedNodes(
+                lambda target_id: self.k_iter.announce(target_id, 5555))
+
     # Auxilary test functions
     # that are generalizations of the test
     # cases below
@@ -92,6 +92,28 @@ class KRPC_ResponderTestCase(unittest.TestCase):
         actual_response = kresponder.sendResponse.response
         self.assertEquals(expected_response, actual_response)
 
+    def test_find_node_Received_cachesClosestNodes(self):
+        kresponder = self._patched_responder()
+        for i in range(1, 20):
+            kresponder.routing_table.offer_node(
+                    contact.Node(i * 2**150, ("127.0.0.%d" % i, i)))
+        incoming_query = Query()
+        incoming_query.rpctype = "find_node"
+        incoming_query._from = 123
+        incoming_query._transaction_id = 15
+        incoming_query.target_id = 2**153 + 1
+        for i in range(2):
+            kresponder.datagramReceived(krpc_coder.encode(incoming_query),
+                                        test_address)
+        cache = kresponder.closest_nodes_cache
+        self.assertEquals(1, cache.hits)
+        self.assertEquals(1, cache.misses)
+        response = kresponder.sendResponse.response
+        decoded = krpc_coder.decode(krpc_coder.encode(response))
+        self.assertEquals(
+                kresponder.routing_table.get_closest_nodes(2**153 + 1),
+                decoded.nodes)
+
     def test_find_node_Received_sendsValidResponseWithTargetNode(self):
         # Create the protocol and populate its
         # routing table with nodes
@@ -216,6 +238,28 @@ class KRPC_ResponderTestCase(unittest.TestCase):
         actual_response.peers.sort(key = lambda (ip, port) : port)
         self.assertEquals(expected_response, actual_response)
 
+    def test_sample_infohashes_Received_sendsValidResponse(self):
+        kresponder = self._patched_responder()
+        infohashes = range(1, 31)
+        for infohash in infohashes:
+            kresponder._datastore.put(infohash, test_address)
+        incoming_query = Query()
+        incoming_query.rpctype = "sample_infohashes"
+        incoming_query._from = 555
+        incoming_query._transaction_id = 15
+        incoming_query.target_id = 77
+        kresponder.datagramReceived(krpc_coder.encode(incoming_query),
+                                    test_address)
+        actual_response = kresponder.sendResponse.response
+        self.assertEquals("sample_infohashes", actual_response.rpctype)
+        self.assertEquals(15, actual_response._transaction_id)
+        self.assertEquals(30, actual_response.num)
+        self.assertEquals(constants.sample_infohashes_interval,
+                          actual_response.interval)
+        self.assertEquals(constants.sample_infohashes_max,
+                          len(set(actual_response.samples)))
+        self.assertTrue(set(actual_response.samples) <= set(infohashes))
+
     def test_announce_peer_Received_sendsValidResponse(self):
         kresponder = self._patched_responder()
         # announce_peer queries need a token (the token value
@@ -396,6 +440,22 @@ class _TokenGeneratorTestCase(unittest.TestCase):
         self.clock.set(constants._secret_timeout)
         self.assertTrue(self.tgen.verify(self.query, self.address, token))
 
+    def test_generate_fixedWidthBytes(self):
+        token = self.tgen.generate(self.query, self.address)
+        self.assertTrue(isinstance(token, str))
+        self.assertEquals(constants.tokensize / 8, len(token))
+
+    def test_verify_dependsOnIPOnly(self):
+        token = self.tgen.generate(self.query, self.address)
+        self.assertTrue(self.tgen.verify(self.query, ("127.0.0.1", 6), token))
+        self.assertFalse(self.tgen.verify(self.query, ("127.0.0.2", 5555),
+                                          token))
+
+    def test_verify_invalidToken(self):
+        self.tgen.generate(self.query, self.address)
+        self.assertFalse(self.tgen.verify(self.query, self.address, 5858))
+        self.assertFalse(self.tgen.verify(self.query, self.address, "abc"))
+
     def test_verify_tokenTimeout(self):
         token = self.tgen.generate(self.query, self.address)
         self.clock.set(constants.token_timeout - 1)
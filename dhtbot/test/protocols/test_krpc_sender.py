@@ -1,6 +1,7 @@
 from twisted.trial import unittest
 from twisted.python.monkey import MonkeyPatcher
 
+from dhtbot import constants, contact
 from dhtbot.krpc_types import Query, Response, Error
 from dhtbot.kademlia.routing_table import TreeRoutingTable
 from dhtbot.protocols import krpc_sender
@@ -101,6 +102,44 @@ class KRPC_Sender_ReceivedCallChainTestCase(unittest.TestCase):
         _restore_reactor()
         self.assertEquals(1, counter.count)
 
+    def test_registerQueryHandler_dispatchesExtensionQuery(self):
+        k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        k_messenger.startProtocol()
+        counter = Counter()
+        k_messenger.registerQueryHandler("sample_infohashes", counter)
+        self.query.rpctype = "sample_infohashes"
+        k_messenger.krpcReceived(self.query, address)
+        self.assertEquals(1, counter.count)
+        self.assertEquals(0, len(k_messenger.unknown_query_counts))
+
+    def test_registerQueryHandler_rebindsHandlers(self):
+        k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        k_messenger.startProtocol()
+        # Handlers are bound when the protocol starts...
+        counter = Counter()
+        k_messenger.ping_Received = counter
+        k_messenger.krpcReceived(self.query, address)
+        self.assertEquals(0, counter.count)
+        # ...and again after a handler is registered
+        k_messenger.registerQueryHandler("sample_infohashes", Counter())
+        k_messenger.krpcReceived(self.query, address)
+        self.assertEquals(1, counter.count)
+
+    def test_registerKRPCObserver_seesEveryKRPC(self):
+        k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        observed = []
+        k_messenger.registerKRPCObserver(
+                lambda krpc, address: observed.append((krpc, address)))
+        k_messenger.krpcReceived(self.query, address)
+        self.assertEquals([(self.query, address)], observed)
+
+    def test_queryReceived_countsUnknownRPCType(self):
+        k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.query.rpctype = "get"
+        k_messenger.krpcReceived(self.query, address)
+        k_messenger.krpcReceived(self.query, address)
+        self.assertEquals(2, k_messenger.unknown_query_counts["get"])
+
 class KRPC_Sender_DeferredTestCase(unittest.TestCase):
     def setUp(self):
         _swap_out_reactor()
@@ -135,6 +174,37 @@ class KRPC_Sender_DeferredTestCase(unittest.TestCase):
         self.assertFalse(self.query._transaction_id in
                          self.k_messenger._transactions)
 
+    def test_datagramReceived_dropsLateReply(self):
+        d = self.k_messenger.sendQuery(self.query, address, timeout)
+        response = self.query.build_response()
+        response._from = 9
+        d.errback(TimeoutError())
+        d.addErrback(self._neutralize_TimeoutError)
+        # Make sure the late reply is not even decoded
+        decodes = []
+        encoded_response = krpc_coder.encode(response)
+        decode_patcher = MonkeyPatcher((krpc_coder, "decode", decodes.append))
+        decode_patcher.runWithPatches(self.k_messenger.datagramReceived,
+                                      encoded_response, address)
+        self.assertEquals([], decodes)
+        self.assertEquals(1, self.k_messenger.dropped_reply_count)
+
+    def test_datagramReceived_dropsReplyFromOtherAddress(self):
+        counter = Counter()
+        d = self.k_messenger.sendQuery(self.query, address, timeout)
+        d.addCallback(counter)
+        response = self.query.build_response()
+        response._from = 9
+        other_address = (address[0], address[1] + 1)
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          other_address)
+        self.assertEquals(0, counter.count)
+        self.assertEquals(1, self.k_messenger.dropped_reply_count)
+        # The query is still waiting for its real reply
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        self.assertEquals(1, counter.count)
+
     def _error_equality(self, error, expected_error):
                 self.assertEquals(expected_error._transaction_id,
                                   error._transaction_id)
@@ -186,4 +256,146 @@ class KRPC_Sender_DeferredTestCase(unittest.TestCase):
         self.assertFalse(self.query._transaction_id in
                          self.k_messenger._transactions)
 
+    def test_errback_TimeoutErrorRemovesStaleNode(self):
+        stale_node = contact.Node(2**100, address)
+        stale_node.last_updated = 0
+        self.k_messenger.routing_table.offer_node(stale_node)
+        d = self.k_messenger.sendQuery(self.query, address, timeout)
+        d.errback(TimeoutError())
+        d.addErrback(self._neutralize_TimeoutError)
+        self.assertEquals(None,
+                self.k_messenger.routing_table.get_node_by_address(address))
+
+
+
+class KRPC_Sender_CoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.sendKRPC = Counter(self.k_messenger.sendKRPC)
+        self.k_messenger.sendKRPC = self.sendKRPC
+
+    def tearDown(self):
+        _restore_reactor()
+
+    def _get_peers(self, target_id, address):
+        query = Query()
+        query.rpctype = "get_peers"
+        query.target_id = target_id
+        return self.k_messenger.sendQuery(query, address, timeout)
+
+    def test_sendQuery_identicalQueriesShareOneResponse(self):
+        results = []
+        d1 = self._get_peers(15, address)
+        d2 = self._get_peers(15, address)
+        d1.addCallback(results.append)
+        d2.addCallback(results.append)
+        self.assertEquals(1, self.sendKRPC.count)
+        self.assertEquals(1, self.k_messenger.coalesced_query_count)
+        (transaction,) = self.k_messenger._transactions.values()
+        response = transaction.query.build_response(token=5)
+        response._from = 9
+        self.k_messenger.datagramReceived(
+                krpc_coder.encode(response), address)
+        self.assertEquals(2, len(results))
+        self.assertEquals(0, len(self.k_messenger._coalesced_queries))
+
+    def test_sendQuery_differentTargetsAreNotShared(self):
+        self._get_peers(15, address)
+        self._get_peers(16, address)
+        self._get_peers(15, ("127.0.0.1", 2929))
+        self.assertEquals(3, self.sendKRPC.count)
+
+    def test_sendQuery_sharedTimeout(self):
+        counter = Counter()
+        d1 = self._get_peers(15, address)
+        d2 = self._get_peers(15, address)
+        d2.addErrback(self._neutralize_TimeoutError)
+        d2.addCallback(counter)
+        d1.errback(TimeoutError())
+        d1.addErrback(self._neutralize_TimeoutError)
+        self.assertEquals(1, counter.count)
+
+    def _neutralize_TimeoutError(self, failure):
+        failure.trap(TimeoutError)
+
+class KRPC_Sender_MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        _swap_out_reactor()
+        self.clock = Clock()
+        self.time_patcher = MonkeyPatcher(
+                (krpc_sender.time, "time", self.clock))
+        self.time_patcher.patch()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.metrics = self.k_messenger.metrics
+        self.query = Query()
+        self.query.rpctype = "find_node"
+        self.query.target_id = 2**100
+
+    def tearDown(self):
+        self.time_patcher.restore()
+        _restore_reactor()
+
+    def _neutralize(self, failure):
+        pass
+
+    def test_response_recordsRTT(self):
+        self.clock.set(10)
+        self.k_messenger.sendQuery(self.query, address, timeout)
+        response = self.query.build_response(nodes=[])
+        response._from = 9
+        self.clock.set(10.5)
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        snapshot = self.metrics.snapshot()
+        self.assertEquals(1, snapshot["queries_sent"]["find_node"])
+        self.assertEquals(1, snapshot["responses_received"]["find_node"])
+        self.assertEquals(1, snapshot["rtt"]["find_node"]["count"])
+        self.assertEquals(0.5, snapshot["rtt"]["find_node"]["sum"])
 
+    def test_timeoutsAndErrors(self):
+        d = self.k_messenger.sendQuery(self.query, address, timeout)
+        d.addErrback(self._neutralize)
+        d.errback(TimeoutError())
+        query = Query()
+        query.rpctype = "ping"
+        d = self.k_messenger.sendQuery(query, address, timeout)
+        d.addErrback(self._neutralize)
+        self.k_messenger.datagramReceived(
+                krpc_coder.encode(query.build_error()), address)
+        snapshot = self.metrics.snapshot()
+        self.assertEquals(1, snapshot["timeouts"]["find_node"])
+        self.assertEquals(1, snapshot["errors_received"]["ping"])
+
+    def test_malformedAndOrphanedPackets(self):
+        self.k_messenger.datagramReceived("garbage", address)
+        response = self.query.build_response(nodes=[])
+        response._transaction_id = 15
+        response._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(response),
+                                          address)
+        self.assertEquals(1, self.metrics.malformed_packets)
+        self.assertEquals(1, self.metrics.orphaned_replies)
+
+    def test_queryReceived(self):
+        self.query._transaction_id = 15
+        self.query._from = 9
+        self.k_messenger.datagramReceived(krpc_coder.encode(self.query),
+                                          address)
+        self.assertEquals(1,
+                self.metrics.snapshot()["queries_received"]["find_node"])
+
+    def test_metricsDisabled(self):
+        patcher = MonkeyPatcher((constants, "metrics_enabled", False))
+        k_messenger = patcher.runWithPatches(KRPC_Sender,
+                                             TreeRoutingTable, 2**50)
+        k_messenger.transport = HollowTransport()
+        self.assertEquals(None, k_messenger.metrics)
+        k_messenger.datagramReceived("garbage", address)
+        k_messenger.sendQuery(self.query, address, timeout)
+        # Nothing was counted, yet the query was still sent
+        self.assertEquals(None, k_messenger.metrics)
+        self.assertEquals(address, k_messenger.transport.address)
+        self.assertTrue(k_messenger.transport._packet_was_sent())
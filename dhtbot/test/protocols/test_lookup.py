@@ -0,0 +1,260 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot import constants
+from dhtbot.contact import Node
+from dhtbot.krpc_types import Response
+from dhtbot.protocols import lookup as lookup_module
+from dhtbot.protocols.lookup import IterativeLookup, LookupCache
+from dhtbot.protocols.errors import TimeoutError
+from dhtbot.test.utils import Clock
+
+make_node = lambda num: Node(num, ("127.0.0.1", num))
+
+# A small network in which every node knows every other node
+network_nodes = [make_node(num) for num in range(1, 500)]
+nodes_by_address = dict((node.address, node) for node in network_nodes)
+
+def closest(target_id, nodes=network_nodes, k=constants.k):
+    return sorted(nodes, key=lambda node: node.distance(target_id))[:k]
+
+class SynchronousNetwork(object):
+    """Answer every query immediately with the num_nodes closest nodes"""
+    def __init__(self, dead_addresses=(), num_nodes=constants.k):
+        self.queried = []
+        self.dead_addresses = set(dead_addresses)
+        self.num_nodes = num_nodes
+
+    def find_node(self, address, target_id, timeout=None):
+        self.queried.append(address)
+        if address in self.dead_addresses:
+            return defer.fail(TimeoutError())
+        response = Response()
+        response._from = nodes_by_address[address].node_id
+        response.nodes = closest(target_id, k=self.num_nodes)
+        return defer.succeed(response)
+
+class DeferredNetwork(object):
+    """Remember every query so that the test can answer it"""
+    def __init__(self):
+        self.pending = []
+
+    def get_peers(self, address, target_id, timeout=None):
+        d = defer.Deferred()
+        self.pending.append((address, d))
+        return d
+
+class IterativeLookupTestCase(unittest.TestCase):
+    def test_start_convergesOnClosestNodes(self):
+        target_id = 77
+        network = SynchronousNetwork()
+        seeds = network_nodes[-20:]
+        lookup = IterativeLookup(network.find_node, target_id, seeds)
+        results = []
+        lookup.start().addCallback(results.append)
+        self.assertEquals([lookup], results)
+        self.assertEquals(closest(target_id), lookup.closest_nodes())
+        self.assertEquals(2, lookup.stats.rounds)
+        self.assertEquals(lookup.stats.queries, len(network.queried))
+        self.assertTrue(lookup.stats.end_time is not None)
+
+    def test_start_skipsFailedNodes(self):
+        target_id = 77
+        dead = [node.address for node in closest(target_id)[:3]]
+        network = SynchronousNetwork(dead, constants.k + 3)
+        lookup = IterativeLookup(network.find_node, target_id,
+                                 network_nodes[-20:])
+        lookup.start()
+        self.assertTrue(lookup.finished)
+        self.assertEquals(3, lookup.stats.failures)
+        expected = closest(target_id, k=constants.k + 3)[3:]
+        self.assertEquals(expected, lookup.closest_nodes())
+
+    def test_start_neverQueriesOwnID(self):
+        network = SynchronousNetwork()
+        own_id = closest(77)[0].node_id
+        lookup = IterativeLookup(network.find_node, 77,
+                                 network_nodes[-20:], own_id=own_id)
+        lookup.start()
+        self.assertFalse(("127.0.0.1", own_id) in network.queried)
+
+    def test_start_alphaQueriesInFlight(self):
+        network = DeferredNetwork()
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:20])
+        lookup.start()
+        self.assertEquals(constants.alpha, len(network.pending))
+        # Answering one query frees one slot
+        (address, d) = network.pending.pop(0)
+        response = Response()
+        response._from = nodes_by_address[address].node_id
+        response.peers = [("127.0.0.1", 5555)]
+        response.token = 99
+        d.callback(response)
+        self.assertEquals(constants.alpha, len(network.pending))
+        self.assertEquals(set([("127.0.0.1", 5555)]), lookup.peers)
+        self.assertEquals({response._from: 99}, lookup.tokens)
+        self.assertFalse(lookup.finished)
+
+    def test_start_finishesWhenEveryQueryFails(self):
+        network = DeferredNetwork()
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:2])
+        lookup.start()
+        for (address, d) in network.pending:
+            d.errback(TimeoutError())
+        self.assertTrue(lookup.finished)
+        self.assertEquals(2, lookup.stats.failures)
+        self.assertEquals([], lookup.closest_nodes())
+
+    def test_start_unexpectedFailureFreesItsSlot(self):
+        network = DeferredNetwork()
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:2])
+        lookup.start()
+        unexpected = []
+        for (address, d) in network.pending:
+            d.errback(ValueError())
+            d.addErrback(unexpected.append)
+        # The lookup finishes, and the failures are still passed on
+        self.assertTrue(lookup.finished)
+        self.assertEquals(2, lookup.stats.failures)
+        self.assertEquals(2, len(unexpected))
+        unexpected[0].trap(ValueError)
+
+    def test_listener_errorsDoNotStallTheLookup(self):
+        network = DeferredNetwork()
+        def listener(lookup, nodes, peers):
+            raise RuntimeError("listener bug")
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:20],
+                                 listener=listener)
+        lookup.start()
+        (address, d) = network.pending.pop(0)
+        response = Response()
+        response.nodes = [network_nodes[100]]
+        d.callback(response)
+        self.assertEquals(1, len(self.flushLoggedErrors(RuntimeError)))
+        self.assertEquals(1, lookup.stats.responses)
+        # The response's slot was handed to the next candidate
+        self.assertEquals(constants.alpha, len(network.pending))
+
+    def test_listener_streamsNewNodesAndPeers(self):
+        network = DeferredNetwork()
+        streamed = []
+        listener = lambda lookup, nodes, peers: streamed.append((nodes, peers))
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:3],
+                                 listener=listener)
+        lookup.start()
+        (address, d) = network.pending.pop(0)
+        response = Response()
+        response.nodes = [network_nodes[100], network_nodes[0]]
+        response.peers = [("127.0.0.1", 5555)]
+        d.callback(response)
+        # network_nodes[0] was a seed node, so it is not new
+        self.assertEquals([([network_nodes[100]], [("127.0.0.1", 5555)])],
+                          streamed)
+
+    def test_max_peers_stopsLookupEarly(self):
+        network = DeferredNetwork()
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:20],
+                                 max_peers=2)
+        results = []
+        lookup.start().addCallback(results.append)
+        (address, d) = network.pending.pop(0)
+        response = Response()
+        response.peers = [("127.0.0.1", 5555), ("127.0.0.1", 5556)]
+        d.callback(response)
+        # The remaining in flight queries do not hold back the result
+        self.assertEquals([lookup], results)
+        self.assertEquals(2, len(lookup.peers))
+        self.assertTrue(lookup.partial)
+
+    def test_sample_listener_streamsNewSamples(self):
+        network = DeferredNetwork()
+        streamed = []
+        sample_listener = lambda lookup, samples: streamed.append(samples)
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:3],
+                                 sample_listener=sample_listener)
+        lookup.start()
+        for samples in ([5, 6], [6, 7]):
+            (address, d) = network.pending.pop(0)
+            response = Response()
+            response.samples = samples
+            d.callback(response)
+        self.assertEquals([[5, 6], [7]], streamed)
+        self.assertEquals(set([5, 6, 7]), lookup.samples)
+
+    def test_stop_ignoresLateResponses(self):
+        network = DeferredNetwork()
+        lookup = IterativeLookup(network.get_peers, 77, network_nodes[:20])
+        lookup.start()
+        lookup.stop()
+        (address, d) = network.pending.pop(0)
+        response = Response()
+        response.peers = [("127.0.0.1", 5555)]
+        d.callback(response)
+        self.assertEquals(0, len(lookup.peers))
+        self.assertEquals(constants.alpha - 1, len(network.pending))
+
+class LookupCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.monkey_patcher = MonkeyPatcher()
+        self.monkey_patcher.addPatch(lookup_module.time, "time", self.clock)
+        self.monkey_patcher.patch()
+
+    def tearDown(self):
+        self.monkey_patcher.restore()
+
+    def _finished_lookup(self, target_id):
+        network = SynchronousNetwork()
+        lookup = IterativeLookup(network.find_node, target_id,
+                                 network_nodes[-20:])
+        lookup.start()
+        return lookup
+
+    def test_get_hitAndMiss(self):
+        cache = LookupCache(max_size=10, timeout=60)
+        self.assertEquals(None, cache.get(77))
+        cache.put(self._finished_lookup(77))
+        cached = cache.get(77)
+        self.assertEquals(closest(77), cached.closest_nodes())
+        self.assertEquals(1, cache.hits)
+        self.assertEquals(1, cache.misses)
+        self.assertEquals(0.5, cache.hit_rate())
+
+    def test_get_expiredEntry(self):
+        cache = LookupCache(max_size=10, timeout=60)
+        cache.put(self._finished_lookup(77))
+        self.clock.set(60)
+        self.assertEquals(None, cache.get(77))
+        self.assertEquals(0, len(cache))
+
+    def test_put_evictsLeastRecentlyUsed(self):
+        cache = LookupCache(max_size=2, timeout=60)
+        cache.put(self._finished_lookup(1))
+        cache.put(self._finished_lookup(2))
+        # Using target 1 makes target 2 the least recently used
+        cache.get(1)
+        cache.put(self._finished_lookup(3))
+        self.assertEquals(2, len(cache))
+        self.assertEquals(None, cache.get(2))
+        self.assertNotEquals(None, cache.get(1))
+
+    def test_put_replacesPeersOfExistingEntry(self):
+        cache = LookupCache(max_size=10, timeout=60)
+        lookup = self._finished_lookup(77)
+        lookup.peers.add(("127.0.0.1", 5555))
+        cache.put(lookup)
+        cache.put(self._finished_lookup(77))
+        self.assertEquals(set(), cache.get(77).peers)
+
+    def test_put_ignoresPartialLookup(self):
+        cache = LookupCache(max_size=10, timeout=60)
+        network = DeferredNetwork()
+        lookup = IterativeLookup(network.get_peers, 77,
+                                 network_nodes[-20:])
+        lookup.start()
+        lookup.stop()
+        self.assertTrue(lookup.partial)
+        self.assertEquals(None, cache.put(lookup))
+        self.assertEquals(0, len(cache))
+        self.assertFalse(self._finished_lookup(77).partial)
@@ -0,0 +1,171 @@
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.python.monkey import MonkeyPatcher
+
+from dhtbot.protocols import query_window, krpc_sender
+from dhtbot.protocols.query_window import QueryWindow
+from dhtbot.protocols.krpc_sender import KRPC_Sender
+from dhtbot.kademlia.routing_table import TreeRoutingTable
+from dhtbot.krpc_types import Query
+from dhtbot.protocols.errors import TimeoutError
+from dhtbot.test.utils import Clock, Counter, HollowReactor, HollowTransport
+
+address1 = ("127.0.0.1", 1111)
+address2 = ("127.0.0.1", 2222)
+address3 = ("127.0.0.1", 3333)
+
+class QueryWindowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.monkey_patcher = MonkeyPatcher()
+        self.monkey_patcher.addPatch(query_window.time, "time", self.clock)
+        self.monkey_patcher.patch()
+        self.reactor = task.Clock()
+
+    def tearDown(self):
+        self.monkey_patcher.restore()
+
+    def _window(self, max_outstanding, max_outstanding_per_host):
+        return QueryWindow(max_outstanding, max_outstanding_per_host,
+                           reactor=self.reactor)
+
+    def test_admit_globalLimit(self):
+        qw = self._window(max_outstanding=2, max_outstanding_per_host=2)
+        qw.acquire(address1)
+        self.assertTrue(qw.admit(address2))
+        qw.acquire(address2)
+        self.assertFalse(qw.admit(address3))
+
+    def test_admit_perHostLimit(self):
+        qw = self._window(max_outstanding=10, max_outstanding_per_host=1)
+        qw.acquire(address1)
+        self.assertFalse(qw.admit(address1))
+        self.assertTrue(qw.admit(address2))
+
+    def test_release_sendsWaitingInOrder(self):
+        qw = self._window(max_outstanding=1, max_outstanding_per_host=1)
+        sent = []
+        send = lambda address: (qw.acquire(address), sent.append(address))
+        qw.acquire(address1)
+        qw.enqueue(address2, 15, Counter(), send, address2)
+        qw.enqueue(address3, 15, Counter(), send, address3)
+        self.assertEquals(2, qw.queue_depth())
+        qw.release(address1)
+        self.assertEquals([address2], sent)
+        qw.release(address2)
+        self.assertEquals([address2, address3], sent)
+        self.assertEquals(0, qw.queue_depth())
+        self.assertEquals(2, qw.max_queue_depth)
+
+    def test_release_skipsHostBlockedQueries(self):
+        qw = self._window(max_outstanding=10, max_outstanding_per_host=1)
+        counter = Counter()
+        qw.acquire(address1)
+        qw.enqueue(address1, 15, Counter(), counter)
+        # A query to another address does not wait behind address1
+        self.assertTrue(qw.admit(address2))
+        self.assertFalse(qw.admit(address1))
+        qw.release(address1)
+        self.assertEquals(1, counter.count)
+
+    def test_average_wait_time(self):
+        qw = self._window(max_outstanding=1, max_outstanding_per_host=1)
+        qw.acquire(address1)
+        qw.enqueue(address2, 15, Counter(), Counter())
+        self.clock.set(4)
+        qw.release(address1)
+        self.assertEquals(4, qw.average_wait_time())
+        self.assertEquals(4, qw.max_wait_time)
+
+    def test_release_blockedHostDoesNotHoldBackOthers(self):
+        qw = self._window(max_outstanding=2, max_outstanding_per_host=1)
+        sent = []
+        send = lambda address: (qw.acquire(address), sent.append(address))
+        qw.acquire(address1)
+        qw.acquire(address2)
+        # Queued first, but address1 stays at its per host limit
+        qw.enqueue(address1, 15, Counter(), send, address1)
+        qw.enqueue(address3, 15, Counter(), send, address3)
+        qw.release(address2)
+        self.assertEquals([address3], sent)
+        self.assertEquals(1, qw.queue_depth())
+        qw.release(address3)
+        qw.release(address1)
+        self.assertEquals([address3, address1], sent)
+
+    def test_enqueue_expiresAfterTimeout(self):
+        qw = self._window(max_outstanding=1, max_outstanding_per_host=1)
+        expired = Counter()
+        sent = Counter()
+        qw.acquire(address1)
+        qw.enqueue(address2, 10, expired, sent, address2)
+        self.reactor.advance(9)
+        self.assertEquals(0, expired.count)
+        self.reactor.advance(1)
+        self.assertEquals(1, expired.count)
+        self.assertEquals(1, qw.total_expired)
+        self.assertEquals(0, qw.queue_depth())
+        # The expired query is not sent once there is room again
+        qw.release(address1)
+        self.assertEquals(0, sent.count)
+        self.assertTrue(qw.admit(address2))
+
+    def test_release_cancelsExpiry(self):
+        qw = self._window(max_outstanding=1, max_outstanding_per_host=1)
+        expired = Counter()
+        qw.acquire(address1)
+        qw.enqueue(address2, 10, expired, Counter(), address2)
+        qw.release(address1)
+        self.reactor.advance(10)
+        self.assertEquals(0, expired.count)
+        self.assertEquals(0, len(self.reactor.getDelayedCalls()))
+
+class KRPC_SenderQueryWindowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.monkey_patcher = MonkeyPatcher()
+        self.monkey_patcher.addPatch(krpc_sender, "reactor", HollowReactor())
+        self.monkey_patcher.patch()
+        self.k_messenger = KRPC_Sender(TreeRoutingTable, 2**50)
+        self.k_messenger.transport = HollowTransport()
+        self.k_messenger.query_window = QueryWindow(1, 1,
+                reactor=HollowReactor())
+
+    def tearDown(self):
+        self.monkey_patcher.restore()
+
+    def _ping(self, address):
+        query = Query()
+        query.rpctype = "ping"
+        return self.k_messenger.sendQuery(query, address, 15)
+
+    def test_sendQuery_queuesUntilTransactionCompletes(self):
+        self._ping(address1)
+        self.assertTrue(self.k_messenger.transport._packet_was_sent())
+        counter = Counter()
+        d = self._ping(address2)
+        d.addCallback(counter)
+        # The second query must wait for the first to complete
+        self.assertFalse(self.k_messenger.transport._packet_was_sent())
+        self.assertEquals(1, len(self.k_messenger._transactions))
+        (transaction,) = self.k_messenger._transactions.values()
+        response = transaction.query.build_response()
+        response._from = 9
+        self.k_messenger.responseReceived(response, transaction, address1)
+        # The waiting query is now in flight
+        self.assertTrue(self.k_messenger.transport._packet_was_sent())
+        (transaction,) = self.k_messenger._transactions.values()
+        self.assertEquals(address2, transaction.address)
+        response = transaction.query.build_response()
+        response._from = 10
+        self.k_messenger.responseReceived(response, transaction, address2)
+        self.assertEquals(1, counter.count)
+
+    def test_sendQuery_waitingQueryTimesOut(self):
+        clock = task.Clock()
+        self.k_messenger.query_window = QueryWindow(1, 1, reactor=clock)
+        self._ping(address1)
+        d = self._ping(address2)
+        clock.advance(15)
+        self.assertFailure(d, TimeoutError)
+        self.assertEquals(1, len(self.k_messenger._transactions))
+        return d
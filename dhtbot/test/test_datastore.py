@@ -129,6 +129,40 @@ class DataStoreTestCaseBase(object):
         self.assertEqual(0, len(peers))
         monkey_patcher.restore()
 
+    def test_sample_boundedRandomSubset(self):
+        m = self.datastore(self.reactor)
+        infohashes = range(1, 51)
+        for infohash in infohashes:
+            m.put(infohash, self.peer_generator(infohash))
+        (sample, num) = m.sample(20)
+        self.assertEquals(50, num)
+        self.assertEquals(20, len(set(sample)))
+        self.assertTrue(set(sample) <= set(infohashes))
+        (sample, num) = m.sample(100)
+        self.assertEquals(sorted(infohashes), sorted(sample))
+
+    def test_sample_refreshedAfterInterval(self):
+        monkey_patcher = MonkeyPatcher()
+        c = clock()
+        c.set(0)
+        monkey_patcher.addPatch(datastore, "time", c)
+        monkey_patcher.addPatch(constants, "peer_timeout", 5)
+        monkey_patcher.patch()
+        m = self.datastore(self.reactor)
+        m.put(1, self.peer_generator(1))
+        self.assertEquals(([1], 1), m.sample(20))
+        # The same sample is handed out until the interval passes
+        m.put(2, self.peer_generator(2))
+        self.assertEquals(([1], 2), m.sample(20))
+        c.set(constants.sample_infohashes_interval)
+        (sample, num) = m.sample(20)
+        self.assertEquals([1, 2], sorted(sample))
+        # Timed out infohashes are no longer sampled
+        c.set(constants.sample_infohashes_interval * 2)
+        m._cleanup(1, self.peer_generator(1))
+        self.assertEquals(([2], 1), m.sample(20))
+        monkey_patcher.restore()
+
 class MemoryDataStoreTestCase(DataStoreTestCaseBase, unittest.TestCase):
     def setUp(self):
         self.datastore = datastore.MemoryDataStore
@@ -1,6 +1,6 @@
 from twisted.trial import unittest
 
-from dhtbot.krpc_types import _KRPC, Query, Response, Error
+from dhtbot.krpc_types import _KRPC, Query, Response, Error, RawField
 
 class KRPCTestCase(unittest.TestCase):
     def test_build_repr_empty(self):
@@ -89,6 +89,20 @@ class ResponseTestCase(unittest.TestCase):
         self.r2._from = 5555
         self.assertNotEquals(self.r, self.r2)
 
+    def test_nodes_decodedOnFirstAccess(self):
+        decoded = []
+        def decoder(raw):
+            decoded.append(raw)
+            return [raw]
+        self.r.nodes = RawField(decoder, "raw nodes")
+        self.assertEquals([], decoded)
+        self.assertEquals(["raw nodes"], self.r.nodes)
+        self.assertEquals(["raw nodes"], self.r.nodes)
+        self.assertEquals(["raw nodes"], decoded)
+
+    def test_slots_unknownAttribute(self):
+        self.assertRaises(AttributeError, setattr, self.r, "nodez", [])
+
 class ErrorTestCase(unittest.TestCase):
     def test_repr(self):
         e = Error()
@@ -0,0 +1,69 @@
+import json
+
+from twisted.trial import unittest
+
+from dhtbot.metrics import Histogram, KRPC_Metrics
+
+class HistogramTestCase(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram([1, 0.1, 10])
+        for value in [0.05, 0.1, 0.5, 20, 30]:
+            histogram.observe(value)
+        self.assertEquals((0.1, 1, 10), histogram.bounds)
+        self.assertEquals([2, 1, 0, 2], list(histogram.counts))
+        self.assertEquals(5, histogram.count)
+        self.assertAlmostEqual(50.65, histogram.sum)
+
+    def test_cumulative_counts(self):
+        histogram = Histogram([0.1, 1])
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEquals([(0.1, 0), (1, 1), (float("inf"), 2)],
+                          histogram.cumulative_counts())
+
+class KRPC_MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = KRPC_Metrics(rtt_buckets=[0.1, 1])
+
+    def test_snapshot(self):
+        self.metrics.query_sent("ping")
+        self.metrics.query_sent("ping")
+        self.metrics.query_received("get_peers")
+        self.metrics.response_received("ping", 0.05)
+        self.metrics.error_received("ping")
+        self.metrics.timed_out("find_node")
+        self.metrics.malformed_packet()
+        self.metrics.orphaned_reply()
+        snapshot = self.metrics.snapshot()
+        self.assertEquals(2, snapshot["queries_sent"]["ping"])
+        self.assertEquals(0, snapshot["queries_sent"]["find_node"])
+        self.assertEquals(1, snapshot["queries_received"]["get_peers"])
+        self.assertEquals(1, snapshot["responses_received"]["ping"])
+        self.assertEquals(1, snapshot["errors_received"]["ping"])
+        self.assertEquals(1, snapshot["timeouts"]["find_node"])
+        self.assertEquals(1, snapshot["malformed_packets"])
+        self.assertEquals(1, snapshot["orphaned_replies"])
+        self.assertEquals([1, 0, 0], snapshot["rtt"]["ping"]["counts"])
+        # The snapshot must survive a JSON round trip
+        self.assertEquals(snapshot["rtt"]["ping"],
+                          json.loads(json.dumps(snapshot))["rtt"]["ping"])
+
+    def test_unknownRPCTypesAreCountedAsOther(self):
+        self.metrics.query_received("get")
+        self.metrics.query_received("put")
+        self.assertEquals(2,
+                self.metrics.snapshot()["queries_received"]["other"])
+
+    def test_prometheus_text(self):
+        self.metrics.query_sent("ping")
+        self.metrics.response_received("ping", 0.5)
+        lines = self.metrics.prometheus_text().splitlines()
+        self.assertIn('dhtbot_queries_sent_total{rpctype="ping"} 1', lines)
+        self.assertIn('dhtbot_malformed_packets_total 0', lines)
+        self.assertIn(
+            'dhtbot_rtt_seconds_bucket{rpctype="ping",le="0.1"} 0', lines)
+        self.assertIn(
+            'dhtbot_rtt_seconds_bucket{rpctype="ping",le="1.0"} 1', lines)
+        self.assertIn(
+            'dhtbot_rtt_seconds_bucket{rpctype="ping",le="+Inf"} 1', lines)
+        self.assertIn('dhtbot_rtt_seconds_count{rpctype="ping"} 1', lines)
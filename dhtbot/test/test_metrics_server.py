@@ -0,0 +1,28 @@
+import json
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from dhtbot.metrics import KRPC_Metrics
+from dhtbot.metrics_server import MetricsResource
+
+class MetricsResourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = KRPC_Metrics()
+        self.metrics.query_sent("ping")
+        self.resource = MetricsResource(self.metrics)
+
+    def test_render_prometheus(self):
+        request = DummyRequest(["metrics"])
+        self.assertEquals(self.metrics.prometheus_text(),
+                          self.resource.render_GET(request))
+
+    def test_render_json(self):
+        request = DummyRequest(["metrics.json"])
+        snapshot = json.loads(self.resource.render_GET(request))
+        self.assertEquals(1, snapshot["queries_sent"]["ping"])
+
+    def test_render_unknownPath(self):
+        request = DummyRequest(["other"])
+        self.resource.render_GET(request)
+        self.assertEquals(404, request.responseCode)
@@ -0,0 +1,127 @@
+import time
+
+from twisted.trial import unittest
+
+from dhtbot.protocols import krpc_sender
+from dhtbot.simulator import (VirtualClock, NodeClock, Simulator,
+                              ChurnModel, constant_latency)
+
+class VirtualClockTestCase(unittest.TestCase):
+    def test_advance_runsCallsInOrderAtTheirTime(self):
+        clock = VirtualClock()
+        seen = []
+        record = lambda name: seen.append((name, clock.seconds()))
+        clock.callLater(2, record, "b")
+        clock.callLater(1, record, "a")
+        clock.callLater(5, record, "c")
+        clock.advance(3)
+        self.assertEquals([("a", 1), ("b", 2)], seen)
+        self.assertEquals(3, clock.seconds())
+
+    def test_cancel_reset(self):
+        clock = VirtualClock()
+        seen = []
+        cancelled = clock.callLater(1, lambda: seen.append("cancelled"))
+        reset = clock.callLater(1, lambda: seen.append("reset"))
+        cancelled.cancel()
+        reset.reset(4)
+        clock.advance(2)
+        self.assertEquals([], seen)
+        self.assertEquals([reset], clock.getDelayedCalls())
+        clock.advance(3)
+        self.assertEquals(["reset"], seen)
+
+class NodeClockTestCase(unittest.TestCase):
+    def test_cancel_all_cancelsOnlyTheNodesCalls(self):
+        clock = VirtualClock()
+        node_clock = NodeClock(clock)
+        seen = []
+        node_clock.callLater(1, seen.append, "ran")
+        node_clock.callLater(2, seen.append, "cancelled")
+        clock.callLater(2, seen.append, "other node")
+        clock.advance(1)
+        self.assertEquals(1, len(node_clock.getDelayedCalls()))
+        node_clock.cancel_all()
+        clock.advance(5)
+        self.assertEquals(["ran", "other node"], seen)
+
+class SimulatorTestCase(unittest.TestCase):
+    def _simulate(self, **kwargs):
+        """Bootstrap a small network and run a few lookups"""
+        simulator = Simulator(num_nodes=60, seed=7,
+                              latency=constant_latency(0.05), **kwargs)
+        simulator.start()
+        try:
+            simulator.bootstrap(spread=1)
+            lookups = []
+            for i in range(5):
+                d = simulator.lookup(simulator.random_node(),
+                                     simulator.random_id())
+                lookups.append(simulator.run_until(d))
+            simulator.run(5)
+        finally:
+            simulator.stop()
+        return (simulator, lookups)
+
+    def test_stop_restoresPatches(self):
+        original_reactor = krpc_sender.reactor
+        original_time = time.time
+        self._simulate()
+        self.assertTrue(krpc_sender.reactor is original_reactor)
+        self.assertTrue(time.time is original_time)
+
+    def test_lookup_findsClosestNodes(self):
+        (simulator, lookups) = self._simulate()
+        for lookup in lookups:
+            self.assertTrue(lookup.stats.responses > 0)
+            closest = min(simulator.nodes,
+                    key=lambda node: node.node_id ^ lookup.target_id)
+            self.assertEquals(closest.node_id,
+                              lookup.closest_nodes()[0].node_id)
+        self.assertTrue(simulator.convergence() > 0.5)
+
+    def test_run_isDeterministic(self):
+        (first, first_lookups) = self._simulate(loss=0.05)
+        (second, second_lookups) = self._simulate(loss=0.05)
+        self.assertEquals(first.network.sent, second.network.sent)
+        self.assertEquals(first.network.lost, second.network.lost)
+        self.assertTrue(first.network.lost > 0)
+        self.assertEquals([lookup.target_id for lookup in first_lookups],
+                          [lookup.target_id for lookup in second_lookups])
+        self.assertEquals(first.clock.seconds(), second.clock.seconds())
+
+    def test_churn_replacesNodes(self):
+        (simulator, lookups) = self._simulate(churn=ChurnModel(0.02))
+        self.assertTrue(simulator.departed > 0)
+        self.assertEquals(simulator.departed, simulator.joined)
+        self.assertEquals(60, len(simulator.nodes))
+        self.assertTrue(simulator.network.unreachable > 0)
+
+    def test_depart_silencesTheNode(self):
+        simulator = Simulator(num_nodes=30, seed=3,
+                              latency=constant_latency(0.05))
+        simulator.start()
+        try:
+            node = simulator.random_node()
+            d = simulator.lookup(node, simulator.random_id())
+            d.addErrback(lambda failure: None)
+            simulator.clock.step()
+            simulator.depart(node)
+            sources = []
+            send = simulator.network.send
+            def record(packet, source, destination):
+                sources.append(source)
+                send(packet, source, destination)
+            simulator.network.send = record
+            self.assertFalse(simulator.is_online(node))
+            self.assertEquals(29, len(simulator.nodes))
+            self.assertEquals(1, simulator.departed)
+            # The lookup neither times its queries out nor sends any
+            # more of them
+            simulator.run(60)
+            node.transport.write("packet", ("10.0.0.1", 6881))
+        finally:
+            simulator.stop()
+        # (the nodes it queried before leaving still respond)
+        self.assertTrue(len(sources) > 0)
+        self.assertFalse(node.transport.address in sources)